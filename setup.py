@@ -27,6 +27,9 @@ setuptools.setup(
     license='Apache License 2.0',
     packages=setuptools.find_packages(),
     include_package_data=True,
+    extras_require={
+        'parquet': ['pyarrow>=0.17'],
+    },
 
     keywords='machine-learning ai information-extraction weak-supervision',
     classifiers=[
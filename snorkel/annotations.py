@@ -5,17 +5,19 @@ from __future__ import unicode_literals
 from builtins import *
 from future.utils import iteritems
 
+import io
 import numpy as np
 from pandas import DataFrame, Series
 import scipy.sparse as sparse
+from sqlalchemy.orm import load_only
 from sqlalchemy.sql import bindparam, select
 
 from snorkel.features import get_span_feats
 from snorkel.models import (
     GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate,
-    Marginal
+    Marginal, Sentence, Span
 )
-from snorkel.models.meta import new_sessionmaker
+from snorkel.models.meta import new_sessionmaker, snorkel_postgres
 from snorkel.udf import UDF, UDFRunner
 from snorkel.utils import (
     matrix_conflicts,
@@ -166,6 +168,13 @@ class Annotator(UDFRunner):
 
     def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None,
         **kwargs):
+        """
+        Annotates the candidates of a split and returns the annotation matrix.
+
+        :param sentence_columns: Optional list of the Sentence attributes the annotation functions read (e.g.
+            ['words', 'text']). If set, only these columns of the candidates' Sentences are loaded up front; any
+            other column is loaded on first access.
+        """
         # If we are replacing the key set, make sure the reducer key id cache is cleared!
         if replace_key_set:
             self.reducer.key_cache = {}
@@ -241,7 +250,7 @@ class AnnotatorUDF(UDF):
 
         super(AnnotatorUDF, self).__init__(**kwargs)
 
-    def apply(self, cid, **kwargs):
+    def apply(self, cid, sentence_columns=None, **kwargs):
         """
         Applies a given function to a Candidate, yielding a set of Annotations as key_name, value pairs
 
@@ -251,6 +260,10 @@ class AnnotatorUDF(UDF):
         seen = set()
         cid = cid[0]
         c    = self.session.query(Candidate).filter(Candidate.id == cid).one()
+
+        # Keep the preloaded contexts referenced, so they stay in the session's identity map
+        contexts = self._load_contexts(c, sentence_columns) if sentence_columns is not None else None
+
         for key_name, value in self.anno_generator(c):
 
             # Note: Make sure no duplicates emitted here!
@@ -258,6 +271,18 @@ class AnnotatorUDF(UDF):
                 seen.add((cid, key_name))
                 yield cid, key_name, value
 
+    def _load_contexts(self, c, sentence_columns):
+        """
+        Loads the Span arguments of a Candidate with one query, and their Sentences with only the given columns
+        """
+        arg_ids  = [getattr(c, arg_name + '_id') for arg_name in c.__argnames__]
+        spans    = self.session.query(Span).filter(Span.id.in_(arg_ids)).all()
+        columns  = set(sentence_columns) | set(['document_id'])
+        sentence_ids = set(span.sentence_id for span in spans)
+        sentences = self.session.query(Sentence).options(load_only(*columns))\
+                                .filter(Sentence.id.in_(sentence_ids)).all() if sentence_ids else []
+        return spans + sentences
+
     def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
         """
         Inserts Annotations into the database.
@@ -333,12 +358,14 @@ def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
     """
     cid_query = cids_query or session.query(Candidate.id)\
                                      .filter(Candidate.split == split)
+    cid_subquery = cid_query.subquery()
     cid_query = cid_query.order_by(Candidate.id)
 
     keys_query = session.query(annotation_key_class.id)
     keys_query = keys_query.filter(annotation_key_class.group == key_group)
     if key_names is not None:
         keys_query = keys_query.filter(annotation_key_class.name.in_(frozenset(key_names)))
+    keys_subquery = keys_query.subquery()
     keys_query = keys_query.order_by(annotation_key_class.id)
 
     # First, we query to construct the row index map
@@ -369,12 +396,13 @@ def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
     data = []
 
     # Rely on the core for fast iteration
-    annot_select_query = annotation_class.__table__.select()
+    # Only the annotations of the key group and candidates are selected, using the indexes on the key group and on
+    # the annotations' (candidate_id, key_id)
+    annotations = annotation_class.__table__
+    annot_select_query = select([annotations.c.candidate_id, annotations.c.key_id, annotations.c.value])\
+        .where(annotations.c.key_id.in_(select([list(keys_subquery.c)[0]])))\
+        .where(annotations.c.candidate_id.in_(select([list(cid_subquery.c)[0]])))
 
-    # Iteratively construct row index and output sparse matrix
-    # Cycles through the entire table to load the data.
-    # Perfornamce may slow down based on table size; however, negligible since
-    # it takes 8min to go throuh 245M rows (pretty fast).
     for res in session.execute(annot_select_query):
         # NOTE: The order of return seems to be switched in Python 3???
         # Either way, make sure the order is set here explicitly!
@@ -466,7 +494,7 @@ class FeatureAnnotator(Annotator):
         return load_feature_matrix(session, coerce_int=False, **kwargs)
 
 
-def save_marginals(session, X, marginals, training=True):
+def save_marginals(session, X, marginals, training=True, chunk_size=100000):
     """Save marginal probabilities for a set of Candidates to db.
 
     :param X: Either an M x N csr_AnnotationMatrix-class matrix, where M
@@ -476,6 +504,8 @@ def save_marginals(session, X, marginals, training=True):
         K is the cardinality of the candidates, OR a M-dim list/array if K=2.
     :param training: If True, these are training marginals / labels; else they
         are saved as end model predictions.
+    :param chunk_size: Number of rows written per INSERT batch (or COPY on
+        Postgres).
 
     Note: The marginals for k=0 are not stored, only for k = 1,...,K
     """
@@ -491,43 +521,46 @@ def save_marginals(session, X, marginals, training=True):
     if len(shape) == 1:
         marginals = np.vstack([1-marginals, marginals]).T
 
+    # Candidate ids of the rows; an AnnotationMatrix maps rows to ids directly
+    if isinstance(X, csr_AnnotationMatrix):
+        cids = np.array([X.row_index[i] for i in range(shape[0])], dtype=np.int64)
+    else:
+        cids = np.array([x.id for x in X], dtype=np.int64)
+
     # Only add values for classes k=1,...,K
-    marginal_tuples = []
-    for i in range(shape[0]):
-        for k in range(1, shape[1] if len(shape) > 1 else 2):
-            if marginals[i, k] > 0:
-                marginal_tuples.append((i, k, marginals[i, k]))
+    rows, ks = np.nonzero(marginals[:, 1:] > 0)
+    ks += 1
+    cids, probs = cids[rows], marginals[rows, ks].astype(np.float64)
 
     # NOTE: This will delete all existing marginals of type `training`
     session.query(Marginal).filter(Marginal.training == training).\
-        delete(synchronize_session='fetch')
+        delete(synchronize_session=False)
 
-    # Prepare bulk INSERT query
+    # Bulk insert in chunks, with COPY on Postgres
     q = Marginal.__table__.insert()
-
-    # Check whether X is an AnnotationMatrix or not
-    anno_matrix = isinstance(X, csr_AnnotationMatrix)
-    if not anno_matrix:
-        X = list(X)
-
-    # Prepare values
-    insert_vals = []
-    for i, k, p in marginal_tuples:
-        cid = X.get_candidate(session, i).id if anno_matrix else X[i].id
-        insert_vals.append({
-            'candidate_id': cid,
-            'training': training,
-            'value': k,
-            # We cast p in case its a numpy type, which psycopg2 does not handle
-            'probability': float(p)
-        })
-
-    # Execute update
-    session.execute(q, insert_vals)
+    for i in range(0, len(cids), chunk_size):
+        chunk = slice(i, i + chunk_size)
+        if snorkel_postgres:
+            _copy_marginals(session, cids[chunk], ks[chunk], probs[chunk], training)
+        else:
+            session.execute(q, [
+                {'candidate_id': cid, 'training': training, 'value': k, 'probability': p}
+                for cid, k, p in zip(cids[chunk].tolist(), ks[chunk].tolist(), probs[chunk].tolist())
+            ])
     session.commit()
     print("Saved %s marginals" % len(marginals))
 
 
+def _copy_marginals(session, cids, ks, probs, training):
+    """Writes marginal rows with a Postgres COPY over the session's connection"""
+    buf = io.StringIO()
+    for cid, k, p in zip(cids.tolist(), ks.tolist(), probs.tolist()):
+        buf.write('%d,%d,%r,%s\n' % (cid, k, p, 'true' if training else 'false'))
+    buf.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert("COPY marginal (candidate_id, value, probability, training) FROM STDIN WITH CSV", buf)
+
+
 def load_marginals(session, X=None, split=0, cids_query=None, training=True):
     """Load the marginal probs. for a given split of Candidates"""
     # For candidate ids subquery
@@ -543,6 +576,10 @@ def load_marginals(session, X=None, split=0, cids_query=None, training=True):
         .filter(Marginal.candidate_id == cids_sub_query.c.id) \
         .filter(Marginal.training == training) \
         .all()
+    if marginal_tuples:
+        m_cids, m_ks, m_probs = [np.array(col) for col in zip(*marginal_tuples)]
+    else:
+        m_cids, m_ks, m_probs = [np.zeros(0, dtype=np.int64)] * 2 + [np.zeros(0)]
 
     # If an AnnotationMatrix or list of candidates X is provided, we make sure
     # that the returned marginals are collated with X.
@@ -568,15 +605,21 @@ def load_marginals(session, X=None, split=0, cids_query=None, training=True):
         marginals = np.zeros((cids_query.count(), cardinality))
         cid_map = dict([(cid, i) for i, (cid,) in enumerate(cids_query.all())])
 
-    # Assemble the marginals matrix according to the candidate index of X
-    for cid, k, p in marginal_tuples:
-        marginals[cid_map[cid], k] = p
+    # Assemble the marginals matrix according to the candidate index of X,
+    # mapping candidate ids to rows by binary search over the sorted ids
+    map_cids = np.fromiter(cid_map.keys(), dtype=np.int64, count=len(cid_map))
+    map_rows = np.fromiter(cid_map.values(), dtype=np.int64, count=len(cid_map))
+    order = np.argsort(map_cids)
+    map_cids, map_rows = map_cids[order], map_rows[order]
+    pos = np.minimum(np.searchsorted(map_cids, m_cids), max(len(map_cids) - 1, 0))
+    missing = map_cids[pos] != m_cids if len(map_cids) > 0 else np.ones(len(m_cids), dtype=bool)
+    if missing.any():
+        raise KeyError(m_cids[missing][0])
+    marginals[map_rows[pos], m_ks] = m_probs
 
     # Add first column if k > 2, else ravel
     if cardinality > 2:
-        row_sums = marginals.sum(axis=1)
-        for i in range(marginals.shape[0]):
-            marginals[i, 0] = 1 - row_sums[i]
+        marginals[:, 0] = 1 - marginals.sum(axis=1)
     else:
         marginals = np.ravel(marginals[:, 1])
     return marginals
@@ -7,11 +7,14 @@ from future.utils import iteritems
 
 from collections import defaultdict
 from copy import deepcopy
-from itertools import product
+from itertools import chain, product
+import numpy as np
 import re
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, text
 
-from snorkel.models import Candidate, TemporarySpan, Sentence, TemporaryDocument
+from snorkel.db_helpers import IdAllocator
+from snorkel.matchers import CompiledMatcher
+from snorkel.models import Candidate, Context, TemporarySpan, Sentence, TemporaryDocument
 from snorkel.udf import UDF, UDFRunner
 
 
@@ -31,25 +34,55 @@ class CandidateExtractor(UDFRunner):
                              that contains it. Only applies to binary relations. Default is False.
     :param symmetric_relations: Boolean indicating whether to extract symmetric Candidates, i.e., rel(A,B) and rel(B,A),
                                 where A and B are Contexts. Only applies to binary relations. Default is False.
+    :param compile_matchers: Boolean indicating whether to apply the matchers through plans compiled with
+                             :func:`snorkel.matchers.Matcher.compile`, which memoize the results of matchers sharing
+                             subtrees or evaluating slices of spans. Only worth it for such expensive matcher trees.
+                             Default is False.
     """
-    def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False, symmetric_relations=False):
+    def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False,
+                 symmetric_relations=False, compile_matchers=False):
         super(CandidateExtractor, self).__init__(CandidateExtractorUDF,
                                                  candidate_class=candidate_class,
                                                  cspaces=cspaces,
                                                  matchers=matchers,
                                                  self_relations=self_relations,
                                                  nested_relations=nested_relations,
-                                                 symmetric_relations=symmetric_relations)
-
-    def apply(self, xs, split=0, **kwargs):
-        super(CandidateExtractor, self).apply(xs, split=split, **kwargs)
+                                                 symmetric_relations=symmetric_relations,
+                                                 compile_matchers=compile_matchers)
+
+    def apply(self, xs, split=0, by_document=False, document_batch_size=100, **kwargs):
+        """
+        Extract candidates from the contexts xs.
+
+        :param by_document: If True, the contexts are grouped by document into batches covering disjoint sets of
+                            documents, and each batch is extracted by a single worker, which writes the new child
+                            contexts and candidates with bulk inserts using ids from pre-reserved blocks. This avoids
+                            contention between workers when running with parallelism > 1.
+        :param document_batch_size: The number of documents per batch if by_document=True.
+        """
+        if by_document:
+            xs = self._batch_by_document(xs, document_batch_size)
+        super(CandidateExtractor, self).apply(xs, split=split, by_document=by_document, **kwargs)
+
+    def _batch_by_document(self, xs, document_batch_size):
+        """Groups contexts into lists of the contexts of document_batch_size consecutive documents"""
+        docs = defaultdict(list)
+        for x in xs:
+            docs[getattr(x, 'document_id', x.id)].append(x)
+        doc_ids = sorted(docs.keys())
+        return [list(chain(*[docs[doc_id] for doc_id in doc_ids[k:k+document_batch_size]]))
+                for k in range(0, len(doc_ids), document_batch_size)]
 
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
 
 class CandidateExtractorUDF(UDF):
-    def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations, **kwargs):
+    # Maximum number of values in a single IN (...) lookup during bulk extraction
+    BULK_CHUNK_SIZE = 500
+
+    def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations,
+                 compile_matchers=False, **kwargs):
         self.candidate_class     = candidate_class
         # Note: isinstance is the way to check types -- not type(x) in [...]!
         self.candidate_spaces    = cspaces if isinstance(cspaces, (list, tuple)) else [cspaces]
@@ -64,6 +97,16 @@ class CandidateExtractorUDF(UDF):
         else:
             self.arity = len(self.candidate_spaces)
 
+        # Optionally compile the matchers into memoized plans; the same matcher passed twice shares a single plan
+        self.plans = []
+        if compile_matchers:
+            plans = {}
+            for matcher in self.matchers:
+                if id(matcher) not in plans:
+                    plans[id(matcher)] = matcher.compile()
+            self.matchers = [plans[id(matcher)] for matcher in self.matchers]
+            self.plans    = [plan for plan in plans.values() if isinstance(plan, CompiledMatcher)]
+
         # Make sure the candidate spaces are different so generators aren't expended!
         self.candidate_spaces = list(map(deepcopy, self.candidate_spaces))
 
@@ -72,21 +115,64 @@ class CandidateExtractorUDF(UDF):
         for i in range(self.arity):
             self.child_context_sets[i] = set()
 
+        # Id allocators for bulk inserts, created on first use so that each worker process reserves its own blocks
+        self.context_ids   = None
+        self.candidate_ids = None
+
         super(CandidateExtractorUDF, self).__init__(**kwargs)
 
-    def apply(self, context, clear, split, **kwargs):
+    def apply(self, context, clear, split, by_document=False, **kwargs):
+        # In document-parallel mode, the input is a batch of contexts which is written with bulk inserts
+        if by_document:
+            self._apply_bulk(context, clear, split)
+            return
+
         # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
         # by the Matcher
+        self._refresh_plans()
         for i in range(self.arity):
             self.child_context_sets[i].clear()
-            for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
+            for tc in self._get_child_contexts(i, context):
                 tc.load_id_or_insert(self.session)
                 self.child_context_sets[i].add(tc)
 
         # Generates and persists candidates
-        extracted = set()
         candidate_args = {'split': split}
-        for args in product(*[enumerate(child_contexts) for child_contexts in self.child_context_sets]):
+        for args in self._get_candidate_tuples(self.child_context_sets):
+
+            # Assemble candidate arguments
+            for i, arg_name in enumerate(self.candidate_class.__argnames__):
+                candidate_args[arg_name + '_id'] = args[i].id
+
+            # Checking for existence
+            if not clear:
+                q = select([self.candidate_class.id])
+                for key, value in iteritems(candidate_args):
+                    q = q.where(getattr(self.candidate_class, key) == value)
+                candidate_id = self.session.execute(q).first()
+                if candidate_id is not None:
+                    continue
+
+            # Add Candidate to session
+            yield self.candidate_class(**candidate_args)
+
+    def _refresh_plans(self):
+        """Picks up changes made to the matchers since they were compiled; done once per context, before prefiltering"""
+        for plan in self.plans:
+            plan.refresh()
+
+    def _get_child_contexts(self, i, context):
+        """Generates the TemporaryContexts for argument i: children of the context accepted by the Matcher"""
+        matcher = self.matchers[i]
+        children = self.candidate_spaces[i].apply_prefiltered(context, matcher)
+        if isinstance(matcher, CompiledMatcher):
+            return matcher.apply(children, refresh=False)
+        return matcher.apply(children)
+
+    def _get_candidate_tuples(self, child_context_sets):
+        """Generates the tuples of child contexts making up the candidates of a context"""
+        extracted = set()
+        for args in product(*[enumerate(child_contexts) for child_contexts in child_context_sets]):
 
             # TODO: Make this work for higher-order relations
             if self.arity == 2:
@@ -107,21 +193,82 @@ class CandidateExtractorUDF(UDF):
                 # Keep track of extracted
                 extracted.add((a,b))
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-
-            # Checking for existence
-            if not clear:
-                q = select([self.candidate_class.id])
-                for key, value in iteritems(candidate_args):
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
-
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+            yield tuple(tc for _, tc in args)
+
+    def _apply_bulk(self, contexts, clear, split):
+        """
+        Extracts the candidates of a batch of contexts, which no other worker processes, writing the new child
+        contexts and candidates with bulk inserts using ids from pre-reserved blocks.
+        """
+        if self.context_ids is None:
+            self.context_ids   = IdAllocator(self.session, Context.__table__)
+            self.candidate_ids = IdAllocator(self.session, Candidate.__table__)
+
+        # Match child contexts for the whole batch first
+        child_context_sets = []
+        for context in contexts:
+            self._refresh_plans()
+            child_context_sets.append([set(self._get_child_contexts(i, context)) for i in range(self.arity)])
+
+        # Resolve the ids of child contexts that already exist with a single query per chunk of stable ids,
+        # then insert the missing ones
+        new_contexts = {}
+        for sets in child_context_sets:
+            for tc in chain(*sets):
+                if tc.id is None:
+                    new_contexts.setdefault(tc.get_stable_id(), tc)
+        stable_ids = list(new_contexts.keys())
+        context_ids = {}
+        for k in range(0, len(stable_ids), self.BULK_CHUNK_SIZE):
+            chunk = stable_ids[k:k+self.BULK_CHUNK_SIZE]
+            q = select([Context.stable_id, Context.id]).where(Context.stable_id.in_(chunk))
+            context_ids.update(self.session.execute(q).fetchall())
+        missing = [stable_id for stable_id in stable_ids if stable_id not in context_ids]
+        context_ids.update(zip(missing, self.context_ids.next_ids(len(missing))))
+        if missing:
+            context_rows, insert_args = [], defaultdict(list)
+            for stable_id in missing:
+                tc = new_contexts[stable_id]
+                row = {'id': context_ids[stable_id], 'type': tc._get_table_name(), 'stable_id': stable_id}
+                row.update(tc.get_stable_key())
+                context_rows.append(row)
+                args = tc._get_insert_args()
+                args['id'] = context_ids[stable_id]
+                insert_args[tc._get_insert_query()].append(args)
+            self.session.execute(Context.__table__.insert(), context_rows)
+            for query, args in iteritems(insert_args):
+                self.session.execute(text(query), args)
+        for sets in child_context_sets:
+            for tc in chain(*sets):
+                if tc.id is None:
+                    tc.id = context_ids[tc.get_stable_id()]
+
+        # Assemble the candidates, skipping existing ones
+        arg_names = self.candidate_class.__argnames__
+        candidates = set()
+        for sets in child_context_sets:
+            for args in self._get_candidate_tuples(sets):
+                candidates.add(tuple(tc.id for tc in args))
+        if not clear and candidates:
+            arg_cols = [getattr(self.candidate_class, arg_name + '_id') for arg_name in arg_names]
+            first_ids = list(set(c[0] for c in candidates))
+            for k in range(0, len(first_ids), self.BULK_CHUNK_SIZE):
+                q = select(arg_cols).where(self.candidate_class.split == split)\
+                                    .where(arg_cols[0].in_(first_ids[k:k+self.BULK_CHUNK_SIZE]))
+                candidates.difference_update(tuple(row) for row in self.session.execute(q))
+
+        # Bulk insert the candidates
+        if candidates:
+            candidate_type = self.candidate_class.__mapper__.polymorphic_identity
+            candidate_rows, subclass_rows = [], []
+            for cid, args in zip(self.candidate_ids.next_ids(len(candidates)), candidates):
+                candidate_rows.append({'id': cid, 'type': candidate_type, 'split': split})
+                row = {'id': cid}
+                for arg_name, arg_id in zip(arg_names, args):
+                    row[arg_name + '_id'] = arg_id
+                subclass_rows.append(row)
+            self.session.execute(Candidate.__table__.insert(), candidate_rows)
+            self.session.execute(self.candidate_class.__table__.insert(), subclass_rows)
 
 
 class CandidateSpace(object):
@@ -135,6 +282,13 @@ class CandidateSpace(object):
     def apply(self, x):
         raise NotImplementedError()
 
+    def apply_prefiltered(self, x, matcher):
+        """
+        Like apply(x), but may skip candidates that _matcher_ rules out via Matcher.prefilter before they are
+        constructed. By default, no candidates are skipped.
+        """
+        return self.apply(x)
+
 
 class DocCandidate(CandidateSpace):
     """
@@ -170,37 +324,66 @@ class Ngrams(CandidateSpace):
         self.n_max     = n_max
         self.split_rgx = r'('+r'|'.join(split_tokens)+r')' if split_tokens and len(split_tokens) > 0 else None
 
-    def apply(self, context):
+    def get_char_offsets(self, context):
+        """
+        Returns arrays of the (char_start, char_end) offsets--**relative to the sentence start**--of all distinct
+        n-grams in the context, in the order in which apply() yields them: n-grams in **reverse** order of length
+        (to facilitate longest-match semantics), with the pieces of each split unigram following the unigram.
+        """
+        offsets = np.asarray(context.char_offsets, dtype=np.int64)
+        L       = len(offsets)
+        if L == 0 or self.n_max < 1:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        tok_ends = offsets + np.array([len(w) for w in context.words], dtype=np.int64) - 1
+
+        # All n-grams with n > 1, longest first
+        starts, ends = [], []
+        for l in range(min(self.n_max, L), 1, -1):
+            starts.append(offsets[:L-l+1])
+            ends.append(tok_ends[l-1:])
+
+        # Unigrams, each followed by the two pieces it splits into (if any)
+        # NOTE: For simplicity, we only split single tokens right now!
+        uni_starts = np.repeat(offsets, 3).reshape(L, 3)
+        uni_ends   = np.repeat(tok_ends, 3).reshape(L, 3)
+        uni_keep   = np.zeros((L, 3), dtype=bool)
+        uni_keep[:, 0] = True
+        if self.split_rgx is not None:
+            rgx = re.compile(self.split_rgx)
+            for i in np.flatnonzero(tok_ends > offsets).tolist():
+                start, end = offsets[i], tok_ends[i]
+                m = rgx.search(context.text[start-offsets[0]:end-offsets[0]+1])
+                if m is not None:
+                    uni_ends[i, 1]   = start + m.start(1) - 1
+                    uni_starts[i, 2] = start + m.end(1)
+                    # Only keep non-empty pieces
+                    uni_keep[i, 1] = uni_ends[i, 1] >= start
+                    uni_keep[i, 2] = end >= uni_starts[i, 2]
+        starts.append(uni_starts[uni_keep])
+        ends.append(uni_ends[uni_keep])
+        starts = np.concatenate(starts)
+        ends   = np.concatenate(ends)
+
+        # Drop duplicate spans, keeping the first occurrence of each
+        keys = (starts - starts.min()) * (ends.max() - ends.min() + 1) + (ends - ends.min())
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        return starts[first], ends[first]
 
-        # These are the character offset--**relative to the sentence start**--for each _token_
-        offsets = context.char_offsets
-
-        # Loop over all n-grams in **reverse** order (to facilitate longest-match semantics)
-        L    = len(offsets)
-        seen = set()
-        for l in range(1, self.n_max+1)[::-1]:
-            for i in range(L-l+1):
-                w     = context.words[i+l-1]
-                start = offsets[i]
-                end   = offsets[i+l-1] + len(w) - 1
-                ts    = TemporarySpan(char_start=start, char_end=end, sentence=context)
-                if ts not in seen:
-                    seen.add(ts)
-                    yield ts
-
-                # Check for split
-                # NOTE: For simplicity, we only split single tokens right now!
-                if l == 1 and self.split_rgx is not None and end - start > 0:
-                    m = re.search(self.split_rgx, context.text[start-offsets[0]:end-offsets[0]+1])
-                    if m is not None and l < self.n_max + 1:
-                        ts1 = TemporarySpan(char_start=start, char_end=start + m.start(1) - 1, sentence=context)
-                        if ts1 not in seen and ts1.get_span():
-                            seen.add(ts1)
-                            yield ts1
-                        ts2 = TemporarySpan(char_start=start + m.end(1), char_end=end, sentence=context)
-                        if ts2 not in seen and ts1.get_span():
-                            seen.add(ts2)
-                            yield ts2
+    def apply(self, context):
+        return self._get_spans(context, *self.get_char_offsets(context))
+
+    def apply_prefiltered(self, context, matcher):
+        starts, ends = self.get_char_offsets(context)
+        mask = matcher.prefilter(context, starts, ends)
+        if mask is not None:
+            starts, ends = starts[mask], ends[mask]
+        return self._get_spans(context, starts, ends)
+
+    def _get_spans(self, context, starts, ends):
+        """Lazily materializes the TemporarySpans for the given offsets"""
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield TemporarySpan(char_start=start, char_end=end, sentence=context)
 
 
 class PretaggedCandidateExtractor(UDFRunner):
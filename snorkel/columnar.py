@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import json
+import numpy as np
+import scipy.sparse as sparse
+from sqlalchemy import Boolean, Float, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import select
+
+from snorkel.annotations import csr_AnnotationMatrix, csr_LabelMatrix
+from snorkel.models import Candidate, Sentence, Span
+from snorkel.models.column_types import IntArray, StringArray
+import snorkel.models
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    raise ImportError("pyarrow not installed. Use `pip install pyarrow`.")
+
+
+# Key of the Snorkel-specific entry in the metadata of exported Parquet files
+METADATA_KEY = b'snorkel'
+
+
+def export_candidates(session, candidate_class, path, split=0, sentence_columns=None, chunk_size=10000):
+    """
+    Writes the candidates of a split to a Parquet file, one row per candidate, for candidate classes whose arguments
+    are Spans of the same Sentence.
+
+    Each row has the candidate's id and split, the id, sentence id and character offsets of each argument (as
+    <arg>_id, <arg>_sentence_id, <arg>_char_start and <arg>_char_end), and the columns of the first argument's
+    Sentence (as sentence_<column>), with the token arrays as lists.
+
+    :param session: the session to read the candidates with
+    :param candidate_class: the Candidate subclass to export
+    :param path: the Parquet file to write
+    :param split: the split of the candidates to export
+    :param sentence_columns: optional list of the Sentence columns to include (e.g. ['words', 'char_offsets']);
+        by default all columns are included
+    :param chunk_size: the number of candidates read from the database, and written as a row group, at a time
+    :return: the number of candidates written
+    """
+    candidate, subclass, sentence = Candidate.__table__, candidate_class.__table__, Sentence.__table__
+    arg_names = candidate_class.__argnames__
+    spans = [Span.__table__.alias('span%s' % i) for i in range(len(arg_names))]
+
+    columns = [candidate.c.id, candidate.c.split]
+    joined = candidate.join(subclass, subclass.c.id == candidate.c.id)
+    for arg_name, span in zip(arg_names, spans):
+        columns.append(span.c.id.label(arg_name + '_id'))
+        columns.append(span.c.sentence_id.label(arg_name + '_sentence_id'))
+        columns.append(span.c.char_start.label(arg_name + '_char_start'))
+        columns.append(span.c.char_end.label(arg_name + '_char_end'))
+        joined = joined.join(span, span.c.id == getattr(subclass.c, arg_name + '_id'))
+    for column in sentence.columns:
+        if sentence_columns is None or column.name in sentence_columns:
+            columns.append(column.label('sentence_' + column.name))
+    joined = joined.join(sentence, sentence.c.id == spans[0].c.sentence_id)
+
+    q = select(columns).select_from(joined).where(candidate.c.split == split).order_by(candidate.c.id)
+    metadata = {'candidate_class': candidate_class.__name__, 'argnames': list(arg_names)}
+    schema = pa.schema([pa.field(column.name, _arrow_type(column)) for column in columns],
+                       metadata={METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+
+    n = 0
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        result = session.execute(q)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            n += len(rows)
+    finally:
+        writer.close()
+    return n
+
+
+def import_candidates(path, columns=None):
+    """
+    Reads the candidates written by export_candidates, memory-mapping the file.
+
+    :param path: the Parquet file to read
+    :param columns: optional list of the columns to read
+    :return: a pyarrow Table
+    """
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+
+def export_matrix(session, X, path):
+    """
+    Writes an annotation matrix (e.g. a label or feature matrix returned by load_label_matrix or
+    load_feature_matrix) to a Parquet file, as one (candidate_id, key_id, value) row per nonzero entry.
+
+    The candidate ids of the rows and the ids and names of the annotation keys of the columns are stored in the
+    file's metadata, so that import_matrix restores the matrix with the same row and column order.
+
+    :param session: the session to read the annotation key names with
+    :param X: the csr_AnnotationMatrix to export
+    :param path: the Parquet file to write
+    """
+    candidate_ids = [X.row_index[i] for i in range(X.shape[0])]
+    key_ids = [X.col_index[j] for j in range(X.shape[1])]
+    key_names = dict(session.query(X.annotation_key_cls.id, X.annotation_key_cls.name)
+                            .filter(X.annotation_key_cls.id.in_(key_ids)).all()) if key_ids else {}
+
+    coo = X.tocoo()
+    value_type = pa.int32() if np.issubdtype(coo.data.dtype, np.integer) else pa.float64()
+    metadata = {
+        'matrix_class':       type(X).__name__,
+        'annotation_key_cls': X.annotation_key_cls.__name__,
+        'candidate_ids':      candidate_ids,
+        'key_ids':            key_ids,
+        'key_names':          [key_names.get(kid) for kid in key_ids],
+    }
+    schema = pa.schema([pa.field('candidate_id', pa.int64()), pa.field('key_id', pa.int64()),
+                        pa.field('value', value_type)],
+                       metadata={METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+    arrays = [
+        pa.array(np.asarray(candidate_ids, dtype=np.int64)[coo.row], type=pa.int64()),
+        pa.array(np.asarray(key_ids, dtype=np.int64)[coo.col], type=pa.int64()),
+        pa.array(coo.data.astype(value_type.to_pandas_dtype()), type=value_type),
+    ]
+    pq.write_table(pa.Table.from_arrays(arrays, schema=schema), path)
+
+
+def import_matrix(path):
+    """
+    Reads an annotation matrix written by export_matrix, memory-mapping the file.
+
+    :param path: the Parquet file to read
+    :return: a csr_LabelMatrix or csr_AnnotationMatrix with the exported row and column indexes
+    """
+    table = pq.read_table(path, memory_map=True)
+    metadata = json.loads(table.schema.metadata[METADATA_KEY].decode('utf-8'))
+    candidate_ids = np.asarray(metadata['candidate_ids'], dtype=np.int64)
+    key_ids = np.asarray(metadata['key_ids'], dtype=np.int64)
+
+    # Map the candidate and key ids of the entries back to rows and columns
+    cids = table.column('candidate_id').to_numpy()
+    kids = table.column('key_id').to_numpy()
+    row_order, col_order = np.argsort(candidate_ids), np.argsort(key_ids)
+    rows = row_order[np.searchsorted(candidate_ids, cids, sorter=row_order)]
+    cols = col_order[np.searchsorted(key_ids, kids, sorter=col_order)]
+
+    X = sparse.coo_matrix((table.column('value').to_numpy(), (rows, cols)),
+                          shape=(len(candidate_ids), len(key_ids)))
+    matrix_class = csr_LabelMatrix if metadata['matrix_class'] == 'csr_LabelMatrix' else csr_AnnotationMatrix
+    return matrix_class(X,
+                        candidate_index=dict((cid, i) for i, cid in enumerate(metadata['candidate_ids'])),
+                        row_index=dict(enumerate(metadata['candidate_ids'])),
+                        annotation_key_cls=getattr(snorkel.models, metadata['annotation_key_cls'], None),
+                        key_index=dict((kid, j) for j, kid in enumerate(metadata['key_ids'])),
+                        col_index=dict(enumerate(metadata['key_ids'])))
+
+
+def _arrow_type(column):
+    """Returns the Arrow type of the values of a database column"""
+    t = column.type
+    if isinstance(t, IntArray) or (isinstance(t, ARRAY) and isinstance(t.item_type, Integer)):
+        return pa.list_(pa.int32())
+    if isinstance(t, (StringArray, ARRAY)):
+        return pa.list_(pa.string())
+    if isinstance(t, Integer):
+        return pa.int64()
+    if isinstance(t, Float):
+        return pa.float64()
+    if isinstance(t, Boolean):
+        return pa.bool_()
+    return pa.string()
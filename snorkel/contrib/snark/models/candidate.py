@@ -8,6 +8,7 @@ from future.utils import iteritems
 import pickle
 
 from snorkel.models import Sentence, Span
+from snorkel.models.column_types import IntArray, StringArray
 from . import SparkModel
 
 
@@ -82,8 +83,7 @@ def wrap_candidate(row, class_name='Candidate', argnames=None):
     # Create Sentence object
     # Arrays are stored as BLOBs so need to be converted to Python using Pickle
     sentence_args = dict(zip(SENTENCE_COLS, row[-len(SENTENCE_COLS):]))
-    sentence_args = {k: pickle.loads(v) if isinstance(v, bytearray) else v
-                     for k, v in iteritems(sentence_args)}
+    sentence_args = {k: _load_value(Sentence, k, v) for k, v in iteritems(sentence_args)}
     sent = Sentence(**sentence_args)
 
     # Create the Span objects
@@ -91,8 +91,7 @@ def wrap_candidate(row, class_name='Candidate', argnames=None):
     for i in range(arity):
         j = CONTEXT_OFFSET + i * (len(SPAN_COLS) + 1)
         span_args = dict(zip(SPAN_COLS, row[j+1:j+len(SPAN_COLS)]))
-        span_args = {k: pickle.loads(v) if isinstance(v, bytearray) else v
-                for k, v in iteritems(span_args)}
+        span_args = {k: _load_value(Span, k, v) for k, v in iteritems(span_args)}
         span = Span(**span_args)
         # Store the Sentence in the Span
         span.sentence = sent
@@ -111,3 +110,13 @@ def wrap_candidate(row, class_name='Candidate', argnames=None):
     )
 
     return candidate
+
+
+def _load_value(cls, name, value):
+    """Decodes a raw value of column name of the table of cls, if it is stored as a blob"""
+    if not isinstance(value, (bytes, bytearray)):
+        return value
+    column_type = cls.__table__.c[name].type
+    if isinstance(column_type, (IntArray, StringArray)):
+        return column_type.process_result_value(bytes(value), None)
+    return pickle.loads(value)
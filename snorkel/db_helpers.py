@@ -5,11 +5,162 @@ from __future__ import unicode_literals
 from builtins import *
 from future.utils import iteritems
 
-from snorkel.models import StableLabel, GoldLabel, Context, GoldLabelKey
+from snorkel.models import (
+    Candidate, StableLabel, GoldLabel, Context, Document, Sentence, Span, GoldLabelKey, split_stable_id,
+    stable_key_columns
+)
+from snorkel.models.meta import SnorkelBase, add_missing_columns, snorkel_postgres
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect
 from sqlalchemy.orm import object_session
+from sqlalchemy.sql import and_, bindparam, exists, func, literal, select, text
+
+
+# The decomposed stable id columns of the context table
+STABLE_KEY_COLUMNS = ['stable_doc_id', 'stable_type', 'stable_start', 'stable_end']
+
+
+class IdAllocator(object):
+    """
+    Hands out primary key ids for a table from blocks reserved up front, so that many rows can be written with
+    bulk inserts that set their ids explicitly.
+
+    On Postgres, each block is drawn from the table's id sequence in a single round trip, so allocators in
+    different processes never hand out the same id. On other backends (which only support a single writer), blocks
+    start above the largest id in the table.
+
+    :param session: the session to reserve ids with
+    :param table: the Table whose id column to allocate for
+    :param block_size: the number of ids to reserve at a time
+    """
+    def __init__(self, session, table, block_size=1000):
+        self.session    = session
+        self.table      = table
+        self.block_size = block_size
+        self.block      = []
+        self.next_id    = 0
+
+    def _reserve_block(self, n):
+        if snorkel_postgres:
+            q = text("SELECT nextval('%s_id_seq') FROM generate_series(1, :n)" % self.table.name)
+            return [row[0] for row in self.session.execute(q, {'n': n})]
+        start = max(self.session.execute(select([func.max(self.table.c.id)])).scalar() or 0, self.next_id - 1) + 1
+        self.next_id = start + n
+        return list(range(start, start + n))
+
+    def next_ids(self, n):
+        """Returns a list of n unused ids"""
+        if n > len(self.block):
+            self.block.extend(self._reserve_block(max(n - len(self.block), self.block_size)))
+        ids, self.block = self.block[:n], self.block[n:]
+        return ids
+
+
+def backfill_stable_keys(session, chunk_size=10000):
+    """
+    Fills in the decomposed stable id columns (see stable_key_columns) of the Contexts which do not have them, e.g.
+    because they were inserted before the columns were added to the context table.
+
+    :param session: the session to update the Contexts with; it is committed after each chunk
+    :param chunk_size: the number of Contexts read and updated at a time
+    :return: the number of updated Contexts
+    """
+    context, document, sentence, span = Context.__table__, Document.__table__, Sentence.__table__, Span.__table__
+    span_sentence = sentence.alias('span_sentence')
+    document_id = func.coalesce(document.c.id, sentence.c.document_id, span_sentence.c.document_id)
+    joined = context.outerjoin(document, document.c.id == context.c.id)\
+                    .outerjoin(sentence, sentence.c.id == context.c.id)\
+                    .outerjoin(span, span.c.id == context.c.id)\
+                    .outerjoin(span_sentence, span_sentence.c.id == span.c.sentence_id)
+    update = context.update().where(context.c.id == bindparam('context_id'))\
+                    .values(**dict((k, bindparam(k)) for k in STABLE_KEY_COLUMNS))
+
+    n, last_id = 0, -1
+    while True:
+        q = select([context.c.id, context.c.stable_id, document_id]).select_from(joined)\
+            .where(context.c.stable_type.is_(None)).where(context.c.id > last_id)\
+            .order_by(context.c.id).limit(chunk_size)
+        rows = session.execute(q).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for context_id, stable_id, doc_id in rows:
+            key = stable_key_columns(doc_id, stable_id)
+            if key['stable_type'] is not None:
+                key['context_id'] = context_id
+                updates.append(key)
+        if updates:
+            session.execute(update, updates)
+        session.commit()
+        n += len(updates)
+    return n
+
+
+def upgrade_schema(session):
+    """
+    Upgrades a database created by an older version of Snorkel: adds the missing columns of the Snorkel tables, fills
+    in the decomposed stable ids of the existing Contexts, and creates the missing indexes.
+
+    :param session: the session to upgrade the database with; it is committed
+    """
+    added = add_missing_columns(session.connection())
+    session.commit()
+    print("Columns added: %s" % (len(added),))
+    print("Contexts updated: %s" % (backfill_stable_keys(session),))
+    print("Indexes created: %s" % (len(create_missing_indexes(session)),))
+
+
+def create_missing_indexes(session):
+    """
+    Creates the indexes of the Snorkel tables (including candidate subclass tables defined in this process) which are
+    missing from the database, e.g. because it was created by an older version of Snorkel. Raises a ValueError if
+    an index is on columns that the tables do not have yet; see upgrade_schema.
+
+    :param session: the session to create the indexes with; it is committed
+    :return: the names of the created indexes
+    """
+    conn = session.connection()
+    inspector = inspect(conn)
+    table_names = set(inspector.get_table_names())
+    created = []
+    for table in SnorkelBase.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            missing = [column.name for column in index.columns if column.name not in columns]
+            if missing:
+                raise ValueError("Cannot create the index %s: the table %s has no column %s; run upgrade_schema to "
+                                 "add the missing columns" % (index.name, table.name, ', '.join(missing)))
+            index.create(bind=conn)
+            created.append(index.name)
+    session.commit()
+    return created
+
+
+def _get_document_ids(session, names, chunk_size=1000):
+    """Returns a dict of the ids of the Documents with the given names"""
+    names = list(names)
+    doc_ids = {}
+    for k in range(0, len(names), chunk_size):
+        q = select([Document.name, Document.id]).where(Document.name.in_(names[k:k+chunk_size]))
+        doc_ids.update(session.execute(q).fetchall())
+    return doc_ids
+
 
 def reload_annotator_labels(session, candidate_class, annotator_name, split, filter_label_split=True, create_missing_cands=False):
-    """Reloads stable annotator labels into the AnnotatorLabel table"""
+    """
+    Reloads stable annotator labels into the AnnotatorLabel table.
+
+    The labels' context stable ids are decomposed (see stable_key_columns) into a temporary table, where the labeled
+    Contexts are looked up by their decomposed stable ids; those not found this way, e.g. Contexts inserted before
+    upgrade_schema was run, are then looked up by their string stable ids in a separate update. The table is joined
+    to the candidates to insert the missing GoldLabels with a single INSERT ... SELECT. If several labels resolve to
+    the same candidate, the smallest value is loaded.
+    """
     # Sets up the AnnotatorLabelKey to use
     ak = session.query(GoldLabelKey).filter(GoldLabelKey.name == annotator_name).first()
     if ak is None:
@@ -17,51 +168,103 @@ def reload_annotator_labels(session, candidate_class, annotator_name, split, fil
         session.add(ak)
         session.commit()
 
-    labels = []
-    missed = []
-    sl_query = session.query(StableLabel).filter(StableLabel.annotator_name == annotator_name)
+    sl_query = session.query(StableLabel.context_stable_ids, StableLabel.value)\
+                      .filter(StableLabel.annotator_name == annotator_name)
     sl_query = sl_query.filter(StableLabel.split == split) if filter_label_split else sl_query
-    for sl in sl_query.all():
-        context_stable_ids = sl.context_stable_ids.split('~~')
-
-        # Check for labeled Contexts
-        # TODO: Does not create the Contexts if they do not yet exist!
-        contexts = []
-        for stable_id in context_stable_ids:
-            context = session.query(Context).filter(Context.stable_id == stable_id).first()
-            if context:
-                contexts.append(context)
-        if len(contexts) < len(context_stable_ids):
-            missed.append(sl)
+    stable_labels = [(context_stable_ids.split('~~'), value) for context_stable_ids, value in sl_query.all()]
+
+    # Decompose the stable ids of the labeled Contexts; the keys of malformed stable ids, or of documents which do
+    # not exist, are left empty
+    arg_names = candidate_class.__argnames__
+    doc_names = set()
+    for stable_ids, _ in stable_labels:
+        for stable_id in stable_ids:
+            try:
+                doc_names.add(split_stable_id(stable_id)[0])
+            except ValueError:
+                pass
+    doc_ids = _get_document_ids(session, doc_names)
+    label_rows = []
+    for stable_ids, value in stable_labels:
+        if len(stable_ids) < len(arg_names):
             continue
+        row = {'value': value}
+        for i, stable_id in enumerate(stable_ids[:len(arg_names)]):
+            try:
+                doc_id = doc_ids.get(split_stable_id(stable_id)[0])
+            except ValueError:
+                doc_id = None
+            row['stable_id_%s' % i] = stable_id
+            for k, v in iteritems(stable_key_columns(doc_id, stable_id)):
+                row['%s_%s' % (k, i)] = v
+        label_rows.append(row)
 
-        # Check for Candidate
-        # Assemble candidate arguments
-        candidate_args  = {'split' : split}
-        for i, arg_name in enumerate(candidate_class.__argnames__):
-            candidate_args[arg_name] = contexts[i]
+    label_columns = []
+    for i in range(len(arg_names)):
+        label_columns.append(Column('context_id_%s' % i, Integer))
+        label_columns.append(Column('stable_id_%s' % i, String))
+        label_columns.extend(Column('%s_%s' % (k, i), Integer) for k in STABLE_KEY_COLUMNS)
+    label_table = Table('tmp_stable_label', MetaData(), Column('id', Integer, primary_key=True),
+                        Column('value', Integer), *label_columns, prefixes=['TEMPORARY'])
 
-        # Assemble query and check
-        candidate_query = session.query(candidate_class)
-        for k, v in iteritems(candidate_args):
-            candidate_query = candidate_query.filter(getattr(candidate_class, k) == v)
-        candidate = candidate_query.first()
+    # The table may be left over from a failed call on the same pooled connection
+    conn = session.connection()
+    conn.execute(text("DROP TABLE IF EXISTS tmp_stable_label"))
+    label_table.create(bind=conn)
+    try:
+        if label_rows:
+            session.execute(label_table.insert(), label_rows)
 
-        # Optionally construct missing candidates
-        if candidate is None and create_missing_cands:
-            candidate = candidate_class(**candidate_args)
+        # Look up the Contexts of the labels by their decomposed stable ids, then look up the ones not found by their
+        # string stable ids, so that each lookup can use an index
+        context = Context.__table__
+        context_ids = [getattr(label_table.c, 'context_id_%s' % i) for i in range(len(arg_names))]
+        for i, context_id in enumerate(context_ids):
+            stable_key = and_(*[getattr(context.c, k) == getattr(label_table.c, '%s_%s' % (k, i))
+                                for k in STABLE_KEY_COLUMNS])
+            session.execute(label_table.update()
+                            .where(getattr(label_table.c, 'stable_type_%s' % i).isnot(None))
+                            .values({context_id: select([context.c.id]).where(stable_key).as_scalar()}))
+            stable_id = context.c.stable_id == getattr(label_table.c, 'stable_id_%s' % i)
+            session.execute(label_table.update()
+                            .where(context_id.is_(None))
+                            .values({context_id: select([context.c.id]).where(stable_id).as_scalar()}))
+        candidate_table = candidate_class.__table__
+        candidate_args = and_(*[getattr(candidate_table.c, arg_name + '_id') == context_id
+                                for arg_name, context_id in zip(arg_names, context_ids)])
 
-        # If candidate is none, mark as missed and continue
-        if candidate is None:
-            missed.append(sl)
-            continue
+        # Optionally construct missing candidates
+        if create_missing_cands:
+            q = select(context_ids).where(and_(*[context_id.isnot(None) for context_id in context_ids]))\
+                .where(~exists().where(candidate_args))
+            missing = set(tuple(row) for row in session.execute(q))
+            if missing:
+                candidate_ids = IdAllocator(session, Candidate.__table__).next_ids(len(missing))
+                candidate_type = candidate_class.__mapper__.polymorphic_identity
+                candidate_rows, subclass_rows = [], []
+                for cid, args in zip(candidate_ids, missing):
+                    candidate_rows.append({'id': cid, 'type': candidate_type, 'split': split})
+                    row = {'id': cid}
+                    for arg_name, arg_id in zip(arg_names, args):
+                        row[arg_name + '_id'] = arg_id
+                    subclass_rows.append(row)
+                session.execute(Candidate.__table__.insert(), candidate_rows)
+                session.execute(candidate_table.insert(), subclass_rows)
 
-        # Check for AnnotatorLabel, otherwise create
-        label = session.query(GoldLabel).filter(GoldLabel.key == ak).filter(GoldLabel.candidate == candidate).first()
-        if label is None:
-            label = GoldLabel(candidate=candidate, key=ak, value=sl.value)
-            session.add(label)
-            labels.append(label)
+        # Insert the labels of candidates which do not have one yet
+        gold_label = GoldLabel.__table__
+        joined = label_table.join(candidate_table, candidate_args)\
+                       .join(Candidate.__table__, Candidate.__table__.c.id == candidate_table.c.id)
+        q = select([literal(ak.id), candidate_table.c.id, func.min(label_table.c.value)]).select_from(joined)\
+            .where(Candidate.__table__.c.split == split)\
+            .where(~exists().where(and_(gold_label.c.key_id == ak.id, gold_label.c.candidate_id == candidate_table.c.id)))\
+            .group_by(candidate_table.c.id)
+        n_labels = session.execute(gold_label.insert().from_select(['key_id', 'candidate_id', 'value'], q)).rowcount
+    except Exception:
+        # Dropping the table could fail as well in an aborted transaction, and hide the original error
+        session.rollback()
+        raise
+    label_table.drop(bind=conn)
 
     session.commit()
-    print("AnnotatorLabels created: %s" % (len(labels),))
+    print("AnnotatorLabels created: %s" % (n_labels,))
@@ -7,6 +7,10 @@ from builtins import *
 import os
 import re
 import warnings
+from bisect import bisect_left, bisect_right
+from copy import copy
+
+import numpy as np
 # Travis will not import the PorterStemmer
 if 'CI' not in os.environ:
     try:
@@ -56,6 +60,32 @@ class Matcher(object):
         else:
             raise Exception("%s does not support more than one child Matcher" % self.__name__)
 
+    def _prefilter(self, context, starts, ends):
+        """The internal (non-composed) version of prefilter, for _f"""
+        return None
+
+    def prefilter(self, context, starts, ends):
+        """
+        Given arrays of the (char_start, char_end) offsets of candidate spans in context, returns a boolean mask
+        which is False only for spans that f is guaranteed to reject, or None if no span can be ruled out from its
+        offsets alone. Lets candidate spaces skip materializing candidates that cannot match.
+        """
+        # Only the default (conjunctive) composition of f can be prefiltered generically
+        if type(self).f != Matcher.f:
+            return None
+        mask = self._prefilter(context, starts, ends)
+        if len(self.children) == 1:
+            child_mask = self.children[0].prefilter(context, starts, ends)
+            if mask is None:
+                mask = child_mask
+            elif child_mask is not None:
+                mask = mask & child_mask
+        return mask
+
+    def _f_slice(self, c, start=None, stop=None):
+        """Applies f to the slice c[start:stop] of span candidate c; used by composed matchers on their children"""
+        return self.f(c[start:stop])
+
     def _is_subspan(self, c, span):
         """Tests if candidate c is subspan of span, where span is defined specific to candidate type"""
         return False
@@ -64,19 +94,189 @@ class Matcher(object):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return c
 
+    def _new_seen_spans(self):
+        """Returns an empty container for tracking the spans seen by apply() for longest-match filtering"""
+        return SeenSpans(self)
+
+    def compile(self):
+        """
+        Returns an optimized plan for this matcher tree: every node is replaced by a CompiledMatcher, which
+        memoizes f per span of the current sentence. Shared subtrees are compiled once, so their results are
+        shared too. The original tree is left unchanged, and changes made to it later are picked up by each
+        apply() of the plan.
+
+        A matcher which overrides apply() is returned as is, as the plan would bypass its apply().
+        """
+        if type(self).apply != Matcher.apply:
+            return self
+        return self._compile({})
+
+    def _compile(self, compiled):
+        if id(self) not in compiled:
+            compiled[id(self)] = CompiledMatcher(self, compiled)
+        return compiled[id(self)]
+
     def apply(self, candidates):
         """
         Apply the Matcher to a **generator** of candidates
         Optionally only takes the longest match (NOTE: assumes this is the *first* match)
         """
-        seen_spans = set()
+        seen_spans = self._new_seen_spans()
         for c in candidates:
-            if self.f(c) and (not self.longest_match_only or not any([self._is_subspan(c, s) for s in seen_spans])):
+            if self.f(c) and (not self.longest_match_only or not seen_spans.contains(c)):
                 if self.longest_match_only:
-                    seen_spans.add(self._get_span(c))
+                    seen_spans.add(c)
                 yield c
 
 
+class CompiledMatcher(Matcher):
+    """
+    A node of a compiled matcher plan, as returned by Matcher.compile().
+
+    Wraps a copy of a Matcher whose children have themselves been compiled, and caches the result of f for each
+    span of the current sentence; the cache is reset whenever a candidate from a new sentence is seen, and at each
+    apply(). Candidates without a parent sentence are passed through uncached.
+    """
+    def __init__(self, matcher, compiled=None):
+        self.original      = matcher
+        self.matcher       = copy(matcher)
+        self._memo         = {}
+        self._memo_context = None
+        # Spans of NgramMatchers are keyed by their char offsets, so slices can be looked up before materializing
+        self._offset_keys  = isinstance(matcher, NgramMatcher)
+        self._compile_children(compiled if compiled is not None else {})
+        super(CompiledMatcher, self).__init__(longest_match_only=matcher.longest_match_only)
+
+    def _compile(self, compiled):
+        return self
+
+    def _compile_children(self, compiled):
+        self._children_source = self.original.children
+        self.matcher.children = tuple(child._compile(compiled) for child in self.original.children)
+
+    def _refresh(self, refreshed):
+        """Copies the current attributes of the original matchers into the plan, and clears the memos"""
+        if id(self) in refreshed:
+            return
+        refreshed.add(id(self))
+        if self.original.children is not self._children_source:
+            self._compile_children({})
+        children = self.matcher.children
+        self.matcher.__dict__.update(self.original.__dict__)
+        self.matcher.children   = children
+        self.longest_match_only = self.original.longest_match_only
+        self._memo.clear()
+        self._memo_context = None
+        for child in children:
+            if isinstance(child, CompiledMatcher):
+                child._refresh(refreshed)
+
+    def refresh(self):
+        """Picks up the changes made to the original matchers since the plan was compiled, and clears the memos"""
+        self._refresh(set())
+
+    def apply(self, candidates, refresh=True):
+        """
+        :param refresh: If False, the plan is not refreshed first; for callers which already called refresh(),
+                        e.g. before prefiltering the candidates.
+        """
+        if refresh:
+            self.refresh()
+        return super(CompiledMatcher, self).apply(candidates)
+
+    def _get_memo(self, context):
+        if context is not self._memo_context:
+            self._memo.clear()
+            self._memo_context = context
+        return self._memo
+
+    def f(self, c):
+        context = getattr(c, 'sentence', None)
+        if context is None:
+            return self.matcher.f(c)
+        memo = self._get_memo(context)
+        key  = self.matcher._get_span(c)
+        try:
+            return memo[key]
+        except KeyError:
+            result = memo[key] = self.matcher.f(c)
+            return result
+
+    def _f_slice(self, c, start=None, stop=None):
+        context = getattr(c, 'sentence', None)
+        if context is None or not self._offset_keys:
+            return self.f(c[start:stop])
+        memo = self._get_memo(context)
+        key  = c.get_slice_char_offsets(start, stop)
+        try:
+            return memo[key]
+        except KeyError:
+            result = memo[key] = self.matcher.f(c._get_instance(char_start=key[0], char_end=key[1], sentence=context))
+            return result
+
+    def prefilter(self, context, starts, ends):
+        return self.matcher.prefilter(context, starts, ends)
+
+    def _is_subspan(self, c, span):
+        return self.matcher._is_subspan(c, span)
+
+    def _get_span(self, c):
+        return self.matcher._get_span(c)
+
+    def _new_seen_spans(self):
+        return self.matcher._new_seen_spans()
+
+
+class SeenSpans(object):
+    """
+    Default set of seen spans used for longest-match filtering in Matcher.apply; tests a candidate
+    against every seen span using the matcher's _is_subspan.
+    """
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.spans   = set()
+
+    def add(self, c):
+        self.spans.add(self.matcher._get_span(c))
+
+    def contains(self, c):
+        """Tests if candidate c is a subspan of any seen span"""
+        return any(self.matcher._is_subspan(c, s) for s in self.spans)
+
+
+class SeenIntervals(object):
+    """
+    Set of seen (char_start, char_end) intervals supporting O(log k) subspan tests.
+
+    Only the maximal intervals are kept (any interval contained in another is dropped), so that when sorted by
+    start they are also sorted by end. The only candidate container of a query span is then the interval with
+    the largest start <= the span start, found by binary search.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends   = []
+
+    def _contains(self, start, end):
+        i = bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def add(self, c):
+        start, end = c.char_start, c.char_end
+        if self._contains(start, end):
+            return
+        # Drop the intervals nested in the new one; these form a contiguous run starting at the insertion point
+        i = bisect_left(self.starts, start)
+        j = i
+        while j < len(self.starts) and self.ends[j] <= end:
+            j += 1
+        self.starts[i:j] = [start]
+        self.ends[i:j]   = [end]
+
+    def contains(self, c):
+        """Tests if candidate c is a subspan of any seen interval"""
+        return self._contains(c.char_start, c.char_end)
+
+
 WORDS = 'words'
 
 class NgramMatcher(Matcher):
@@ -89,6 +289,9 @@ class NgramMatcher(Matcher):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return (c.char_start, c.char_end)
 
+    def _new_seen_spans(self):
+        return SeenIntervals()
+
 
 class DictionaryMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
@@ -109,6 +312,12 @@ class DictionaryMatch(NgramMatcher):
                 self.stemmer = PorterStemmer()
             self.d = frozenset(self._stem(w) for w in list(self.d))
 
+        # Lookup table of the character lengths of the dictionary phrases, for prefiltering candidate spans; the
+        # last entry stands for all lengths longer than the longest phrase
+        max_len = max([len(w) for w in self.d] or [0])
+        self._lengths = np.zeros(max_len + 2, dtype=bool)
+        self._lengths[np.array([len(w) for w in self.d], dtype=np.int64)] = True
+
     def _stem(self, w):
         """Apply stemmer, handling encoding errors"""
         try:
@@ -116,6 +325,18 @@ class DictionaryMatch(NgramMatcher):
         except UnicodeDecodeError:
             return w
 
+    def _prefilter(self, context, starts, ends):
+        # Reject spans whose length matches no phrase; only valid for the lookup of DictionaryMatch._f on the raw
+        # text, when neither stemming nor lowercasing can change the length of the span
+        if type(self)._f != DictionaryMatch._f:
+            return None
+        if self.attrib != WORDS or self.reverse or self.stemmer is not None:
+            return None
+        if self.ignore_case and len(context.text.lower()) != len(context.text):
+            return None
+        lengths = np.maximum(np.minimum(ends + 1, len(context.text)) - starts, 0)
+        return self._lengths[np.minimum(lengths, len(self._lengths) - 1)]
+
     def _f(self, c):
         p = c.get_attrib_span(self.attrib)
         p = p.lower() if self.ignore_case else p
@@ -145,6 +366,15 @@ class Union(NgramMatcher):
                return True
        return False
 
+    def prefilter(self, context, starts, ends):
+        mask = np.zeros(len(starts), dtype=bool)
+        for child in self.children:
+            child_mask = child.prefilter(context, starts, ends)
+            if child_mask is None:
+                return None
+            mask |= child_mask
+        return mask
+
 
 class Concat(NgramMatcher):
     """
@@ -167,16 +397,18 @@ class Concat(NgramMatcher):
             return True
 
         # Iterate over candidate splits **at the word boundaries**
+        span = None if self.ignore_sep else c.get_span()
         for wsplit in range(c.get_word_start()+1, c.get_word_end()+1):
             csplit = c.word_to_char_index(wsplit) - c.char_start  # NOTE the switch to **candidate-relative** char index
 
             # Optionally check for specific separator
-            if self.ignore_sep or c.get_span()[csplit-1] == self.sep:
-                c1 = c[:csplit-len(self.sep)]
-                c2 = c[csplit:]
-                if self.children[0].f(c1) and self.children[1].f(c2):
+            if self.ignore_sep or span[csplit-1] == self.sep:
+                # Children are applied to the slices c[:csplit-len(sep)] and c[csplit:]
+                split1 = csplit - len(self.sep)
+                if self.children[0]._f_slice(c, stop=split1) and self.children[1]._f_slice(c, start=csplit):
                     return True
-                if self.permutations and self.children[1].f(c1) and self.children[0].f(c2):
+                if self.permutations and self.children[1]._f_slice(c, stop=split1) \
+                        and self.children[0]._f_slice(c, start=csplit):
                     return True
         return False
 
@@ -204,16 +436,19 @@ class SlotFillMatch(NgramMatcher):
             raise ValueError("Number of provided matchers (%s) != number of slots (%s)." \
                     % (len(self.children), len(set(self._ops))))
 
+        # Compile the splits pattern once, rather than on every call to f
+        self._rgx = re.compile(r'(.+)'.join(self._splits) + r'$')
+
     def f(self, c):
 
         # First, filter candidates by matching splits pattern
-        m = re.match(r'(.+)'.join(self._splits) + r'$', c.get_attrib_span(self.attrib))
+        m = self._rgx.match(c.get_attrib_span(self.attrib))
         if m is None:
             return False
 
         # Then, recursively apply matchers
         for i,op in enumerate(self._ops):
-            if self.children[op].f(c[m.start(i+1):m.end(i+1)]) == 0:
+            if self.children[op]._f_slice(c, m.start(i+1), m.end(i+1)) == 0:
                 return False
         return True
 
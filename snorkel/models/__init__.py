@@ -28,9 +28,9 @@ For example, the correct way to define a new type of Context is:
 """
 from __future__ import absolute_import
 
-from snorkel.models.meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres
+from snorkel.models.meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres, add_missing_columns
 from snorkel.models.context import Context, Document, Sentence, TemporarySpan, Span, TemporaryDocument
-from snorkel.models.context import construct_stable_id, split_stable_id
+from snorkel.models.context import construct_stable_id, split_stable_id, stable_key_columns
 from snorkel.models.candidate import Candidate, candidate_subclass, Marginal
 from snorkel.models.annotation import (
     Feature, FeatureKey, Label, LabelKey, GoldLabel, GoldLabelKey, StableLabel,
@@ -38,5 +38,7 @@ from snorkel.models.annotation import (
 )
 
 # This call must be performed after all classes that extend SnorkelBase are
-# declared to ensure the storage schema is initialized
+# declared to ensure the storage schema is initialized; tables created by older versions of Snorkel get the
+# columns added since
 SnorkelBase.metadata.create_all(snorkel_engine)
+add_missing_columns(snorkel_engine)
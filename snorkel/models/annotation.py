@@ -4,7 +4,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import *
 
-from sqlalchemy import Column, String, Integer, Float, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship, backref
 
@@ -32,7 +32,7 @@ class AnnotationKeyMixin(object):
 
     @declared_attr
     def group(cls):
-        return Column(Integer, nullable=False, default=0)
+        return Column(Integer, nullable=False, default=0, index=True)
 
     @declared_attr
     def __table_args__(cls):
@@ -102,6 +102,11 @@ class AnnotationMixin(object):
         return relationship('Candidate', backref=backref(camel_to_under(cls.__name__) + 's', cascade='all, delete-orphan', cascade_backrefs=False),
                             cascade_backrefs=False)
 
+    # The primary key leads with key_id; this index serves lookups by candidate
+    @declared_attr
+    def __table_args__(cls):
+        return (Index('ix_%s_candidate_id_key_id' % cls.__tablename__, 'candidate_id', 'key_id'),)
+
     def __repr__(self):
         return self.__class__.__name__ + " (" + str(self.key.name) + " = " + str(self.value) + ")"
 
@@ -201,7 +201,7 @@ class Marginal(SnorkelBase):
     id           = Column(Integer, primary_key=True)
     candidate_id = Column(Integer,
                         ForeignKey('candidate.id', ondelete='CASCADE'), index=True)
-    training     = Column(Boolean, default=True)
+    training     = Column(Boolean, default=True, index=True)
     value        = Column(Integer, nullable=False, default=1)
     probability  = Column(Float, nullable=False, default=0.0)
     candidate    = relationship('Candidate', backref=backref('marginals',
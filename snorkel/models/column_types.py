@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+from future.utils import native_str
+
+import array
+import struct
+import sys
+import numpy as np
+
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+INT32_MIN, INT32_MAX = -2**31, 2**31 - 1
+
+# Typecode of a 4-byte signed integer array
+INT32_TYPECODE = native_str('i' if array.array(native_str('i')).itemsize == 4 else 'l')
+
+
+class IntArray(TypeDecorator):
+    """
+    Stores a list of integers as a buffer of packed little-endian integers, for backends without array types.
+
+    Each list is packed with the narrowest of uint8, uint16 and int32 that fits all of its values, so e.g. dependency
+    parents take one byte per token and sentence-relative character offsets two.
+
+    Values written as pickles (the PickleType format) are still read; the column's storage (a BLOB) is unchanged, so
+    no schema migration is needed, but rows written in this format cannot be read by versions using PickleType.
+
+    :param as_numpy: if True, values are loaded as read-only NumPy arrays (of the stored width) viewing the stored
+        buffer, rather than as lists
+    """
+    impl     = LargeBinary
+    cache_ok = True
+    TAG      = b'I'
+    # Tags, NumPy dtypes and array typecodes of the encodings, from the narrowest
+    ENCODINGS = [
+        (b'B', '<u1', native_str('B'), 0, 2**8 - 1),
+        (b'H', '<u2', native_str('H'), 0, 2**16 - 1),
+        (TAG,  '<i4', INT32_TYPECODE,  INT32_MIN, INT32_MAX),
+    ]
+
+    def __init__(self, as_numpy=False, *args, **kwargs):
+        super(IntArray, self).__init__(*args, **kwargs)
+        self.as_numpy = as_numpy
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        a = np.asarray(value, dtype=np.int64).ravel()
+        lo, hi = (a.min(), a.max()) if a.size > 0 else (0, 0)
+        for tag, dtype, _, min_value, max_value in self.ENCODINGS:
+            if min_value <= lo and hi <= max_value:
+                return tag + a.astype(dtype).tobytes()
+        raise ValueError("IntArray values must fit in 32 bits.")
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        tag = value[:1]
+        for t, dtype, typecode, _, _ in self.ENCODINGS:
+            if tag == t:
+                break
+        else:
+            return pickle.loads(value)
+        if self.as_numpy:
+            return np.frombuffer(value, dtype=dtype, offset=1)
+        a = array.array(typecode, value[1:])
+        if sys.byteorder == 'big' and a.itemsize > 1:
+            a.byteswap()
+        return a.tolist()
+
+
+class StringArray(TypeDecorator):
+    """
+    Stores a list of strings as one UTF-8 blob, for backends without array types.
+
+    Lists of strings without NUL characters are stored with each string NUL-terminated, so they are loaded with a
+    single decode and split. Other lists (containing None or NUL) are length-prefixed: the number of strings and the
+    byte length of each (-1 for None) as little-endian int32s, followed by the encoded strings. Lists with items
+    which are neither strings nor None (e.g. numbers or bytes) are pickled, as with PickleType.
+
+    Values written as pickles (the PickleType format) are still read, see IntArray.
+    """
+    impl              = LargeBinary
+    cache_ok          = True
+    TAG               = b'S'
+    LENGTH_PREFIX_TAG = b'L'
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not all(s is None or isinstance(s, str) for s in value):
+            return pickle.dumps(value, 2)
+        if all(s is not None and '\x00' not in s for s in value):
+            return self.TAG + ''.join(s + '\x00' for s in value).encode('utf-8')
+        encoded = [None if s is None else s.encode('utf-8') for s in value]
+        lengths = np.array([-1 if e is None else len(e) for e in encoded], dtype='<i4')
+        return b''.join([self.LENGTH_PREFIX_TAG, struct.pack('<i', len(encoded)), lengths.tobytes()] +
+                        [e for e in encoded if e is not None])
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        tag = value[:1]
+        if tag == self.TAG:
+            return value.decode('utf-8')[1:-1].split('\x00') if len(value) > 1 else []
+        if tag != self.LENGTH_PREFIX_TAG:
+            return pickle.loads(value)
+        n = struct.unpack_from('<i', value, 1)[0]
+        pos = 5 + 4 * n
+        strings = []
+        for length in np.frombuffer(value, dtype='<i4', count=n, offset=5).tolist():
+            if length < 0:
+                strings.append(None)
+            else:
+                strings.append(value[pos:pos + length].decode('utf-8'))
+                pos += length
+        return strings
@@ -4,12 +4,16 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import *
 
+from bisect import bisect_left
+
+from snorkel.models.column_types import IntArray, StringArray
 from snorkel.models.meta import SnorkelBase, snorkel_postgres
-from sqlalchemy import Column, String, Integer, Text, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Integer, SmallInteger, Text, ForeignKey, Index, UniqueConstraint, event
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, deferred
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.types import PickleType
-from sqlalchemy.sql import select, text
+from sqlalchemy.sql import and_, or_, select, text
 
 
 class Context(SnorkelBase):
@@ -21,11 +25,21 @@ class Context(SnorkelBase):
     type          = Column(String, nullable=False)
     stable_id     = Column(String, unique=True, nullable=False)
 
+    # The stable id decomposed into integers (see stable_key_columns), so Contexts can be looked up by index probes
+    stable_doc_id = Column(Integer)
+    stable_type   = Column(SmallInteger)
+    stable_start  = Column(Integer)
+    stable_end    = Column(Integer)
+
     __mapper_args__ = {
         'polymorphic_identity': 'context',
         'polymorphic_on': type
     }
 
+    __table_args__ = (
+        Index('ix_context_stable_key', stable_doc_id, stable_type, stable_start, stable_end, unique=True),
+    )
+
     def get_parent(self):
         raise NotImplementedError()
 
@@ -35,6 +49,13 @@ class Context(SnorkelBase):
     def get_sentence_generator(self):
         raise NotImplementedError()
 
+    def _get_document_id(self):
+        """
+        Returns the id of the Document this Context belongs to; Contexts of other types (e.g. user-defined ones)
+        have none, so they keep no decomposed stable id and are looked up by their stable_id string.
+        """
+        return None
+
 
 class Document(Context):
     """
@@ -43,7 +64,8 @@ class Document(Context):
     __tablename__ = 'document'
     id = Column(Integer, ForeignKey('context.id', ondelete='CASCADE'), primary_key=True)
     name = Column(String, unique=True, nullable=False)
-    meta = Column(PickleType)
+    # Only loaded when accessed, as candidates and sentences rarely need it
+    meta = deferred(Column(PickleType))
 
     __mapper_args__ = {
         'polymorphic_identity': 'document',
@@ -55,6 +77,9 @@ class Document(Context):
     def get_children(self):
         return self.sentences
 
+    def _get_document_id(self):
+        return self.id
+
     def get_sentence_generator(self):
         for sentence in self.sentences:
             yield sentence
@@ -83,16 +108,16 @@ class Sentence(Context):
         entity_cids       = Column(postgresql.ARRAY(String))
         entity_types      = Column(postgresql.ARRAY(String))
     else:
-        words             = Column(PickleType, nullable=False)
-        char_offsets      = Column(PickleType, nullable=False)
-        abs_char_offsets  = Column(PickleType, nullable=False)
-        lemmas            = Column(PickleType)
-        pos_tags          = Column(PickleType)
-        ner_tags          = Column(PickleType)
-        dep_parents       = Column(PickleType)
-        dep_labels        = Column(PickleType)
-        entity_cids       = Column(PickleType)
-        entity_types      = Column(PickleType)
+        words             = Column(StringArray, nullable=False)
+        char_offsets      = Column(IntArray, nullable=False)
+        abs_char_offsets  = Column(IntArray, nullable=False)
+        lemmas            = Column(StringArray)
+        pos_tags          = Column(StringArray)
+        ner_tags          = Column(StringArray)
+        dep_parents       = Column(IntArray)
+        dep_labels        = Column(StringArray)
+        entity_cids       = Column(StringArray)
+        entity_types      = Column(StringArray)
 
     __mapper_args__ = {
         'polymorphic_identity': 'sentence',
@@ -108,6 +133,9 @@ class Sentence(Context):
     def get_children(self):
         return self.spans
 
+    def _get_document_id(self):
+        return self.document_id if self.document_id is not None else self.document.id
+
     def _asdict(self):
         return {
             'id': self.id,
@@ -143,18 +171,34 @@ class TemporaryContext(object):
 
     A TemporaryContext must have specified equality / set membership semantics, a stable_id for checking
     uniqueness against the database, and a promote() method which returns a corresponding Context object.
+
+    TemporaryContexts are created in very large numbers, so subclasses declare __slots__ rather than carrying
+    a per-instance __dict__.
     """
+    __slots__ = ('id',)
+
     def __init__(self):
         self.id = None
 
     def load_id_or_insert(self, session):
         if self.id is None:
             stable_id = self.get_stable_id()
-            id = session.execute(select([Context.id]).where(Context.stable_id == stable_id)).first()
+            key = self.get_stable_key()
+            if key['stable_type'] is not None:
+                # Contexts inserted before the decomposed stable id columns were added (see
+                # snorkel.db_helpers.upgrade_schema) are still matched on the string stable id
+                q = select([Context.id]).where(or_(
+                    and_(Context.stable_doc_id == key['stable_doc_id'], Context.stable_type == key['stable_type'],
+                         Context.stable_start == key['stable_start'], Context.stable_end == key['stable_end']),
+                    and_(Context.stable_type.is_(None), Context.stable_id == stable_id)
+                ))
+            else:
+                q = select([Context.id]).where(Context.stable_id == stable_id)
+            id = session.execute(q).first()
             if id is None:
-                self.id = session.execute(
-                        Context.__table__.insert(),
-                        {'type': self._get_table_name(), 'stable_id': stable_id}).inserted_primary_key[0]
+                row = {'type': self._get_table_name(), 'stable_id': stable_id}
+                row.update(key)
+                self.id = session.execute(Context.__table__.insert(), row).inserted_primary_key[0]
                 insert_args = self._get_insert_args()
                 insert_args['id'] = self.id
                 session.execute(text(self._get_insert_query()), insert_args)
@@ -176,6 +220,13 @@ class TemporaryContext(object):
     def get_stable_id(self):
         raise NotImplementedError()
 
+    def get_stable_key(self):
+        """Returns the values of the decomposed stable id columns of the Context"""
+        return stable_key_columns(self._get_document_id(), self.get_stable_id())
+
+    def _get_document_id(self):
+        raise NotImplementedError()
+
     def _get_table_name(self):
         raise NotImplementedError()
 
@@ -190,7 +241,8 @@ class TemporaryDocument(TemporaryContext):
     """
     TemporaryContext to hold the entire document.
     """
-    
+    __slots__ = ('document', 'name', 'meta')
+
     def __init__(self, document):
         super(TemporaryDocument, self).__init__()
         self.document = document
@@ -210,6 +262,12 @@ class TemporaryDocument(TemporaryContext):
     
     def get_stable_id(self):
         return self.document.id
+
+    def get_stable_key(self):
+        return stable_key_columns(self.document.id, self.document.stable_id)
+
+    def _get_document_id(self):
+        return self.document.id
     
     def _get_table_name(self):
         return 'document'
@@ -229,6 +287,8 @@ class TemporaryDocument(TemporaryContext):
 
 class TemporarySpan(TemporaryContext):
     """The TemporaryContext version of Span"""
+    __slots__ = ('sentence', 'char_start', 'char_end', 'meta')
+
     def __init__(self, sentence, char_start, char_end, meta=None):
         super(TemporarySpan, self).__init__()
         self.sentence     = sentence  # The sentence Context of the Span
@@ -254,11 +314,14 @@ class TemporarySpan(TemporaryContext):
             return True
 
     def __hash__(self):
-        return hash(self.sentence) + hash(self.char_start) + hash(self.char_end)
+        return hash((self.sentence, self.char_start, self.char_end))
 
     def get_stable_id(self):
         return construct_stable_id(self.sentence, self._get_polymorphic_identity(), self.char_start, self.char_end)
 
+    def _get_document_id(self):
+        return self.sentence.document_id
+
     def _get_table_name(self):
         return 'span'
 
@@ -288,13 +351,14 @@ class TemporarySpan(TemporaryContext):
 
     def char_to_word_index(self, ci):
         """Given a character-level index (offset), return the index of the **word this char is in**"""
-        i = None
-        for i, co in enumerate(self.sentence.char_offsets):
-            if ci == co:
-                return i
-            elif ci < co:
-                return i-1
-        return i
+        offsets = self.sentence.char_offsets
+        if not offsets:
+            return None
+        # Binary search over the (sorted) token start offsets
+        i = bisect_left(offsets, ci)
+        if i < len(offsets) and offsets[i] == ci:
+            return i
+        return i - 1
 
     def word_to_char_index(self, wi):
         """Given a word-level index, return the character-level index (offset) of the word's start"""
@@ -319,19 +383,27 @@ class TemporarySpan(TemporaryContext):
         return self.sentence == other_span.sentence and other_span.char_start >= self.char_start \
             and other_span.char_end <= self.char_end
 
+    def get_slice_char_offsets(self, start=None, stop=None):
+        """
+        Return the (char_start, char_end) offsets, relative to the sentence, of the slice [start:stop] of this span,
+        without constructing the sliced span
+        """
+        char_start = self.char_start if start is None else self.char_start + start
+        if stop is None:
+            char_end = self.char_end
+        elif stop >= 0:
+            char_end = self.char_start + stop - 1
+        else:
+            char_end = self.char_end + stop
+        return char_start, char_end
+
     def __getitem__(self, key):
         """
         Slice operation returns a new candidate sliced according to **char index**
         Note that the slicing is w.r.t. the candidate range (not the abs. sentence char indexing)
         """
         if isinstance(key, slice):
-            char_start = self.char_start if key.start is None else self.char_start + key.start
-            if key.stop is None:
-                char_end = self.char_end
-            elif key.stop >= 0:
-                char_end = self.char_start + key.stop - 1
-            else:
-                char_end = self.char_end + key.stop
+            char_start, char_end = self.get_slice_char_offsets(key.start, key.stop)
             return self._get_instance(char_start=char_start, char_end=char_end, sentence=self.sentence)
         else:
             raise NotImplementedError()
@@ -378,6 +450,9 @@ class Span(Context, TemporarySpan):
     def _get_instance(self, **kwargs):
         return Span(**kwargs)
 
+    # Context's default would otherwise take precedence over the one inherited from TemporarySpan
+    _get_document_id = TemporarySpan._get_document_id
+
     # We redefine these to use default semantics, overriding the operators inherited from TemporarySpan
     def __eq__(self, other):
         return self is other
@@ -411,3 +486,47 @@ def construct_stable_id(parent_context, polymorphic_type, relative_char_offset_s
     start = parent_doc_char_start + relative_char_offset_start
     end   = parent_doc_char_start + relative_char_offset_end
     return "%s::%s:%s:%s" % (doc_id, polymorphic_type, start, end)
+
+
+# Integer codes of the Context types in the stable_type column
+STABLE_TYPE_CODES = {'document': 0, 'sentence': 1, 'span': 2}
+
+
+def stable_key_columns(document_id, stable_id):
+    """
+    Decompose a stable id into the values of the indexed integer columns of the context table: the id of the
+    Context's document, the code of its type, and its character offsets relative to the document start.
+
+    All values are None for stable ids which are malformed or of a type without a code, or if the document id
+    is not known.
+    """
+    key = {'stable_doc_id': None, 'stable_type': None, 'stable_start': None, 'stable_end': None}
+    try:
+        _, polymorphic_type, start, end = split_stable_id(stable_id)
+    except (ValueError, AttributeError):
+        return key
+    if document_id is not None and polymorphic_type in STABLE_TYPE_CODES:
+        key['stable_doc_id'] = document_id
+        key['stable_type']   = STABLE_TYPE_CODES[polymorphic_type]
+        key['stable_start']  = start
+        key['stable_end']    = end
+    return key
+
+
+@event.listens_for(Context, 'before_insert', propagate=True)
+def _set_stable_key(mapper, connection, target):
+    """Fills in the decomposed stable id of Contexts added through the ORM"""
+    if target.stable_type is None and not (isinstance(target, Document) and target.id is None):
+        for k, v in stable_key_columns(target._get_document_id(), target.stable_id).items():
+            setattr(target, k, v)
+
+
+@event.listens_for(Document, 'after_insert')
+def _set_document_stable_key(mapper, connection, target):
+    """Documents inserted without an explicit id only get their decomposed stable id once it is assigned"""
+    if target.stable_type is None:
+        key = stable_key_columns(target.id, target.stable_id)
+        if key['stable_type'] is not None:
+            connection.execute(Context.__table__.update().where(Context.id == target.id), key)
+            for k, v in key.items():
+                set_committed_value(target, k, v)
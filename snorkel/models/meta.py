@@ -4,10 +4,12 @@ from __future__ import print_function
 from builtins import *
 
 import os
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, exc, inspect
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import text
 
 # Sets connection string
 snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and os.environ['SNORKELDB'] != '' \
@@ -18,29 +20,102 @@ snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and o
 snorkel_postgres = snorkel_conn_string.startswith('postgres')
 
 
-# Automatically turns on foreign key enforcement for SQLite
+# Opt-in SQLite performance profile, enabled by setting SNORKEL_SQLITE_PERFORMANCE=1: write-ahead logging (so
+# readers do not block the writer) with fewer fsyncs, a 256MB page cache, memory-mapped reads of up to 1GB and
+# in-memory temporary tables. A transaction committed just before a power loss (not an application crash) may
+# be lost, but the database is never corrupted.
+snorkel_sqlite_performance = os.environ.get('SNORKEL_SQLITE_PERFORMANCE', '') not in ('', '0')
+
+SQLITE_PERFORMANCE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA mmap_size=1073741824",
+    "PRAGMA temp_store=MEMORY",
+]
+
+
+# Automatically turns on foreign key enforcement for SQLite, and the performance profile if enabled
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     if snorkel_conn_string.startswith('sqlite'):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON")
+        if snorkel_sqlite_performance:
+            for pragma in SQLITE_PERFORMANCE_PRAGMAS:
+                cursor.execute(pragma)
         cursor.close()
 
 
-# Defines procedure for setting up a sessionmaker
-def new_sessionmaker():
-    
+# Size of the connection pool each engine keeps open for reuse; more connections are opened (and closed when
+# returned) when needed, as sessions are not always closed
+SNORKEL_POOL_SIZE = int(os.environ.get('SNORKEL_POOL_SIZE', 5))
+
+# The engines of this process, by connection string, and the id of the process they were created in
+_engines = {}
+_engines_pid = None
+
+
+def _create_engine(conn_string):
     # Turning on autocommit for Postgres, see http://oddbird.net/2014/06/14/sqlalchemy-postgres-autocommit/
     # Otherwise any e.g. query starts a transaction, locking tables... very bad for e.g. multiple notebooks
     # open, multiple processes, etc.
-    if snorkel_postgres:
-        snorkel_engine = create_engine(snorkel_conn_string, isolation_level="AUTOCOMMIT")
+    if conn_string.startswith('postgres'):
+        engine = create_engine(conn_string, isolation_level="AUTOCOMMIT", pool_size=SNORKEL_POOL_SIZE,
+                               max_overflow=-1, pool_pre_ping=True)
+    elif conn_string.startswith('sqlite') and ':memory:' not in conn_string and conn_string.rstrip('/') != 'sqlite:':
+        # Pool connections to SQLite files too, rather than opening one per checkout (the default); connections are
+        # only ever used by one thread at a time
+        engine = create_engine(conn_string, poolclass=QueuePool, pool_size=SNORKEL_POOL_SIZE, max_overflow=-1,
+                               connect_args={'check_same_thread': False})
     else:
-        snorkel_engine = create_engine(snorkel_conn_string)
+        engine = create_engine(conn_string)
+
+    # Guard against using a connection opened by another process: a pooled connection inherited through a fork is
+    # dropped (without closing it, which would close it for the parent too) and replaced by a new one
+    # See http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError("Connection belongs to pid %s, attempting to check out in pid %s" %
+                                         (connection_record.info['pid'], os.getpid()))
+    return engine
 
-    # New sessionmaker
-    SnorkelSession = sessionmaker(bind=snorkel_engine)
-    return SnorkelSession
+
+def dispose_inherited_engines():
+    """
+    Gives the engines of this process new, empty connection pools if they were created in another (parent)
+    process, so that connections opened before a fork are never shared. The inherited connections are left open,
+    as closing them would close them in the parent as well.
+    """
+    global _engines_pid
+    if _engines_pid != os.getpid():
+        for engine in _engines.values():
+            engine.pool = engine.pool.recreate()
+        _engines_pid = os.getpid()
+
+
+def get_engine(conn_string=None):
+    """
+    Returns the engine of this process for a connection string (by default, the Snorkel database), creating it on
+    first use, so that all sessions and UDFs share its connection pool.
+    """
+    conn_string = conn_string or snorkel_conn_string
+    dispose_inherited_engines()
+    if conn_string not in _engines:
+        _engines[conn_string] = _create_engine(conn_string)
+    return _engines[conn_string]
+
+
+# Defines procedure for setting up a sessionmaker
+def new_sessionmaker():
+    """Returns a sessionmaker bound to the shared engine of the Snorkel database"""
+    return sessionmaker(bind=get_engine())
 
 
 # We initialize the engine within the models module because models' schema can depend on
@@ -49,3 +124,34 @@ SnorkelSession = new_sessionmaker()
 snorkel_engine = SnorkelSession.kw['bind']
 
 SnorkelBase = declarative_base(name='SnorkelBase', cls=object)
+
+
+def add_missing_columns(bind):
+    """
+    Adds the columns of the Snorkel tables which are missing from the database, e.g. because it was created by an
+    older version of Snorkel. The added columns are empty (NULL) until filled in, see
+    snorkel.db_helpers.upgrade_schema.
+
+    :param bind: the engine or connection to alter the tables with
+    :return: the names of the added columns, as <table>.<column>
+    """
+    inspector = inspect(bind)
+    table_names = set(inspector.get_table_names())
+    preparer = bind.dialect.identifier_preparer
+    added = []
+    for table in SnorkelBase.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            name = '%s.%s' % (table.name, column.name)
+            if not column.nullable:
+                raise ValueError("Cannot add the NOT NULL column %s to the existing table %s; recreate the database "
+                                 "with this version of Snorkel" % (name, table.name))
+            bind.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (
+                preparer.format_table(table), preparer.format_column(column),
+                column.type.compile(dialect=bind.dialect))))
+            added.append(name)
+    return added
@@ -4,48 +4,100 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import *
 
-def create_serialized_candidate_view(session, C, verbose=False):
+from sqlalchemy import inspect
+from sqlalchemy.sql import select, text
+
+from snorkel.models.candidate import Candidate
+from snorkel.models.context import Sentence, Span
+
+
+def get_serialized_candidate_view_name(C):
+    return C.__tablename__ + '_serialized'
+
+
+def get_serialized_candidate_query(C):
+    """
+    Returns a select of the serialized rows of a Candidate sub-class C defined over Span contexts, which are direct
+    children of a single sentence, with schema:
+        id, split, <arg0>_cid, <arg0>_<span column>, ..., <argK>_cid, <argK>_<span column>, sentence_<column>
+
+    The columns are in the order of the span and sentence table columns, so rows can also be read by position.
+    """
+    candidate, subclass, sentence = Candidate.__table__, C.__table__, Sentence.__table__
+    spans = [Span.__table__.alias('span%s' % i) for i in range(len(C.__argnames__))]
+
+    columns = [candidate.c.id, candidate.c.split]
+    joined = candidate.join(subclass, subclass.c.id == candidate.c.id)
+    for arg, span in zip(C.__argnames__, spans):
+        columns.append(getattr(subclass.c, arg + '_cid'))
+        columns.extend(column.label('%s_%s' % (arg, column.name)) for column in span.columns)
+        joined = joined.join(span, span.c.id == getattr(subclass.c, arg + '_id'))
+    columns.extend(column.label('sentence_' + column.name) for column in sentence.columns)
+    joined = joined.join(sentence, sentence.c.id == spans[0].c.sentence_id)
+    return select(columns).select_from(joined)
+
+
+def create_serialized_candidate_view(session, C, verbose=False, materialized=False):
     """Creates a view in the database for a Candidate sub-class C defined over
-    Span contexts, which are direct children of a single sentence.
+    Span contexts, which are direct children of a single sentence, with one row
+    per candidate (see get_serialized_candidate_query). Does nothing if the view
+    already exists.
 
-    Creates VIEW with schema:
-        candidate.id, candidate.split, span0.*, ..., spanK.*, sentence.*
+    If materialized is True, the rows are stored, so readers do not join the
+    candidate, span and sentence tables at query time, and indexed by candidate
+    id and split: as a materialized view on Postgres, and as a table on other
+    backends. Call refresh_serialized_candidate_view after the candidates or
+    their contexts change.
 
     NOTE: This limited functionality should be expanded for arbitrary context
-    trees. Also this should be made more dialect-independent.
+    trees.
     """
-    selects, froms, joins = [], [], []
-    for i, arg in enumerate(C.__argnames__):
-        # Select the context CID
-        selects.append("{0}.{1}_cid".format(C.__tablename__, arg))
-        # Then all of its span columns
-        selects.append("span{0}.*".format(i))
-        froms.append("span AS span{0}".format(i))
-        joins.append("{0}.{1}_id = span{2}.id".format(C.__tablename__, arg, i))
-
-    sql = """
-    CREATE VIEW IF NOT EXISTS {0}_serialized AS
-        SELECT
-            candidate.id,
-            candidate.split,
-            {1},
-            sentence.*
-        FROM
-            candidate,
-            {0},
-            {2},
-            sentence
-        WHERE
-            candidate.id = {0}.id
-            AND sentence.id = span0.sentence_id
-            AND {3}
-    """.format(
-        C.__tablename__,
-        ", ".join(selects),
-        ", ".join(froms),
-        " AND ".join(joins)
-    )
+    name = get_serialized_candidate_view_name(C)
+    conn = session.connection()
+    inspector = inspect(conn)
+    if name in inspector.get_view_names() or name in inspector.get_table_names() or \
+            name in _get_materialized_view_names(conn):
+        return
+
+    query = _compile(conn, get_serialized_candidate_query(C))
+    if not materialized:
+        sql = "CREATE VIEW {0} AS {1}".format(name, query)
+    elif conn.dialect.name == 'postgresql':
+        sql = "CREATE MATERIALIZED VIEW {0} AS {1}".format(name, query)
+    else:
+        sql = "CREATE TABLE {0} AS {1}".format(name, query)
     if verbose:
         print("Creating view...")
         print(sql)
-    session.execute(sql)
\ No newline at end of file
+    session.execute(text(sql))
+
+    if materialized:
+        session.execute(text("CREATE UNIQUE INDEX ix_{0}_id ON {0} (id)".format(name)))
+        session.execute(text("CREATE INDEX ix_{0}_split ON {0} (split)".format(name)))
+    session.commit()
+
+
+def refresh_serialized_candidate_view(session, C):
+    """
+    Recomputes the rows of a materialized serialized candidate view created by
+    create_serialized_candidate_view; does nothing for a plain view.
+    """
+    name = get_serialized_candidate_view_name(C)
+    conn = session.connection()
+    if name in _get_materialized_view_names(conn):
+        session.execute(text("REFRESH MATERIALIZED VIEW {0}".format(name)))
+    elif name in inspect(conn).get_table_names():
+        session.execute(text("DELETE FROM {0}".format(name)))
+        session.execute(text("INSERT INTO {0} {1}".format(name, _compile(conn, get_serialized_candidate_query(C)))))
+    session.commit()
+
+
+def _compile(conn, query):
+    return str(query.compile(dialect=conn.dialect))
+
+
+def _get_materialized_view_names(conn):
+    if conn.dialect.name != 'postgresql':
+        return []
+    q = text("SELECT matviewname FROM pg_matviews WHERE schemaname = current_schema()")
+    return [row[0] for row in conn.execute(q)]
@@ -3,6 +3,13 @@ from __future__ import absolute_import
 from snorkel.parser.corenlp import *
 from snorkel.parser.corpus_parser import *
 from snorkel.parser.doc_preprocessors import *
+from snorkel.parser.parse_cache import *
 from snorkel.parser.parser import *
-from snorkel.parser.spacy_parser import *
+from snorkel.parser.regex_parser import *
 from snorkel.parser.rule_parser import *
+
+# spaCy is optional, e.g. for RegexParser or CoreNLP users
+try:
+    from snorkel.parser.spacy_parser import *
+except ImportError:
+    pass
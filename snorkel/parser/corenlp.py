@@ -7,6 +7,7 @@ from builtins import *
 from future.utils import iteritems
 
 import os
+import re
 import sys
 import json
 import signal
@@ -15,7 +16,8 @@ import string
 import warnings
 
 from subprocess import Popen,PIPE
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from snorkel.parser.parser import Parser, URLParserConnection
 from snorkel.models import Candidate, Context, Document, Sentence, construct_stable_id
@@ -56,9 +58,13 @@ class StanfordCoreNLPServer(Parser):
     # CoreNLP changed some JSON element names across versions
     BLOCK_DEFS = {"3.6.0":"basic-dependencies", "3.7.0":"basicDependencies"}
 
+    # Safe split points for long documents, in order of preference
+    CHUNK_BOUNDARIES = [re.compile(r'\n[ \t\r\f\v]*\n\s*'), re.compile(r'(?<=[.!?])\s+'), re.compile(r'\s+')]
+
     def __init__(self, annotators=['tokenize', 'ssplit', 'pos', 'lemma', 'depparse', 'ner'],
                  annotator_opts={}, tokenize_whitespace=False, split_newline=False, encoding="utf-8",
-                 java_xmx='4g', port=12345, num_threads=1, verbose=False, version='3.6.0'):
+                 java_xmx='4g', port=12345, num_threads=1, verbose=False, version='3.6.0',
+                 max_in_flight=None, max_chunk_size=50000):
         '''
         Create CoreNLP server instance.
         :param annotators:
@@ -70,6 +76,11 @@ class StanfordCoreNLPServer(Parser):
         :param num_threads:
         :param verbose:
         :param version:
+        :param max_in_flight: max number of concurrent requests each connection
+                              keeps open when parsing a batch; defaults to num_threads
+        :param max_chunk_size: documents longer than this many characters are split at
+                               paragraph/sentence boundaries and parsed in chunks
+                               (the server rejects requests over 100K characters)
         '''
         super(StanfordCoreNLPServer, self).__init__(name="CoreNLP", encoding=encoding)
 
@@ -84,6 +95,8 @@ class StanfordCoreNLPServer(Parser):
         self.num_threads = num_threads
         self.verbose = verbose
         self.version = version
+        self.max_in_flight = max_in_flight or num_threads
+        self.max_chunk_size = max_chunk_size
 
         # configure connection request options
         opts = self._conn_opts(annotators, annotator_opts, tokenize_whitespace, split_newline)
@@ -177,6 +190,8 @@ class StanfordCoreNLPServer(Parser):
         print("port:", self.port)
         print("timeout:", self.timeout)
         print("threads:", self.num_threads)
+        print("max in flight:", self.max_in_flight)
+        print("max chunk size:", self.max_chunk_size)
         print("-" * 40)
 
     def connect(self):
@@ -184,7 +199,14 @@ class StanfordCoreNLPServer(Parser):
         Return URL connection object for this server
         :return:
         '''
-        return URLParserConnection(self)
+        return URLParserConnection(self, pool_maxsize=max(10, self.max_in_flight))
+
+    def get_config(self):
+        '''
+        Parser name, version and the server properties used for requests
+        :return:
+        '''
+        return "{}:{}:{}:{}".format(self.name, self.version, self.endpoint.split('?', 1)[-1], self.max_chunk_size)
 
     def close(self):
         '''
@@ -212,6 +234,121 @@ class StanfordCoreNLPServer(Parser):
             sys.stderr.write("Warning, empty document {0} passed to CoreNLP".format(document.name if document else "?"))
             return
 
+        chunks = self.split_text(text)
+        if len(chunks) == 1 or self.max_in_flight < 2:
+            responses = ((offset, self.request(chunk, conn)) for offset, chunk in chunks)
+            for parts in self._parse_chunks(document, responses):
+                yield parts
+            return
+
+        # Submit the chunks of a long document in parallel
+        pool = ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(chunks)))
+        try:
+            futures = [(offset, pool.submit(self.request, chunk, conn)) for offset, chunk in chunks]
+            for parts in self._parse_chunks(document, ((offset, f.result()) for offset, f in futures)):
+                yield parts
+        finally:
+            pool.shutdown(wait=False)
+
+    def parse_batch(self, batch, conn=None, **kwargs):
+        '''
+        Parse a batch of (document, text) pairs, keeping up to max_in_flight
+        requests open against the server at a time. Long documents are split
+        into chunks, which count as separate requests. Parts are yielded in
+        document order.
+
+        :param batch: list of (document, text) pairs
+        :param conn: server connection, shared by the request threads
+        :return:
+        '''
+        if self.max_in_flight < 2:
+            for document, text in batch:
+                for parts in self.parse(document, text, conn):
+                    yield parts
+            return
+
+        pool = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            pending, in_flight = deque(), 0
+            for document, text in batch:
+                futures = None
+                if len(text.strip()) > 0:
+                    futures = [(offset, pool.submit(self.request, chunk, conn))
+                               for offset, chunk in self.split_text(text)]
+                    in_flight += len(futures)
+                pending.append((document, text, futures))
+                while in_flight >= self.max_in_flight:
+                    in_flight -= len(pending[0][2] or [])
+                    for parts in self._parse_pending(pending.popleft(), conn):
+                        yield parts
+            while pending:
+                for parts in self._parse_pending(pending.popleft(), conn):
+                    yield parts
+        finally:
+            pool.shutdown(wait=False)
+
+    def _parse_pending(self, pending, conn):
+        '''
+        Wait for the response of an in-flight request and parse it
+        :param pending: (document, text, futures) triple, where futures holds an
+                        (offset, future) pair per chunk and is None for empty texts
+        :param conn:
+        :return:
+        '''
+        document, text, futures = pending
+        if futures is None:
+            return self.parse(document, text, conn)
+        return self._parse_chunks(document, ((offset, f.result()) for offset, f in futures))
+
+    def _parse_chunks(self, document, responses):
+        '''
+        Parse the responses for the chunks of a document, stitching sentence
+        positions back together in document order
+        :param document:
+        :param responses: (char offset of chunk, decoded server response) pairs
+        :return:
+        '''
+        position = 0
+        for offset, content in responses:
+            for parts in self.parse_response(document, content, offset=offset, position=position):
+                position = parts['position'] + 1
+                yield parts
+
+    def split_text(self, text):
+        '''
+        Split a text into chunks of at most max_chunk_size characters, cutting at
+        paragraph breaks, then sentence ends, then whitespace where possible.
+        Chunks that contain only whitespace are dropped.
+
+        :param text:
+        :return: list of (char offset, chunk) pairs
+        '''
+        max_size = self.max_chunk_size
+        if not max_size or len(text) <= max_size:
+            return [(0, text)]
+
+        chunks, start = [], 0
+        while len(text) - start > max_size:
+            window = text[start:start + max_size]
+            end = max_size
+            for rgx in StanfordCoreNLPServer.CHUNK_BOUNDARIES:
+                # cut at the last boundary, unless it leaves a chunk under half size
+                cuts = [m.end() for m in rgx.finditer(window) if m.end() >= max_size // 2]
+                if cuts:
+                    end = cuts[-1]
+                    break
+            chunks.append((start, text[start:start + end]))
+            start += end
+        chunks.append((start, text[start:]))
+        return [(offset, chunk) for offset, chunk in chunks if len(chunk.strip()) > 0]
+
+    def request(self, text, conn):
+        '''
+        POST a text to the CoreNLP server, returning the decoded response
+        :param text:
+        :param conn: server connection
+        :return:
+        '''
         # handle encoding (force to unicode)
         if isinstance(text, str):
             text = text.encode('utf-8', 'error')
@@ -219,12 +356,21 @@ class StanfordCoreNLPServer(Parser):
         # POST request to CoreNLP Server
         try:
             content = conn.post(self.endpoint, text)
-            content = content.decode(self.encoding)
+            return content.decode(self.encoding)
 
         except socket.error as e:
             sys.stderr.write("Socket error")
             raise ValueError("Socket Error")
 
+    def parse_response(self, document, content, offset=0, position=0):
+        '''
+        Parse the CoreNLP JSON response for a document into sentence parts
+        :param document:
+        :param content: decoded server response
+        :param offset: char offset of the parsed text (chunk) within the document
+        :param position: position of the first sentence within the document
+        :return:
+        '''
         # check for parsing error messages
         StanfordCoreNLPServer.validate_response(content)
 
@@ -233,7 +379,6 @@ class StanfordCoreNLPServer(Parser):
         except:
             warnings.warn("CoreNLP skipped a malformed document.", RuntimeWarning)
 
-        position = 0
         for block in blocks:
             parts = defaultdict(list)
             dep_order, dep_par, dep_lab = [], [], []
@@ -261,8 +406,9 @@ class StanfordCoreNLPServer(Parser):
 
             # make char_offsets relative to start of sentence
             abs_sent_offset = parts['char_offsets'][0]
+            parts['abs_char_offsets'] = [p + offset for p in parts['char_offsets']]
             parts['char_offsets'] = [p - abs_sent_offset for p in parts['char_offsets']]
-            parts['abs_char_offsets'] = [p for p in parts['char_offsets']]
+            abs_sent_offset += offset
             parts['dep_parents'] = sort_X_on_Y(dep_par, dep_order)
             parts['dep_labels'] = sort_X_on_Y(dep_lab, dep_order)
             parts['position'] = position
@@ -4,18 +4,113 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import *
 
-from snorkel.parser.spacy_parser import Spacy
-from snorkel.models import Candidate, Context, Sentence
+import os
+
+from collections import defaultdict
+from itertools import islice
+from sqlalchemy.sql import exists, select
+
+from snorkel.db_helpers import IdAllocator
+from snorkel.parser.parse_cache import ParseCache
+from snorkel.models import Candidate, Context, Document, Sentence, stable_key_columns
 from snorkel.udf import UDF, UDFRunner
 
 
 class CorpusParser(UDFRunner):
 
-    def __init__(self, parser=None, fn=None):
-        self.parser = parser or Spacy()
+    def __init__(self, parser=None, fn=None, cache_dir=None):
+        """
+        :param parser: Parser to apply; defaults to Spacy
+        :param fn: Optional function applied to each sentence's parts dict
+        :param cache_dir: If set, parser output is cached on disk in this
+            directory, keyed by document text and parser configuration, and
+            documents found in the cache are not re-parsed
+        """
+        if parser is None:
+            from snorkel.parser.spacy_parser import Spacy
+            parser = Spacy()
+        self.parser = parser
         super(CorpusParser, self).__init__(CorpusParserUDF,
                                            parser=self.parser,
-                                           fn=fn)
+                                           fn=fn,
+                                           cache_dir=cache_dir)
+
+    def apply(self, xs, batch_size=None, n_process=1, bulk=False, clear=True,
+              commit_every=None, checkpoint_path=None, **kwargs):
+        """
+        Parse the (document, text) pairs xs into Sentences.
+
+        :param batch_size: If set, documents are grouped into batches of this
+            size and each batch is passed to the parser at once, letting parsers
+            with a batch mode (e.g. spaCy's pipe) process it in one stream.
+        :param n_process: Number of processes the parser may use per batch
+        :param bulk: If True, new Documents and their Sentences are written
+            with bulk inserts of rows using pre-reserved ids, bypassing the ORM
+            session. Combine with batch_size to insert many documents at once.
+        :param clear: If False, existing Contexts are kept and documents whose
+            stable_id already has Sentences are skipped, so an interrupted run
+            can be resumed by applying to the same inputs again.
+        :param commit_every: If set, the session is committed after about this
+            many documents, rather than only at the end of the run.
+        :param checkpoint_path: If set, the number of leading documents of xs
+            that have been committed is saved to this file (at each periodic
+            commit when single-threaded, and at the end of the run). With
+            clear=False, a saved count is used to skip those documents
+            without reading them from the database.
+
+        If xs keeps checkpoints of its own (a TSVDocPreprocessor with a
+        checkpoint_dir), they are confirmed with its commit_checkpoint method
+        after each commit instead, and reset if clear is True; checkpoint_path
+        must then not be set.
+        """
+        commit_checkpoint = None
+        if getattr(xs, 'checkpoint_dir', None) is not None:
+            if checkpoint_path is not None:
+                raise ValueError("checkpoint_path cannot be combined with the checkpoints of xs")
+            if clear:
+                xs.reset_checkpoints()
+            commit_checkpoint = xs.commit_checkpoint
+
+        # The wrappers of xs below hide its length, which sets the size of the progress bar
+        if kwargs.get('progress_bar', True) and kwargs.get('count') is None and hasattr(xs, '__len__'):
+            kwargs['count'] = len(xs)
+
+        start = 0
+        if checkpoint_path is not None:
+            if not clear:
+                start = _load_checkpoint(checkpoint_path)
+                if start > 0:
+                    print("Resuming after %s documents..." % start)
+                    xs = islice(xs, start, None)
+                    if kwargs.get('count') is not None:
+                        kwargs['count'] = max(kwargs['count'] - start, 0)
+            else:
+                _save_checkpoint(checkpoint_path, 0)
+        consumed = [start]
+        if checkpoint_path is not None:
+            xs = _count(xs, consumed)
+
+        # Periodic checkpoints are only prefixes of xs for a single worker
+        udf_checkpoint_path, udf_commit_checkpoint = checkpoint_path, commit_checkpoint
+        if kwargs.get('parallelism') is not None and kwargs['parallelism'] > 1:
+            udf_checkpoint_path, udf_commit_checkpoint = None, None
+
+        if batch_size is not None:
+            xs = _batches(xs, batch_size)
+            # Progress is counted in batches
+            if kwargs.get('count') is not None:
+                kwargs['count'] = -(-kwargs['count'] // batch_size)
+        super(CorpusParser, self).apply(xs, batch_size=batch_size,
+                                        n_process=n_process, bulk=bulk, clear=clear,
+                                        commit_every=commit_every,
+                                        checkpoint_path=udf_checkpoint_path,
+                                        checkpoint_start=start,
+                                        commit_checkpoint=udf_commit_checkpoint, **kwargs)
+        if checkpoint_path is not None:
+            _save_checkpoint(checkpoint_path, consumed[0])
+        if commit_checkpoint is not None:
+            commit_checkpoint()
+
     def clear(self, session, **kwargs):
         session.query(Context).delete()
         # We cannot cascade up from child contexts to parent Candidates,
@@ -24,16 +119,234 @@ class CorpusParser(UDFRunner):
 
 
 class CorpusParserUDF(UDF):
+    BULK_CHUNK_SIZE = 5000
 
-    def __init__(self, parser, fn, **kwargs):
+    def __init__(self, parser, fn, cache_dir=None, **kwargs):
         super(CorpusParserUDF, self).__init__(**kwargs)
         self.parser = parser
         self.req_handler = parser.connect()
         self.fn = fn
+        self.cache = ParseCache(cache_dir) if cache_dir is not None else None
+        self.context_ids = None
+        self.n_applied = 0
+        self.n_committed = 0
+
+    def apply(self, x, batch_size=None, n_process=1, bulk=False, clear=True,
+              commit_every=None, checkpoint_path=None, checkpoint_start=0,
+              commit_checkpoint=None, **kwargs):
+        """
+        Given a Document object and its raw text, parse into Sentences; if
+        batch_size is set, x is a list of such pairs
+        """
+        # The sentences of all previously applied documents are in the session by now
+        if commit_every is not None and self.n_applied - self.n_committed >= commit_every:
+            self.session.commit()
+            if checkpoint_path is not None:
+                _save_checkpoint(checkpoint_path, checkpoint_start + self.n_applied)
+            if commit_checkpoint is not None:
+                commit_checkpoint(self.n_applied - self.n_committed)
+            self.n_committed = self.n_applied
+        self.n_applied += len(x) if batch_size is not None else 1
+
+        if not clear:
+            x = self._skip_parsed(x, batch_size)
+            if x is None:
+                return
 
-    def apply(self, x, **kwargs):
-        """Given a Document object and its raw text, parse into Sentences"""
-        doc, text = x
-        for parts in self.req_handler.parse(doc, text):
-            parts = self.fn(parts) if self.fn is not None else parts
+        if bulk:
+            self._apply_bulk(x, batch_size, n_process)
+            return
+
+        for parts in self._parse(x, batch_size, n_process):
             yield Sentence(**parts)
+
+    def _skip_parsed(self, x, batch_size):
+        """
+        Removes the documents whose stable_id already has sentences, and swaps
+        in the persisted Document for those which exist without sentences;
+        returns None if nothing is left to parse
+        """
+        batch = x if batch_size is not None else [x]
+        context, sentence = Context.__table__, Sentence.__table__
+        q = select([context.c.stable_id, context.c.id,
+                    exists().where(sentence.c.document_id == context.c.id)])\
+            .where(context.c.stable_id.in_([doc.stable_id for doc, _ in batch]))
+        existing = dict((stable_id, (doc_id, parsed)) for stable_id, doc_id, parsed in self.session.execute(q))
+
+        remaining = []
+        for doc, text in batch:
+            if doc.stable_id in existing:
+                doc_id, parsed = existing[doc.stable_id]
+                if parsed:
+                    continue
+                doc = self.session.query(Document).get(doc_id)
+            remaining.append((doc, text))
+        if not remaining:
+            return None
+        return remaining if batch_size is not None else remaining[0]
+
+    def _parse(self, x, batch_size, n_process):
+        """Generates the parts dicts of the sentences of x"""
+        if self.cache is not None:
+            batch = x if batch_size is not None else [x]
+            parsed = self._parse_cached(batch, batch_size, n_process)
+        elif batch_size is not None:
+            parsed = self.req_handler.parse_batch(x, batch_size=batch_size,
+                                                  n_process=n_process)
+        else:
+            doc, text = x
+            parsed = self.req_handler.parse(doc, text)
+        for parts in parsed:
+            yield self.fn(parts) if self.fn is not None else parts
+
+    def _apply_bulk(self, x, batch_size, n_process):
+        """
+        Parses a batch of (document, text) pairs, writing the new Documents and
+        the Sentences with executemany inserts of context, document and
+        sentence rows in chunks of about BULK_CHUNK_SIZE sentences, using
+        pre-reserved ids
+        """
+        if self.context_ids is None:
+            self.context_ids = IdAllocator(self.session, Context.__table__)
+
+        # Documents which are not yet persisted get their ids before parsing,
+        # but their rows are only built once their sentences are parsed, so
+        # that they include any meta set by the parser
+        batch = x if batch_size is not None else [x]
+        new_docs = [doc for doc, _ in batch if doc.id is None]
+        for doc, doc_id in zip(new_docs, self.context_ids.next_ids(len(new_docs))):
+            doc.id = doc_id
+        unwritten = set(doc.id for doc in new_docs)
+
+        context_rows, document_rows, sentence_rows = [], [], []
+        for doc, sentences in self._parse_by_document(x, batch_size, n_process):
+            if doc.id in unwritten:
+                unwritten.remove(doc.id)
+                self._add_document_rows(doc, context_rows, document_rows)
+            for parts, sentence_id in zip(sentences, self.context_ids.next_ids(len(sentences))):
+                row = {'id': sentence_id, 'type': 'sentence', 'stable_id': parts['stable_id']}
+                row.update(stable_key_columns(doc.id, parts['stable_id']))
+                context_rows.append(row)
+                row = {'id': sentence_id, 'document_id': doc.id}
+                for col in _SENTENCE_COLUMNS:
+                    value = parts.get(col)
+                    row[col] = list(value) if isinstance(value, tuple) else value
+                sentence_rows.append(row)
+            # Chunks end between documents, so sentences are never inserted before their document
+            if len(sentence_rows) >= self.BULK_CHUNK_SIZE:
+                self._insert_rows(context_rows, document_rows, sentence_rows)
+                context_rows, document_rows, sentence_rows = [], [], []
+
+        # Documents without sentences
+        for doc in new_docs:
+            if doc.id in unwritten:
+                self._add_document_rows(doc, context_rows, document_rows)
+        self._insert_rows(context_rows, document_rows, sentence_rows)
+
+    def _parse_by_document(self, x, batch_size, n_process):
+        """
+        Generates a (document, parts dicts of its sentences) pair for each
+        document of x with sentences, once all its sentences are parsed
+        """
+        doc, sentences = None, []
+        for parts in self._parse(x, batch_size, n_process):
+            if parts['document'] is not doc:
+                if sentences:
+                    yield doc, sentences
+                doc, sentences = parts['document'], []
+            sentences.append(parts)
+        if sentences:
+            yield doc, sentences
+
+    def _add_document_rows(self, doc, context_rows, document_rows):
+        row = {'id': doc.id, 'type': 'document', 'stable_id': doc.stable_id}
+        row.update(stable_key_columns(doc.id, doc.stable_id))
+        context_rows.append(row)
+        document_rows.append({'id': doc.id, 'name': doc.name, 'meta': doc.meta})
+
+    def _insert_rows(self, context_rows, document_rows, sentence_rows):
+        for table, rows in [(Context.__table__, context_rows),
+                            (Document.__table__, document_rows),
+                            (Sentence.__table__, sentence_rows)]:
+            if rows:
+                self.session.execute(table.insert(), rows)
+
+    def _parse_cached(self, batch, batch_size, n_process):
+        """
+        Load the parts of the documents in batch from the cache, parsing (and
+        caching) only the missing ones
+        """
+        keys = [self.cache.key(self.parser, text) for _, text in batch]
+        cached = [self.cache.get(key, doc) for key, (doc, _) in zip(keys, batch)]
+
+        # Parse the misses together, then regroup their parts by index in the
+        # batch: the parser sees each document through a proxy carrying its
+        # index, as documents without sentences yield no parts and the same
+        # document may be in the batch twice
+        misses = [(_IndexedDocument(doc, i), text)
+                  for i, ((doc, text), sentences) in enumerate(zip(batch, cached)) if sentences is None]
+        parsed = defaultdict(list)
+        if misses:
+            if batch_size is not None:
+                results = self.req_handler.parse_batch(misses, batch_size=batch_size,
+                                                       n_process=n_process)
+            else:
+                results = self.req_handler.parse(*misses[0])
+            for parts in results:
+                proxy = parts['document']
+                parts['document'] = proxy.document
+                parsed[proxy.index].append(parts)
+
+        for i, (key, sentences) in enumerate(zip(keys, cached)):
+            if sentences is None:
+                sentences = parsed[i]
+                self.cache.put(key, sentences)
+            for parts in sentences:
+                yield parts
+
+
+class _IndexedDocument(object):
+    """A Document with its index in a batch, which reads through to the Document"""
+    def __init__(self, document, index):
+        self.__dict__['document'] = document
+        self.__dict__['index'] = index
+
+    def __getattr__(self, name):
+        return getattr(self.document, name)
+
+
+# Sentence columns filled from the parser's parts dicts in bulk mode
+_SENTENCE_COLUMNS = [c.name for c in Sentence.__table__.columns if c.name not in ('id', 'document_id')]
+
+
+def _count(xs, counter):
+    """Passes through an iterable, counting the items taken in counter[0]"""
+    for x in xs:
+        yield x
+        counter[0] += 1
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return 0
+
+
+def _save_checkpoint(path, n):
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(n))
+    os.rename(path + '.tmp', path)
+
+
+def _batches(xs, batch_size):
+    """Group an iterable into lists of batch_size items"""
+    batch = []
+    for x in xs:
+        batch.append(x)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
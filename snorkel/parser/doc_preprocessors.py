@@ -2,14 +2,25 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
 from builtins import *
 
+import bz2
 import codecs
 import glob
+import gzip
+import hashlib
+import mmap
+import multiprocessing
 import os
 import re
+import threading
 import lxml.etree as et
 
+from collections import deque
+from queue import Full, Queue
+
 from bs4 import BeautifulSoup
 
 from snorkel.models import Document
@@ -23,31 +34,109 @@ class DocPreprocessor(object):
     :param path: filesystem path to file or directory to parse
     :param max_docs: the maximum number of Documents to produce,
         default=float('inf')
-
+    :param parallelism: if greater than 1, the number of workers reading and
+        parsing files concurrently. Documents are then produced in the order
+        they are completed, default=None
+    :param use_processes: run the workers as processes instead of threads,
+        for preprocessors whose parsing is CPU-bound, default=False
+    :param max_queue_size: the maximum number of parsed documents buffered
+        ahead of the consumer in parallel mode, default=1000
+
+    Files ending in .gz or .bz2 are decompressed on the fly.
     """
 
-    def __init__(self, path, encoding="utf-8", max_docs=float('inf')):
+    COMPRESSED_EXTENSIONS = {'.gz': gzip.GzipFile, '.bz2': bz2.BZ2File}
+
+    def __init__(self, path, encoding="utf-8", max_docs=float('inf'),
+                 parallelism=None, use_processes=False, max_queue_size=1000):
         self.path = path
         self.encoding = encoding
         self.max_docs = max_docs
+        self.parallelism = parallelism
+        self.use_processes = use_processes
+        self.max_queue_size = max_queue_size
 
     def generate(self):
         """
         Parses a file or directory of files into a set of Document objects.
 
         """
+        if self.parallelism is not None and self.parallelism > 1:
+            docs = self._generate_parallel()
+        else:
+            docs = self._generate_files(self._get_files(self.path))
         doc_count = 0
-        for fp in self._get_files(self.path):
+        try:
+            for doc, text in docs:
+                yield doc, text
+                doc_count += 1
+                if doc_count >= self.max_docs:
+                    return
+        finally:
+            docs.close()
+
+    def __iter__(self):
+        return self.generate()
+
+    def _generate_files(self, fpaths):
+        for fp in fpaths:
             file_name = os.path.basename(fp)
             if self._can_read(file_name):
                 for doc, text in self.parse_file(fp, file_name):
                     yield doc, text
-                    doc_count += 1
-                    if doc_count >= self.max_docs:
-                        return
 
-    def __iter__(self):
-        return self.generate()
+    def _generate_parallel(self):
+        """
+        Reads and parses the files in a pool of worker threads or processes,
+        which put the documents on a bounded queue as they go
+        """
+        if self.use_processes:
+            worker_class, queue_class, stop = multiprocessing.Process, multiprocessing.Queue, multiprocessing.Event()
+        else:
+            worker_class, queue_class, stop = threading.Thread, Queue, threading.Event()
+        in_queue, out_queue = queue_class(), queue_class(maxsize=self.max_queue_size)
+        for fp in self._get_files(self.path):
+            in_queue.put(fp)
+
+        workers = []
+        for _ in range(self.parallelism):
+            in_queue.put(None)
+            worker = worker_class(target=_parse_files, args=(self, in_queue, out_queue, stop))
+            worker.daemon = True
+            workers.append(worker)
+        for worker in workers:
+            worker.start()
+
+        try:
+            n_done = 0
+            while n_done < len(workers):
+                item = out_queue.get()
+                if item[0] == 'doc':
+                    yield item[1], item[2]
+                elif item[0] == 'error':
+                    raise item[1]
+                else:
+                    n_done += 1
+        finally:
+            stop.set()
+            if self.use_processes:
+                for worker in workers:
+                    worker.terminate()
+
+    def _open(self, fp, binary=False):
+        """
+        Opens a file for reading, decompressing it if it is gzip or bz2
+        compressed; unless binary is set, contents are decoded with the
+        preprocessor's encoding
+        """
+        ext = os.path.splitext(fp)[1].lower()
+        f = self.COMPRESSED_EXTENSIONS.get(ext, open)(fp, 'rb')
+        return f if binary else codecs.getreader(self.encoding)(f)
+
+    def _strip_compression(self, file_name):
+        """Removes a compression extension (e.g. .gz) from a file name"""
+        root, ext = os.path.splitext(file_name)
+        return root if ext.lower() in self.COMPRESSED_EXTENSIONS else file_name
 
     def get_stable_id(self, doc_id):
         return "%s::document:0:0" % doc_id
@@ -72,26 +161,132 @@ class DocPreprocessor(object):
 
 
 class TSVDocPreprocessor(DocPreprocessor):
-    """Simple parsing of TSV file with one (doc_name <tab> doc_text) per line"""
+    """
+    Simple parsing of TSV file with one (doc_name <tab> doc_text) per line
+
+    Uncompressed files are memory-mapped and read incrementally, tracking the
+    byte offset of the next unread line, so that ingestion of a large file can
+    be restarted part way through.
+
+    The following options can only be passed as keywords:
+
+    :param start_offset: byte offset at which to start reading each file;
+        must be the start of a line, default=0
+    :param checkpoint_dir: if set, reading resumes from the byte offsets saved
+        in this directory. An offset is only saved once the documents before it
+        have been committed: CorpusParser.apply confirms them as it commits, or
+        call commit_checkpoint. Cannot be combined with parallelism,
+        default=None
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        self.start_offset = kwargs.pop('start_offset', 0)
+        self.checkpoint_dir = kwargs.pop('checkpoint_dir', None)
+        super(TSVDocPreprocessor, self).__init__(path, *args, **kwargs)
+        if self.checkpoint_dir is not None:
+            if self.parallelism is not None and self.parallelism > 1:
+                raise ValueError("checkpoint_dir cannot be combined with parallelism")
+            if not os.path.isdir(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+        # The (file, end offset) of each generated document not yet committed
+        self.uncommitted = deque()
 
     def parse_file(self, fp, file_name):
-        with codecs.open(fp, encoding=self.encoding) as tsv:
-            for line in tsv:
-                (doc_name, doc_text) = line.split('\t')
-                stable_id = self.get_stable_id(doc_name)
-                doc = Document(
-                    name=doc_name, stable_id=stable_id,
-                    meta={'file_name': file_name}
-                )
-                yield doc, doc_text
+        offset = self.start_offset
+        if self.checkpoint_dir is not None:
+            offset = self.load_checkpoint(fp, offset)
+
+        for line, end in self._read_lines(fp, offset):
+            line = line.decode(self.encoding)
+            if not line.strip():
+                continue
+            (doc_name, doc_text) = line.split('\t')
+            stable_id = self.get_stable_id(doc_name)
+            doc = Document(
+                name=doc_name, stable_id=stable_id,
+                meta={'file_name': file_name}
+            )
+            if self.checkpoint_dir is not None:
+                self.uncommitted.append((fp, end))
+            yield doc, doc_text
+
+    def commit_checkpoint(self, n_docs=None):
+        """
+        Saves the offsets after the next n_docs generated documents (by
+        default, all of them), which must have been committed
+        """
+        if self.checkpoint_dir is None:
+            return
+        n_docs = len(self.uncommitted) if n_docs is None else min(n_docs, len(self.uncommitted))
+        offsets = {}
+        for _ in range(n_docs):
+            fp, offset = self.uncommitted.popleft()
+            offsets[fp] = offset
+        for fp, offset in offsets.items():
+            self.save_checkpoint(fp, offset)
+
+    def reset_checkpoints(self):
+        """Deletes the saved offsets, so that the files are read from start_offset again"""
+        if self.checkpoint_dir is None:
+            return
+        self.uncommitted.clear()
+        for fp in self._get_files(self.path):
+            if os.path.exists(self._checkpoint_file(fp)):
+                os.remove(self._checkpoint_file(fp))
+
+    def _read_lines(self, fp, offset):
+        """
+        Generates the (line bytes, end byte offset) pairs of a file from
+        offset on; uncompressed files are memory-mapped
+        """
+        if self._strip_compression(fp) != fp:
+            with self._open(fp, binary=True) as f:
+                f.seek(offset)
+                for line in f:
+                    offset += len(line)
+                    yield line, offset
+            return
+
+        with open(fp, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                size = len(mm)
+                while offset < size:
+                    end = mm.find(b'\n', offset)
+                    end = size if end < 0 else end + 1
+                    yield mm[offset:end], end
+                    offset = end
+            finally:
+                mm.close()
+
+    def _checkpoint_file(self, fp):
+        key = hashlib.sha1(os.path.abspath(fp).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.checkpoint_dir, '%s.%s.offset' % (os.path.basename(fp), key))
+
+    def load_checkpoint(self, fp, default=0):
+        """Returns the saved byte offset of the next unread line of fp"""
+        try:
+            with open(self._checkpoint_file(fp)) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError):
+            return default
+
+    def save_checkpoint(self, fp, offset):
+        """Saves the byte offset of the next unread line of fp"""
+        fname = self._checkpoint_file(fp)
+        with open(fname + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.rename(fname + '.tmp', fname)
 
 
 class TextDocPreprocessor(DocPreprocessor):
     """Simple parsing of raw text files, assuming one document per file"""
 
     def parse_file(self, fp, file_name):
-        with codecs.open(fp, encoding=self.encoding) as f:
-            name = os.path.basename(fp).rsplit('.', 1)[0]
+        with self._open(fp) as f:
+            name = self._strip_compression(os.path.basename(fp)).rsplit('.', 1)[0]
             stable_id = self.get_stable_id(name)
             doc = Document(
                 name=name, stable_id=stable_id, meta={'file_name': file_name}
@@ -190,11 +385,11 @@ class HTMLDocPreprocessor(DocPreprocessor):
     """Simple parsing of raw HTML files, assuming one document per file"""
 
     def parse_file(self, fp, file_name):
-        with open(fp, 'rb') as f:
+        with self._open(fp, binary=True) as f:
             html = BeautifulSoup(f, 'lxml')
             txt = list(filter(self._cleaner, html.findAll(text=True)))
             txt = ' '.join(self._strip_special(s) for s in txt if s != '\n')
-            name = os.path.basename(fp).rsplit('.', 1)[0]
+            name = self._strip_compression(os.path.basename(fp)).rsplit('.', 1)[0]
             stable_id = self.get_stable_id(name)
             doc = Document(
                 name=name, stable_id=stable_id, meta={'file_name': file_name}
@@ -202,7 +397,7 @@ class HTMLDocPreprocessor(DocPreprocessor):
             yield doc, txt
 
     def _can_read(self, fpath):
-        return fpath.endswith('.html')
+        return self._strip_compression(fpath).endswith('.html')
 
     def _cleaner(self, s):
         if s.parent.name in ['style', 'script', '[document]', 'head', 'title']:
@@ -225,27 +420,84 @@ class XMLMultiDocPreprocessor(DocPreprocessor):
 
     **Note: Include the full document XML etree in the attribs dict with
     keep_xml_tree=True**
+
+    With iterparse=True (keyword only), files are parsed incrementally and each document
+    element is freed once it has been read, so memory use does not grow with
+    the file size. The doc query must then end in a plain tag name
+    (e.g. './/document'), and every element with that tag is a document.
     """
 
     def __init__(self, path, doc='.//document', text='./text/text()',
         id='./id/text()', keep_xml_tree=False, *args, **kwargs):
+        # Keyword only, as positional arguments after keep_xml_tree go to DocPreprocessor
+        iterparse = kwargs.pop('iterparse', False)
         super(XMLMultiDocPreprocessor, self).__init__(path, *args, **kwargs)
         self.doc = doc
         self.text = text
         self.id = id
         self.keep_xml_tree = keep_xml_tree
+        self.iterparse = iterparse
+        if iterparse:
+            self.doc_tag = doc.split('/')[-1]
+            if not re.match(r'^[\w.:-]+$', self.doc_tag):
+                raise ValueError("iterparse requires a doc query ending in a tag name, got %s" % doc)
 
     def parse_file(self, f, file_name):
-        for i, doc in enumerate(et.parse(f).xpath(self.doc)):
-            doc_id = str(doc.xpath(self.id)[0])
-            text = '\n'.join(
-                [t for t in doc.xpath(self.text) if t is not None]
-            )
-            meta = {'file_name': str(file_name)}
-            if self.keep_xml_tree:
-                meta['root'] = et.tostring(doc)
-            stable_id = self.get_stable_id(doc_id)
-            yield Document(name=doc_id, stable_id=stable_id, meta=meta), text
+        if self.iterparse:
+            for doc in self._iterparse_file(f, file_name):
+                yield doc
+            return
+        with self._open(f, binary=True) as fh:
+            tree = et.parse(fh)
+        for i, doc in enumerate(tree.xpath(self.doc)):
+            yield self._get_document(doc, file_name)
+
+    def _iterparse_file(self, f, file_name):
+        with self._open(f, binary=True) as fh:
+            for _, doc in et.iterparse(fh, events=('end',), tag=self.doc_tag):
+                yield self._get_document(doc, file_name)
+                # Free the element and the already processed siblings before it
+                doc.clear()
+                while doc.getprevious() is not None:
+                    del doc.getparent()[0]
+
+    def _get_document(self, doc, file_name):
+        doc_id = str(doc.xpath(self.id)[0])
+        text = '\n'.join(
+            [t for t in doc.xpath(self.text) if t is not None]
+        )
+        meta = {'file_name': str(file_name)}
+        if self.keep_xml_tree:
+            meta['root'] = et.tostring(doc)
+        stable_id = self.get_stable_id(doc_id)
+        return Document(name=doc_id, stable_id=stable_id, meta=meta), text
 
     def _can_read(self, fpath):
-        return fpath.endswith('.xml')
+        return self._strip_compression(fpath).endswith('.xml')
+
+
+def _parse_files(preprocessor, in_queue, out_queue, stop):
+    """
+    Worker loop of DocPreprocessor's parallel mode: parses the files taken
+    from in_queue until a None sentinel, putting ('doc', doc, text) items on
+    out_queue, followed by ('done',) or ('error', exception)
+    """
+    def put(item):
+        # Block while the queue is full, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    try:
+        for fp in iter(in_queue.get, None):
+            for doc, text in preprocessor._generate_files([fp]):
+                if not put(('doc', doc, text)):
+                    return
+    except Exception as e:
+        put(('error', e))
+        return
+    put(('done',))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import zlib
+import hashlib
+import tempfile
+
+from snorkel.models import construct_stable_id
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class ParseCache(object):
+    '''
+    On-disk, content-addressed cache of parser output.
+
+    Each document's sentence parts dicts are stored as a zlib-compressed
+    pickle, keyed by a hash of the parser configuration and the raw text, so
+    re-running a CorpusParser (e.g. against a new database) loads unchanged
+    documents instead of re-parsing them. The parent document object and the
+    sentence stable ids are not stored; they are restored on load.
+    '''
+    # Pickle protocol readable from both Python 2 and 3
+    PROTOCOL = 2
+
+    def __init__(self, path):
+        '''
+        :param path: cache directory, created if missing
+        '''
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, parser, text):
+        '''
+        Content hash of a text and the configuration of the parser applied to it
+        :param parser:
+        :param text:
+        :return:
+        '''
+        h = hashlib.sha1(parser.get_config().encode('utf-8'))
+        h.update(b'\0')
+        h.update(text.encode('utf-8') if not isinstance(text, bytes) else text)
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key, document):
+        '''
+        Load the cached parts of a document, or return None on a cache miss
+        :param key:
+        :param document: document the parts are linked to
+        :return: list of parts dicts
+        '''
+        try:
+            with open(self._file(key), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        try:
+            sentences = pickle.loads(zlib.decompress(data))
+        except Exception:
+            # Treat partially written or corrupt entries as misses
+            return None
+
+        for parts in sentences:
+            parts['document'] = document
+            if document and parts['words']:
+                abs_sent_offset = parts['abs_char_offsets'][0]
+                abs_sent_offset_end = abs_sent_offset + parts['char_offsets'][-1] + len(parts['words'][-1])
+                parts['stable_id'] = construct_stable_id(document, 'sentence', abs_sent_offset, abs_sent_offset_end)
+        return sentences
+
+    def put(self, key, sentences):
+        '''
+        Store the parts of a document
+        :param key:
+        :param sentences: list of parts dicts
+        :return:
+        '''
+        sentences = [dict((k, v) for k, v in parts.items() if k not in ('document', 'stable_id'))
+                     for parts in sentences]
+        data = zlib.compress(pickle.dumps(sentences, protocol=ParseCache.PROTOCOL))
+
+        fname = self._file(key)
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created concurrently by another parser process
+                pass
+
+        # Write to a temporary file first, so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, fname)
@@ -39,6 +39,28 @@ class Parser(object):
         '''
         raise NotImplemented
 
+    def get_config(self):
+        '''
+        Return a string identifying this parser and every setting that affects
+        its output; used to key cached parses
+        :return:
+        '''
+        return self.name
+
+    def parse_batch(self, batch, conn=None, **kwargs):
+        '''
+        Parse a batch of (document, text) pairs, yielding the parts of each
+        sentence in document order. Parses one document at a time by default;
+        parsers with a native batch mode override this.
+        :param batch: list of (document, text) pairs
+        :param conn: connection to the parser server, for parsers that use one
+        :return:
+        '''
+        for document, text in batch:
+            parts_iter = self.parse(document, text) if conn is None else self.parse(document, text, conn)
+            for parts in parts_iter:
+                yield parts
+
     def close(self):
         '''
         Kill this parser
@@ -60,13 +82,17 @@ class ParserConnection(object):
     def parse(self, document, text):
         return self.parser.parse(document, text)
 
+    def parse_batch(self, batch, **kwargs):
+        return self.parser.parse_batch(batch, **kwargs)
+
 
 class URLParserConnection(ParserConnection):
     '''
     URL parser connection
     '''
-    def __init__(self, parser, retries=5):
+    def __init__(self, parser, retries=5, pool_maxsize=10):
         self.retries = retries
+        self.pool_maxsize = pool_maxsize
         self.parser = parser
         self.request = self._connection()
 
@@ -91,7 +117,8 @@ class URLParserConnection(ParserConnection):
         # See: http://stackoverflow.com/questions/30453152/python-multiprocessing-and-requests
         if sys.platform in ['darwin']:
             requests_session.trust_env = False
-        requests_session.mount('http://', HTTPAdapter(max_retries=retries))
+        # Size the connection pool for the number of concurrent requests
+        requests_session.mount('http://', HTTPAdapter(max_retries=retries, pool_maxsize=self.pool_maxsize))
         return requests_session
 
     def post(self, url, data, allow_redirects=True):
@@ -115,6 +142,13 @@ class URLParserConnection(ParserConnection):
         '''
         return self.parser.parse(document, text, self)
 
+    def parse_batch(self, batch, **kwargs):
+        '''
+        Return parse generator over a batch of (document, text) pairs
+        :param batch:
+        :return:
+        '''
+        return self.parser.parse_batch(batch, conn=self, **kwargs)
 
 
 
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import re
+from collections import defaultdict
+from snorkel.models import construct_stable_id
+from snorkel.parser.parser import Parser, ParserConnection
+
+
+class RegexParser(Parser):
+    '''
+    Lightweight parser that only detects sentence boundaries and tokens, using
+    precompiled regular expressions. No models are loaded and text is not run
+    through an escape round trip, so startup is immediate and throughput is
+    bound by I/O. Sentences have no lemmas, POS, NER or dependency tags.
+
+    Tokens are the matches of token_rgx; sentences are the pieces of text
+    between matches of sent_rgx.
+    '''
+    def __init__(self, token_rgx=r"\w+|[^\w\s]", sent_rgx=r"[\n\r]+|(?<=[.!?])\s+", encoding='utf-8'):
+        super(RegexParser, self).__init__(name="regex", encoding=encoding)
+        self.token_rgx = re.compile(token_rgx, re.UNICODE)
+        self.sent_rgx = re.compile(sent_rgx, re.UNICODE)
+
+    def connect(self):
+        return ParserConnection(self)
+
+    def get_config(self):
+        return "{}:{}:{}".format(self.name, self.token_rgx.pattern, self.sent_rgx.pattern)
+
+    def parse(self, document, text):
+        '''
+        Split text into sentences and tokens, producing the same parts as the
+        other parsers
+        :param document:
+        :param text:
+        :return:
+        '''
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding)
+
+        position, start = 0, 0
+        for m in self.sent_rgx.finditer(text):
+            parts = self._get_parts(document, text, start, m.start(), position)
+            start = m.end()
+            if parts is not None:
+                position += 1
+                yield parts
+        parts = self._get_parts(document, text, start, len(text), position)
+        if parts is not None:
+            yield parts
+
+    def parse_batch(self, batch, conn=None, **kwargs):
+        '''
+        Parse a batch of (document, text) pairs in document order. There is no
+        model to stream texts through, so batch_size and n_process are ignored
+        and each document is parsed as soon as it is reached
+        :param batch: list of (document, text) pairs
+        :param conn: unused
+        :return:
+        '''
+        for document, text in batch:
+            for parts in self.parse(document, text):
+                yield parts
+
+    def _get_parts(self, document, text, start, end, position):
+        '''
+        Tokenize the sentence text[start:end]; returns None if it has no tokens
+        '''
+        abs_char_offsets, words = [], []
+        for m in self.token_rgx.finditer(text, start, end):
+            abs_char_offsets.append(m.start())
+            words.append(m.group())
+        if not words:
+            return None
+
+        parts = defaultdict(list)
+        abs_sent_offset = abs_char_offsets[0]
+        abs_sent_offset_end = abs_char_offsets[-1] + len(words[-1])
+        parts['words'] = words
+        parts['char_offsets'] = [p - abs_sent_offset for p in abs_char_offsets]
+        parts['abs_char_offsets'] = abs_char_offsets
+        parts['lemmas'] = []
+        parts['pos_tags'] = []
+        parts['ner_tags'] = []
+        parts['dep_parents'] = []
+        parts['dep_labels'] = []
+        parts['position'] = position
+
+        # Link the sentence to its parent document object
+        parts['document'] = document
+        parts['text'] = text[abs_sent_offset:abs_sent_offset_end]
+
+        # Add null entity array (matching null for CoreNLP)
+        parts['entity_cids'] = ['O' for _ in words]
+        parts['entity_types'] = ['O' for _ in words]
+
+        # Assign the stable id as document's stable id plus absolute
+        # character offset
+        if document:
+            parts['stable_id'] = construct_stable_id(document, 'sentence', abs_sent_offset, abs_sent_offset_end)
+        return parts
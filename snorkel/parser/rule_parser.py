@@ -11,12 +11,13 @@ from collections import defaultdict
 from snorkel.models import construct_stable_id
 from snorkel.parser.parser import Parser, ParserConnection
 
+# spaCy is only needed by SpacyTokenizer
 try:
     import spacy
     from spacy.cli import download
     from spacy import util
-except:
-    raise Exception("spacy not installed. Use `pip install spacy`.")
+except ImportError:
+    spacy = None
 
 class Tokenizer(object):
     '''
@@ -54,6 +55,8 @@ class SpacyTokenizer(Tokenizer):
     Only use spaCy's tokenizer functionality
     '''
     def __init__(self, lang='en'):
+        if spacy is None:
+            raise ImportError("spacy not installed. Use `pip install spacy`.")
         super(SpacyTokenizer, self).__init__()
         self.lang = lang
         self.model = SpacyTokenizer.load_lang_model(lang)
@@ -150,6 +153,13 @@ class RuleBasedParser(Parser):
     def connect(self):
         return ParserConnection(self)
 
+    def get_config(self):
+        def describe(tokenizer):
+            rgx = getattr(tokenizer, 'rgx', None)
+            lang = getattr(tokenizer, 'lang', None)
+            return "{}({})".format(type(tokenizer).__name__, rgx.pattern if rgx is not None else lang)
+        return "{}:{}:{}".format(self.name, describe(self.tokenizer), describe(self.sent_boundary))
+
     def parse(self, document, text):
         '''
         Transform spaCy output to match CoreNLP's default format
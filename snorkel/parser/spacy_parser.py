@@ -4,6 +4,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import *
 
+import re
 import pkg_resources
 from pathlib import Path
 from collections import defaultdict
@@ -18,8 +19,10 @@ try:
         spacy_version = int(spacy.__version__[0])
     except:
         spacy_version = 1
-except:
-    raise Exception("spaCy not installed. Use `pip install spacy`.")
+    # (major, minor), for features introduced in minor releases
+    spacy_version_info = tuple(int(v) for v in re.findall(r'\d+', spacy.__version__)[:2]) or (spacy_version, 0)
+except ImportError:
+    raise ImportError("spaCy not installed. Use `pip install spacy`.")
 
 
 class Spacy(Parser):
@@ -58,6 +61,8 @@ class Spacy(Parser):
                  lang='en', num_threads=1, verbose=False):
 
         super(Spacy, self).__init__(name="spacy")
+        self.lang = lang
+        self.annotators = annotators
         self.model = Spacy.load_lang_model(lang)
         self.num_threads = num_threads
 
@@ -130,6 +135,11 @@ class Spacy(Parser):
     def connect(self):
         return ParserConnection(self)
 
+    def get_config(self):
+        meta = getattr(self.model, 'meta', {}) or {}
+        return "{}:{}:{}:{}:{}".format(self.name, spacy.__version__, self.lang,
+                                       meta.get('version', ''), ",".join(self.annotators))
+
     def parse(self, document, text):
         '''
         Transform spaCy output to match CoreNLP's default format
@@ -142,6 +152,46 @@ class Spacy(Parser):
         doc = self.model.tokenizer(text)
         for proc in self.pipeline:
             proc(doc)
+        return self._get_parts(document, doc)
+
+    def parse_batch(self, batch, conn=None, batch_size=1000, n_process=1, **kwargs):
+        '''
+        Parse a batch of (document, text) pairs by streaming them through
+        spaCy's batched pipe() methods, rather than one document at a time.
+        Yields the same parts dicts as parse(), in document order.
+
+        :param batch: list of (document, text) pairs
+        :param conn: unused, spaCy runs in process
+        :param batch_size: number of texts spaCy buffers per minibatch
+        :param n_process: number of processes (requires spaCy >= 2.2)
+        :return:
+        '''
+        documents = [document for document, _ in batch]
+        texts = [self.to_unicode(text) for _, text in batch]
+
+        if n_process > 1:
+            if spacy_version_info < (2, 2):
+                raise ValueError("n_process > 1 requires spaCy >= 2.2")
+            # Only run the pipeline components selected in __init__
+            disable = [name for name, _ in self.model.pipeline[len(self.pipeline):]]
+            docs = self.model.pipe(texts, batch_size=batch_size,
+                                   n_process=n_process, disable=disable)
+        else:
+            docs = self.model.tokenizer.pipe(texts, batch_size=batch_size)
+            for proc in self.pipeline:
+                docs = proc.pipe(docs, batch_size=batch_size)
+
+        for document, doc in zip(documents, docs):
+            for parts in self._get_parts(document, doc):
+                yield parts
+
+    def _get_parts(self, document, doc):
+        '''
+        Generate the parts dict of each sentence of a processed spaCy Doc
+        :param document:
+        :param doc:
+        :return:
+        '''
         assert doc.is_parsed
 
         position = 0
@@ -6,10 +6,10 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import *
 
-from multiprocessing import Process, JoinableQueue
+from multiprocessing import Process, JoinableQueue, Semaphore
 from queue import Empty
 
-from snorkel.models.meta import new_sessionmaker, snorkel_conn_string
+from snorkel.models.meta import dispose_inherited_engines, new_sessionmaker, snorkel_conn_string
 from tqdm import tqdm
 
 class UDFRunner(object):
@@ -20,15 +20,26 @@ class UDFRunner(object):
         self.udfs            = []
         self.pb = None
 
+        # Persistent worker pool, see start_workers()
+        self.pool      = []
+        self.pool_in   = None
+        self.pool_out  = None
+        self.pool_sema = None
+
         if hasattr(self.udf_class, 'reduce'):
             self.reducer = self.udf_class(**self.udf_init_kwargs)
         else:
             self.reducer = None
 
-    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, **kwargs):
+    def apply(self, xs, clear=True, parallelism=None, progress_bar=True, count=None, write_batch_size=None,
+              **kwargs):
         """
         Apply the given UDF to the set of objects xs, either single or multi-threaded,
         and optionally calling clear() first.
+
+        If write_batch_size is set, each session that outputs are written to is committed once at least this many
+        outputs have been written since its last commit (after the input they came from), rather than only at the
+        end of the run; this bounds the size of the transactions and of the sessions.
         """
         # Clear everything downstream of this UDF if requested
         if clear:
@@ -48,9 +59,9 @@ class UDFRunner(object):
             self.pb = tqdm(total=n)
 
         if parallelism is None or parallelism < 2:
-            self.apply_st(xs, clear=clear, count=count, **kwargs)
+            self.apply_st(xs, clear=clear, count=count, write_batch_size=write_batch_size, **kwargs)
         else:
-            self.apply_mt(xs, parallelism, clear=clear, **kwargs)
+            self.apply_mt(xs, parallelism, clear=clear, write_batch_size=write_batch_size, **kwargs)
 
         if self.pb is not None:
             self.pb.close()
@@ -59,7 +70,7 @@ class UDFRunner(object):
     def clear(self, session, **kwargs):
         raise NotImplementedError()
 
-    def apply_st(self, xs, count, **kwargs):
+    def apply_st(self, xs, count, write_batch_size=None, **kwargs):
         """Run the UDF single-threaded, optionally with progress bar"""
         udf = self.udf_class(**self.udf_init_kwargs)
 
@@ -69,21 +80,69 @@ class UDFRunner(object):
                 self.pb.update(1)
 
             # Apply UDF and add results to the session
+            n = 0
             for y in udf.apply(x, **kwargs):
                 # If UDF has a reduce step, this will take care of the insert; else add to session
                 if hasattr(self.udf_class, 'reduce'):
                     udf.reduce(y, **kwargs)
                 else:
                     udf.session.add(y)
+                n += 1
+            udf.commit_batch(n, write_batch_size)
 
         # Commit session and close progress bar if applicable
         udf.session.commit()
 
-    def apply_mt(self, xs, parallelism, **kwargs):
+    def start_workers(self, parallelism):
+        """
+        Start a pool of UDF processes that is reused by every multi-threaded apply() call until close_workers().
+
+        The processes are forked from the current one, so anything the UDF init kwargs already hold (e.g. a parser
+        with its models loaded) is shared copy-on-write instead of being loaded again for each worker and run.
+        While the pool is running, the parallelism argument of apply() only selects multi-threaded execution.
+        """
+        if snorkel_conn_string.startswith('sqlite'):
+            raise ValueError('Multiprocessing with SQLite is not supported. Please use a different database backend,'
+                             ' such as PostgreSQL.')
+        if self.pool:
+            self.close_workers()
+
+        self.pool_in   = JoinableQueue()
+        self.pool_out  = JoinableQueue()
+        self.pool_sema = Semaphore(0)
+        for i in range(parallelism):
+            udf = self.udf_class(in_queue=self.pool_in, out_queue=self.pool_out, resume=self.pool_sema,
+                add_to_session=(self.reducer is None), **self.udf_init_kwargs)
+            self.pool.append(udf)
+        for udf in self.pool:
+            udf.start()
+
+    def close_workers(self):
+        """Stop the persistent UDF processes started by start_workers()"""
+        for udf in self.pool:
+            self.pool_in.put(UDF.QUIT_SENTINEL)
+        for udf in self.pool:
+            udf.join()
+        self.pool = []
+
+    def terminate_workers(self):
+        """
+        Kill the persistent UDF processes, e.g. after one of them failed, when the others may be waiting for the
+        end of a run that cannot complete
+        """
+        for udf in self.pool:
+            udf.terminate()
+        for udf in self.pool:
+            udf.join()
+        self.pool = []
+
+    def apply_mt(self, xs, parallelism, write_batch_size=None, **kwargs):
         """Run the UDF multi-threaded using python multiprocessing"""
         if snorkel_conn_string.startswith('sqlite'):
             raise ValueError('Multiprocessing with SQLite is not supported. Please use a different database backend,'
                              ' such as PostgreSQL.')
+        if self.pool:
+            return self.apply_pool(xs, write_batch_size=write_batch_size, **kwargs)
 
         # Fill a JoinableQueue with input objects
         in_queue = JoinableQueue()
@@ -103,6 +162,7 @@ class UDFRunner(object):
             udf = self.udf_class(in_queue=in_queue, out_queue=out_queue,
                 add_to_session=(self.reducer is None), **self.udf_init_kwargs)
             udf.apply_kwargs = kwargs
+            udf.write_batch_size = write_batch_size
             self.udfs.append(udf)
 
         # Start the UDF processes, and then join on their completion
@@ -121,6 +181,7 @@ class UDFRunner(object):
             # If there is a reduce step, do now on this thread
             elif self.reducer is not None: 
                 self.reducer.reduce(y, **kwargs)
+                self.reducer.commit_batch(1, write_batch_size)
                 out_queue.task_done()
 
             else:
@@ -136,41 +197,97 @@ class UDFRunner(object):
         # Flush the processes
         self.udfs = []
 
+    def apply_pool(self, xs, write_batch_size=None, **kwargs):
+        """Run the UDF on the persistent worker pool"""
+        # The apply kwargs travel with each input, as the workers outlive this call
+        total_count = 0
+        for x in xs:
+            self.pool_in.put((x, kwargs, write_batch_size))
+            total_count += 1
+
+        # Each worker commits when it takes an end-of-run marker, and then waits until every worker has done so
+        for udf in self.pool:
+            self.pool_in.put(UDF.RUN_END_SENTINEL)
+
+        count, n_ended = 0, 0
+        while count < total_count or n_ended < len(self.pool):
+            try:
+                y = self.pool_out.get(timeout=1)
+            except Empty:
+                if not all([udf.is_alive() for udf in self.pool]):
+                    self.terminate_workers()
+                    raise RuntimeError("A UDF worker process exited unexpectedly; the worker pool was shut down.")
+                continue
+
+            if y == UDF.TASK_DONE_SENTINEL:
+                count += 1
+                if self.pb is not None:
+                    self.pb.update(1)
+            elif y == UDF.RUN_END_SENTINEL:
+                n_ended += 1
+            elif self.reducer is not None:
+                self.reducer.reduce(y, **kwargs)
+                self.reducer.commit_batch(1, write_batch_size)
+                self.pool_out.task_done()
+            else:
+                raise ValueError("Got non-sentinel output without reducer.")
+
+        for udf in self.pool:
+            self.pool_sema.release()
+        if self.reducer is not None:
+            self.reducer.session.commit()
+            self.reducer.session.close()
+
 class UDF(Process):
     TASK_DONE_SENTINEL = "done"
+    RUN_END_SENTINEL   = "run_end"
+    QUIT_SENTINEL      = "quit"
 
-    def __init__(self, in_queue=None, out_queue=None, add_to_session=True):
+    def __init__(self, in_queue=None, out_queue=None, add_to_session=True, resume=None):
         """
         in_queue: A Queue of input objects to process; primarily for running in parallel
+        resume: A Semaphore to wait on after each run; if set, the UDF is a persistent worker which takes
+            (x, apply_kwargs, write_batch_size) triples and end-of-run markers from in_queue until told to quit
         """
         Process.__init__(self)
         self.daemon         = True
         self.in_queue       = in_queue
         self.out_queue      = out_queue
         self.add_to_session = add_to_session
+        self.resume         = resume
+        self.n_uncommitted  = 0
 
-        # Each UDF starts its own Engine
-        # See http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
+        # UDFs share the engine of their process; once started as a Process, the UDF gives it a new pool (see run)
         SnorkelSession = new_sessionmaker()
         self.session   = SnorkelSession()
 
-        # We use a workaround to pass in the apply kwargs
-        self.apply_kwargs = {}
+        # We use a workaround to pass in the apply kwargs, and the write batch size (see UDFRunner.apply)
+        self.apply_kwargs     = {}
+        self.write_batch_size = None
 
     def run(self):
         """
         This method is called when the UDF is run as a Process in a multiprocess setting
         The basic routine is: get from JoinableQueue, apply, put / add outputs, loop
         """
+        # Do not reuse the connections pooled by the parent process
+        dispose_inherited_engines()
+
+        if self.resume is not None:
+            return self.run_persistent()
+
         while True:
             try:
                 x = self.in_queue.get_nowait()
+                n = 0
                 for y in self.apply(x, **self.apply_kwargs):
                     # If there's no additional reduce step coming, add to session
                     if self.add_to_session:
                         self.session.add(y)
+                        n += 1
                     else:
                         self.out_queue.put(y)
+                self.commit_batch(n, self.write_batch_size)
                 self.in_queue.task_done()
                 self.out_queue.put(UDF.TASK_DONE_SENTINEL)
 
@@ -179,6 +296,45 @@ class UDF(Process):
         self.session.commit()
         self.session.close()
 
+    def run_persistent(self):
+        """Worker loop of a persistent pool, which processes the inputs of many runs"""
+        while True:
+            item = self.in_queue.get()
+            if item == UDF.QUIT_SENTINEL:
+                self.in_queue.task_done()
+                break
+
+            # At the end of a run, commit and wait until all workers have committed
+            if item == UDF.RUN_END_SENTINEL:
+                self.session.commit()
+                self.in_queue.task_done()
+                self.out_queue.put(UDF.RUN_END_SENTINEL)
+                self.resume.acquire()
+                continue
+
+            x, apply_kwargs, write_batch_size = item
+            n = 0
+            for y in self.apply(x, **apply_kwargs):
+                if self.add_to_session:
+                    self.session.add(y)
+                    n += 1
+                else:
+                    self.out_queue.put(y)
+            self.commit_batch(n, write_batch_size)
+            self.in_queue.task_done()
+            self.out_queue.put(UDF.TASK_DONE_SENTINEL)
+        self.session.close()
+
+    def commit_batch(self, n, write_batch_size):
+        """
+        Counts n more outputs written to the session, and commits it if write_batch_size is set and at least that
+        many outputs are uncommitted
+        """
+        self.n_uncommitted += n
+        if write_batch_size is not None and self.n_uncommitted >= write_batch_size:
+            self.session.commit()
+            self.n_uncommitted = 0
+
     def apply(self, x, **kwargs):
         """This function takes in an object, and returns a generator / set / list"""
         raise NotImplementedError()
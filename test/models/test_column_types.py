@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import pickle
+import unittest
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import select, text
+
+from snorkel.models import Document, Sentence
+from snorkel.models.column_types import IntArray, StringArray
+from snorkel.models.meta import SnorkelBase
+
+
+class TestIntArray(unittest.TestCase):
+
+    def round_trip(self, value, **kwargs):
+        t = IntArray(**kwargs)
+        return t.process_result_value(t.process_bind_param(value, None), None)
+
+    def test_round_trip(self):
+        for value in [[], [0], [1, 2, 255], [0, 256, 65535], [65536, 7], [-1, 0, 1], [-2**31, 2**31 - 1]]:
+            self.assertEqual(self.round_trip(value), value)
+        self.assertIsNone(self.round_trip(None))
+
+    def test_width(self):
+        t = IntArray()
+        self.assertEqual(t.process_bind_param([1, 2, 255], None), b'B\x01\x02\xff')
+        self.assertEqual(t.process_bind_param([256], None), b'H\x00\x01')
+        self.assertEqual(t.process_bind_param([-1], None), b'I\xff\xff\xff\xff')
+        self.assertEqual(t.process_bind_param([65536], None), b'I\x00\x00\x01\x00')
+        self.assertEqual(t.process_bind_param([], None), b'B')
+
+    def test_out_of_range(self):
+        t = IntArray()
+        self.assertRaises(ValueError, t.process_bind_param, [2**31], None)
+        self.assertRaises(ValueError, t.process_bind_param, [0, -2**31 - 1], None)
+
+    def test_as_numpy(self):
+        for value, dtype in [([3, 1, 2], np.uint8), ([3, 1000], np.uint16), ([-3, 1], np.int32)]:
+            a = self.round_trip(value, as_numpy=True)
+            self.assertIsInstance(a, np.ndarray)
+            self.assertEqual(a.dtype, dtype)
+            self.assertEqual(a.tolist(), value)
+            self.assertFalse(a.flags.writeable)
+
+    def test_pickle_fallback(self):
+        t = IntArray()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(t.process_result_value(pickle.dumps([3, -1, 70000], protocol), None), [3, -1, 70000])
+
+
+class TestStringArray(unittest.TestCase):
+
+    def round_trip(self, value):
+        t = StringArray()
+        return t.process_result_value(t.process_bind_param(value, None), None)
+
+    def test_round_trip(self):
+        for value in [[], [''], ['', ''], ['a', 'bc', ''], ['caf\xe9', '文字', '\U0001f600']]:
+            self.assertEqual(self.round_trip(value), value)
+        self.assertIsNone(self.round_trip(None))
+
+    def test_length_prefixed(self):
+        t = StringArray()
+        for value in [[None], ['a', None, ''], ['a\x00b', 'c'], [None, 'caf\xe9\x00']]:
+            encoded = t.process_bind_param(value, None)
+            self.assertEqual(encoded[:1], StringArray.LENGTH_PREFIX_TAG)
+            self.assertEqual(t.process_result_value(encoded, None), value)
+
+    def test_other_items(self):
+        # Lists of items other than strings are pickled
+        t = StringArray()
+        for value in [[1, 2], ['a', 1], [b'a\x00b', 'c'], [None, 1.5], ['a', ['b']]]:
+            encoded = t.process_bind_param(value, None)
+            self.assertNotIn(encoded[:1], [StringArray.TAG, StringArray.LENGTH_PREFIX_TAG])
+            self.assertEqual(t.process_result_value(encoded, None), value)
+
+    def test_pickle_fallback(self):
+        t = StringArray()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(t.process_result_value(pickle.dumps(['a', 'caf\xe9'], protocol), None), ['a', 'caf\xe9'])
+
+
+class TestSentenceColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_sentence(self):
+        words = ['Alice', 'met', 'Bob', '.']
+        sentence = Sentence(document=Document(name='doc', stable_id='doc::document:0:0'), position=0,
+                            text='Alice met Bob.', words=words, char_offsets=[0, 6, 10, 13],
+                            abs_char_offsets=[100000, 100006, 100010, 100013], dep_parents=[2, 0, 2, 2],
+                            pos_tags=['NNP', 'VBD', 'NNP', '.'], ner_tags=['PERSON', None, 'PERSON', None],
+                            stable_id='doc::sentence:0:13')
+        self.session.add(sentence)
+        self.session.commit()
+        self.session.expunge_all()
+
+        sentence = self.session.query(Sentence).one()
+        self.assertEqual(sentence.words, words)
+        self.assertEqual(sentence.char_offsets, [0, 6, 10, 13])
+        self.assertEqual(sentence.abs_char_offsets, [100000, 100006, 100010, 100013])
+        self.assertEqual(sentence.dep_parents, [2, 0, 2, 2])
+        self.assertEqual(sentence.pos_tags, ['NNP', 'VBD', 'NNP', '.'])
+        self.assertEqual(sentence.ner_tags, ['PERSON', None, 'PERSON', None])
+        self.assertIsNone(sentence.lemmas)
+
+    def test_pickled_sentence(self):
+        # Rows written by versions storing the arrays with PickleType are still read
+        self.session.add(Document(name='doc', stable_id='doc::document:0:0'))
+        self.session.commit()
+        sentence = Sentence.__table__
+        self.session.execute(text("INSERT INTO context (id, type, stable_id) VALUES (2, 'sentence', 's')"))
+        self.session.execute(text(
+            "INSERT INTO sentence (id, document_id, position, text, words, char_offsets, abs_char_offsets) "
+            "VALUES (2, 1, 0, 'Alice met Bob', :words, :char_offsets, :abs_char_offsets)"
+        ), {'words': pickle.dumps(['Alice', 'met', 'Bob'], 2), 'char_offsets': pickle.dumps([0, 6, 10], 2),
+            'abs_char_offsets': pickle.dumps([0, 6, 10], 2)})
+        self.session.commit()
+
+        row = self.session.execute(select([sentence.c.words, sentence.c.char_offsets])).first()
+        self.assertEqual(list(row), [['Alice', 'met', 'Bob'], [0, 6, 10]])
+        self.assertEqual(self.session.query(Sentence).one().words, ['Alice', 'met', 'Bob'])
+
+
+if __name__ == '__main__':
+    unittest.main()
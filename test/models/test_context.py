@@ -0,0 +1,206 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+from sqlalchemy import Column, ForeignKey, Integer, String, create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import select, text
+
+from snorkel.models import Context, Document, Sentence, Span, TemporarySpan, construct_stable_id
+from snorkel.models.context import STABLE_TYPE_CODES, TemporaryDocument, stable_key_columns
+from snorkel.models.meta import SnorkelBase, add_missing_columns
+
+
+class Note(Context):
+    """A user-defined type of Context, with no Document"""
+    __tablename__ = 'test_note'
+    id = Column(Integer, ForeignKey('context.id', ondelete='CASCADE'), primary_key=True)
+    name = Column(String)
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'test_note',
+    }
+
+
+def add_document(session, name, text):
+    document = Document(name=name, stable_id='%s::document:0:0' % name)
+    words = text.split()
+    offsets = [text.index(w) for w in words]
+    sentence = Sentence(document=document, position=0, text=text, words=words, char_offsets=offsets,
+                        abs_char_offsets=offsets, stable_id='%s::sentence:0:%s' % (name, len(text) - 1))
+    session.add(sentence)
+    session.commit()
+    return document, sentence
+
+
+def get_key(session, context_id):
+    c = Context.__table__.c
+    q = select([c.stable_doc_id, c.stable_type, c.stable_start, c.stable_end]).where(c.id == context_id)
+    return tuple(session.execute(q).first())
+
+
+class TestStableKey(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_stable_key_columns(self):
+        self.assertEqual(stable_key_columns(3, 'doc::span:10:14'),
+                         {'stable_doc_id': 3, 'stable_type': STABLE_TYPE_CODES['span'],
+                          'stable_start': 10, 'stable_end': 14})
+        for document_id, stable_id in [(3, 'malformed'), (None, 'doc::span:10:14'), (3, 'doc::unknown:1:2')]:
+            self.assertEqual(set(stable_key_columns(document_id, stable_id).values()), set([None]))
+
+    def test_orm_insert_sets_key(self):
+        document, sentence = add_document(self.session, 'doc', 'Hello big world')
+        span = Span(sentence=sentence, char_start=6, char_end=8,
+                    stable_id=construct_stable_id(sentence, 'span', 6, 8))
+        self.session.add(span)
+        self.session.commit()
+
+        # Documents only get their key after the insert assigns their id
+        self.assertEqual(get_key(self.session, document.id), (document.id, STABLE_TYPE_CODES['document'], 0, 0))
+        self.assertEqual(document.stable_doc_id, document.id)
+        self.assertEqual(get_key(self.session, sentence.id), (document.id, STABLE_TYPE_CODES['sentence'], 0, 14))
+        self.assertEqual(get_key(self.session, span.id), (document.id, STABLE_TYPE_CODES['span'], 6, 8))
+
+    def test_load_id_or_insert(self):
+        _, sentence = add_document(self.session, 'doc', 'Hello big world')
+        ts = TemporarySpan(sentence, 6, 8)
+        ts.load_id_or_insert(self.session)
+        self.assertIsNotNone(ts.id)
+        self.assertEqual(get_key(self.session, ts.id), (sentence.document_id, STABLE_TYPE_CODES['span'], 6, 8))
+
+        # The same span is found by its key rather than inserted again
+        ts2 = TemporarySpan(sentence, 6, 8)
+        ts2.load_id_or_insert(self.session)
+        self.assertEqual(ts2.id, ts.id)
+        self.assertEqual(self.session.query(Span).count(), 1)
+
+    def test_load_id_or_insert_without_key(self):
+        # Contexts inserted by older versions of Snorkel have no key, and are matched by their stable id
+        _, sentence = add_document(self.session, 'doc', 'Hello big world')
+        ts = TemporarySpan(sentence, 0, 4)
+        ts.load_id_or_insert(self.session)
+        self.session.execute(Context.__table__.update().values(stable_doc_id=None, stable_type=None,
+                                                               stable_start=None, stable_end=None))
+        ts2 = TemporarySpan(sentence, 0, 4)
+        ts2.load_id_or_insert(self.session)
+        self.assertEqual(ts2.id, ts.id)
+
+    def test_other_context_type(self):
+        # Contexts of types other than Document, Sentence and Span are inserted without a key
+        note = Note(name='note', stable_id='note::test_note:0:0')
+        self.session.add(note)
+        self.session.commit()
+        self.assertEqual(get_key(self.session, note.id), (None, None, None, None))
+        self.session.expunge_all()
+        self.assertEqual(self.session.query(Note).filter(Note.stable_id == 'note::test_note:0:0').one().name, 'note')
+
+
+class TestUpgradeSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        # The context table as created by older versions of Snorkel
+        self.engine.execute(text("CREATE TABLE context (id INTEGER NOT NULL PRIMARY KEY, type VARCHAR NOT NULL, "
+                                 "stable_id VARCHAR NOT NULL UNIQUE)"))
+        SnorkelBase.metadata.create_all(self.engine, tables=[t for t in SnorkelBase.metadata.sorted_tables
+                                                             if t.name != 'context'])
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_add_missing_columns(self):
+        self.assertEqual(sorted(add_missing_columns(self.engine)),
+                         ['context.stable_doc_id', 'context.stable_end', 'context.stable_start', 'context.stable_type'])
+        self.assertEqual(add_missing_columns(self.engine), [])
+        columns = [column['name'] for column in inspect(self.engine).get_columns('context')]
+        self.assertIn('stable_doc_id', columns)
+
+    def test_upgrade_schema(self):
+        from snorkel.db_helpers import upgrade_schema
+        add_missing_columns(self.engine)
+        _, sentence = add_document(self.session, 'doc', 'Hello big world')
+        ts = TemporarySpan(sentence, 6, 8)
+        ts.load_id_or_insert(self.session)
+        self.session.execute(Context.__table__.update().values(stable_doc_id=None, stable_type=None,
+                                                               stable_start=None, stable_end=None))
+        self.session.commit()
+
+        upgrade_schema(self.session)
+        self.assertEqual(get_key(self.session, ts.id), (sentence.document_id, STABLE_TYPE_CODES['span'], 6, 8))
+        self.assertEqual(get_key(self.session, sentence.id), (sentence.document_id, STABLE_TYPE_CODES['sentence'], 0, 14))
+        indexes = [index['name'] for index in inspect(self.engine).get_indexes('context')]
+        self.assertIn('ix_context_stable_key', indexes)
+
+
+def linear_char_to_word_index(offsets, ci):
+    """The linear scan char_to_word_index used to do"""
+    i = None
+    for i, co in enumerate(offsets):
+        if ci == co:
+            return i
+        elif ci < co:
+            return i - 1
+    return i
+
+
+class TestTemporarySpan(unittest.TestCase):
+
+    def setUp(self):
+        text = 'The  quick brown fox, jumped.'
+        words = ['The', 'quick', 'brown', 'fox', ',', 'jumped', '.']
+        offsets, start = [], 0
+        for w in words:
+            start = text.index(w, start)
+            offsets.append(start)
+            start += len(w)
+        self.sentence = Sentence(id=1, position=0, text=text, words=words, char_offsets=offsets,
+                                 abs_char_offsets=offsets, stable_id='doc::sentence:0:%s' % (len(text) - 1))
+
+    def test_char_to_word_index(self):
+        span = TemporarySpan(self.sentence, 0, 2)
+        for ci in range(-2, len(self.sentence.text) + 3):
+            self.assertEqual(span.char_to_word_index(ci),
+                             linear_char_to_word_index(self.sentence.char_offsets, ci), ci)
+
+    def test_word_range(self):
+        # 'quick brown fox'
+        span = TemporarySpan(self.sentence, 5, 19)
+        self.assertEqual(span.get_word_range(), (1, 3))
+        self.assertEqual(span.get_span(), 'quick brown fox')
+        self.assertEqual(TemporarySpan(self.sentence, 28, 28).get_word_range(), (6, 6))
+
+    def test_no_words(self):
+        sentence = Sentence(id=2, position=0, text='', words=[], char_offsets=[], abs_char_offsets=[],
+                            stable_id='doc::sentence:0:0')
+        self.assertIsNone(TemporarySpan(sentence, 0, 0).char_to_word_index(0))
+
+    def test_slots(self):
+        span = TemporarySpan(self.sentence, 0, 2)
+        self.assertFalse(hasattr(span, '__dict__'))
+        with self.assertRaises(AttributeError):
+            span.other = 1
+        self.assertFalse(hasattr(TemporaryDocument(Document(name='doc')), '__dict__'))
+
+    def test_hash(self):
+        spans = set([TemporarySpan(self.sentence, 0, 2), TemporarySpan(self.sentence, 0, 2),
+                     TemporarySpan(self.sentence, 2, 0), TemporarySpan(self.sentence, 1, 1)])
+        self.assertEqual(len(spans), 3)
+        self.assertEqual(hash(TemporarySpan(self.sentence, 4, 8)), hash(TemporarySpan(self.sentence, 4, 8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from sqlalchemy.pool import QueuePool
+
+import snorkel.models.meta as meta
+
+
+def query_in_child(engine, queue):
+    """Runs a query on an engine inherited from the parent process, and reports the pid its connection was opened in"""
+    try:
+        meta.dispose_inherited_engines()
+        conn = engine.connect()
+        conn.execute("SELECT 1").scalar()
+        queue.put(conn.connection._connection_record.info['pid'])
+        conn.close()
+    except Exception as e:
+        queue.put(repr(e))
+
+
+class TestEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.conn_string = 'sqlite:///' + os.path.join(self.tmpdir, 'snorkel.db')
+
+    def tearDown(self):
+        engine = meta._engines.pop(self.conn_string, None)
+        if engine is not None:
+            engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_engine_is_shared(self):
+        engine = meta.get_engine(self.conn_string)
+        self.assertIs(meta.get_engine(self.conn_string), engine)
+        self.assertIs(meta.get_engine(), meta.snorkel_engine)
+        self.assertIs(meta.new_sessionmaker().kw['bind'], meta.snorkel_engine)
+
+    def test_sqlite_file_pool(self):
+        engine = meta.get_engine(self.conn_string)
+        self.assertIsInstance(engine.pool, QueuePool)
+
+        # A connection returned to the pool is reused, from any thread
+        conn = engine.connect()
+        dbapi_connection = conn.connection.connection
+        conn.close()
+        results = []
+
+        def run():
+            c = engine.connect()
+            results.append((c.connection.connection is dbapi_connection, c.execute("SELECT 1").scalar()))
+            c.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [(True, 1)])
+
+    def test_checkout_from_other_process(self):
+        engine = meta.get_engine(self.conn_string)
+        conn = engine.connect()
+        dbapi_connection = conn.connection.connection
+        conn.connection._connection_record.info['pid'] = -1
+        conn.close()
+
+        # The connection recorded as opened by another process is replaced, rather than used
+        conn = engine.connect()
+        self.assertIsNot(conn.connection.connection, dbapi_connection)
+        self.assertEqual(conn.connection._connection_record.info['pid'], os.getpid())
+        self.assertEqual(conn.execute("SELECT 1").scalar(), 1)
+        conn.close()
+
+    def test_dispose_inherited_engines(self):
+        engine = meta.get_engine(self.conn_string)
+        pool = engine.pool
+        meta.dispose_inherited_engines()
+        self.assertIs(engine.pool, pool)
+
+        pid = meta._engines_pid
+        try:
+            meta._engines_pid = -1
+            meta.dispose_inherited_engines()
+            self.assertIsNot(engine.pool, pool)
+            self.assertEqual(meta._engines_pid, os.getpid())
+        finally:
+            meta._engines_pid = pid
+
+    @unittest.skipIf(sys.platform == 'win32', "requires fork")
+    def test_fork(self):
+        engine = meta.get_engine(self.conn_string)
+        conn = engine.connect()
+        conn.execute("SELECT 1")
+        conn.close()
+
+        # The child opens its own connection instead of using the one pooled by the parent
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        child = ctx.Process(target=query_in_child, args=(engine, queue))
+        child.start()
+        result = queue.get(timeout=30)
+        child.join()
+        self.assertEqual(result, child.pid)
+
+        # The parent's pooled connection is still usable
+        conn = engine.connect()
+        self.assertEqual(conn.connection._connection_record.info['pid'], os.getpid())
+        self.assertEqual(conn.execute("SELECT 1").scalar(), 1)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
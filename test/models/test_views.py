@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+
+from snorkel.models import Document, Sentence, Span, candidate_subclass, construct_stable_id
+from snorkel.models.meta import SnorkelBase
+from snorkel.models.views import (
+    create_serialized_candidate_view, get_serialized_candidate_query, get_serialized_candidate_view_name,
+    refresh_serialized_candidate_view
+)
+
+ViewPair = candidate_subclass('ViewPair', ['a', 'b'])
+
+
+class TestSerializedCandidateView(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        text = 'Alice met Bob and Carol'
+        offsets = [0, 6, 10, 14, 18]
+        self.sentence = Sentence(document=Document(name='doc', stable_id='doc::document:0:0'), position=0, text=text,
+                                 words=text.split(), char_offsets=offsets, abs_char_offsets=offsets,
+                                 stable_id='doc::sentence:0:%s' % (len(text) - 1))
+        self.spans = [Span(sentence=self.sentence, char_start=start, char_end=end,
+                           stable_id=construct_stable_id(self.sentence, 'span', start, end))
+                      for start, end in [(0, 4), (10, 12), (18, 22)]]
+        self.session.add_all([ViewPair(a=self.spans[0], b=self.spans[1], split=0),
+                              ViewPair(a=self.spans[0], b=self.spans[2], split=1)])
+        self.session.commit()
+        self.name = get_serialized_candidate_view_name(ViewPair)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def rows(self):
+        q = "SELECT id, split, a_char_start, b_char_start, sentence_text FROM {0} ORDER BY id".format(self.name)
+        return [tuple(row)[1:] for row in self.session.execute(text(q))]
+
+    def add_candidate(self):
+        self.session.add(ViewPair(a=self.spans[1], b=self.spans[2], split=0))
+        self.session.commit()
+
+    def test_query(self):
+        q = get_serialized_candidate_query(ViewPair)
+        names = [column.name for column in q.columns]
+        self.assertEqual(names[:5], ['id', 'split', 'a_cid', 'a_id', 'a_sentence_id'])
+        self.assertIn('b_char_end', names)
+        self.assertIn('sentence_words', names)
+        self.assertEqual(len(self.session.execute(q).fetchall()), 2)
+
+    def test_view(self):
+        create_serialized_candidate_view(self.session, ViewPair)
+        self.assertIn(self.name, inspect(self.engine).get_view_names())
+        self.assertEqual(self.rows(), [(0, 0, 10, self.sentence.text), (1, 0, 18, self.sentence.text)])
+
+        # Creating the view again does nothing, and a plain view is always up to date
+        create_serialized_candidate_view(self.session, ViewPair)
+        self.add_candidate()
+        self.assertEqual(len(self.rows()), 3)
+        refresh_serialized_candidate_view(self.session, ViewPair)
+        self.assertEqual(len(self.rows()), 3)
+
+    def test_materialized(self):
+        create_serialized_candidate_view(self.session, ViewPair, materialized=True)
+        inspector = inspect(self.engine)
+        self.assertIn(self.name, inspector.get_table_names())
+        self.assertNotIn(self.name, inspector.get_view_names())
+        indexes = dict((index['name'], index) for index in inspector.get_indexes(self.name))
+        self.assertEqual(indexes['ix_%s_id' % self.name]['column_names'], ['id'])
+        self.assertTrue(indexes['ix_%s_id' % self.name]['unique'])
+        self.assertEqual(indexes['ix_%s_split' % self.name]['column_names'], ['split'])
+        self.assertEqual(self.rows(), [(0, 0, 10, self.sentence.text), (1, 0, 18, self.sentence.text)])
+
+        # The stored rows are only recomputed on refresh
+        self.add_candidate()
+        create_serialized_candidate_view(self.session, ViewPair, materialized=True)
+        self.assertEqual(len(self.rows()), 2)
+        refresh_serialized_candidate_view(self.session, ViewPair)
+        self.assertEqual(self.rows(), [(0, 0, 10, self.sentence.text), (1, 0, 18, self.sentence.text),
+                                       (0, 10, 18, self.sentence.text)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from snorkel.parser.corenlp import StanfordCoreNLPServer
+
+import json
+import re
+import threading
+import time
+import unittest
+
+
+class StubCoreNLPHandler(BaseHTTPRequestHandler):
+    """Answers every POST with a single-sentence CoreNLP JSON parse of the whitespace-tokenized text"""
+    lock      = threading.Lock()
+    in_flight = 0
+    max_seen  = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        cls = StubCoreNLPHandler
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_seen = max(cls.max_seen, cls.in_flight)
+        text = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        time.sleep(0.02)
+
+        tokens = []
+        for m in re.finditer(r'\S+', text):
+            tokens.append({'word': m.group(), 'lemma': m.group(), 'pos': 'NN', 'ner': 'O',
+                           'characterOffsetBegin': m.start(), 'originalText': m.group()})
+        deps = [{'governor': 0, 'dep': 'root', 'dependent': i + 1} for i in range(len(tokens))]
+        body = json.dumps({'sentences': [{'tokens': tokens, 'basic-dependencies': deps}]}).encode('utf-8')
+
+        with cls.lock:
+            cls.in_flight -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingStubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestCoreNLPPipelining(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingStubServer(('127.0.0.1', 0), StubCoreNLPHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def get_parser(self, max_in_flight, max_chunk_size=50000):
+        # Bypass __init__, which launches a Java CoreNLP server
+        parser = StanfordCoreNLPServer.__new__(StanfordCoreNLPServer)
+        parser.process_group  = None
+        parser.verbose        = False
+        parser.encoding       = 'utf-8'
+        parser.version        = '3.6.0'
+        parser.max_in_flight  = max_in_flight
+        parser.max_chunk_size = max_chunk_size
+        parser.endpoint       = 'http://127.0.0.1:%d/' % self.server.server_port
+        return parser
+
+    def test_parse_batch_order(self):
+        batch = [(None, 'document number %d' % i) for i in range(30)]
+        for max_in_flight in [1, 4]:
+            StubCoreNLPHandler.max_seen = 0
+            parser = self.get_parser(max_in_flight)
+            words = [parts['words'] for parts in parser.connect().parse_batch(batch)]
+            self.assertEqual(words, [['document', 'number', str(i)] for i in range(30)])
+            self.assertLessEqual(StubCoreNLPHandler.max_seen, max_in_flight)
+            if max_in_flight > 1:
+                self.assertGreater(StubCoreNLPHandler.max_seen, 1)
+
+    def test_split_text(self):
+        parser = self.get_parser(1, max_chunk_size=40)
+        text = ('First paragraph here.\n\nSecond one, which is rather longer. It has two sentences. '
+                'And a third sentence!\n\n' + 'x' * 90)
+        chunks = parser.split_text(text)
+        self.assertEqual(''.join(chunk for _, chunk in chunks), text)
+        for offset, chunk in chunks:
+            self.assertLessEqual(len(chunk), 40)
+            self.assertEqual(text[offset:offset + len(chunk)], chunk)
+        self.assertTrue(chunks[0][1].endswith('.\n\n'))
+        self.assertTrue(chunks[1][1].endswith('. '))
+        self.assertEqual(parser.split_text('short text'), [(0, 'short text')])
+
+    def test_parse_long_document(self):
+        text = ' '.join('word%d' % i for i in range(200))
+        for max_in_flight in [1, 4]:
+            parser = self.get_parser(max_in_flight, max_chunk_size=100)
+            for sents in [list(parser.connect().parse(None, text)),
+                          list(parser.connect().parse_batch([(None, 'a b'), (None, text)]))[1:]]:
+                self.assertGreater(len(sents), 1)
+                self.assertEqual([parts['position'] for parts in sents], list(range(len(sents))))
+                words = [w for parts in sents for w in parts['words']]
+                self.assertEqual(words, text.split(' '))
+                for parts in sents:
+                    for w, offset in zip(parts['words'], parts['abs_char_offsets']):
+                        self.assertEqual(text[offset:offset + len(w)], w)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import sys
+import unittest
+from sqlalchemy.sql import select
+
+from snorkel.models import Context, Document, Sentence
+from snorkel.models.context import STABLE_TYPE_CODES
+from snorkel.parser import CorpusParser, RegexParser
+from snorkel.parser.corpus_parser import CorpusParserUDF
+
+# The base class of the tests using a database is in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from snorkel_test_base import SnorkelTestBase
+
+
+class RecordingParser(RegexParser):
+    """RegexParser which records the size and arguments of the batches it parses"""
+    def __init__(self):
+        super(RecordingParser, self).__init__()
+        self.batches = []
+
+    def parse_batch(self, batch, conn=None, **kwargs):
+        self.batches.append((len(batch), kwargs))
+        return super(RecordingParser, self).parse_batch(batch, conn=conn, **kwargs)
+
+
+class FailingParser(RecordingParser):
+    """RegexParser which fails on one document, and records the names of the documents it parses"""
+    def __init__(self, fail_on=None):
+        super(FailingParser, self).__init__()
+        self.fail_on = fail_on
+        self.parsed = []
+
+    def parse(self, document, text):
+        if document.name == self.fail_on:
+            raise RuntimeError("parse failed")
+        self.parsed.append(document.name)
+        return super(FailingParser, self).parse(document, text)
+
+
+class MetaParser(RegexParser):
+    """RegexParser which records the number of sentences of each document in its meta, once it is parsed"""
+    def parse(self, document, text):
+        n = 0
+        for parts in super(MetaParser, self).parse(document, text):
+            n += 1
+            yield parts
+        document.meta = dict(document.meta or {}, n_sentences=n)
+
+
+class InterruptedUDF(CorpusParserUDF):
+    """CorpusParserUDF which keeps track of its instances, so that the sessions of a failed run can be closed"""
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super(InterruptedUDF, self).__init__(*args, **kwargs)
+        self.instances.append(self)
+
+
+def make_docs(n):
+    return [(Document(name='doc%s' % i, stable_id='doc%s::document:0:0' % i, meta={}),
+             'Document %s. It has two sentences.' % i) for i in range(n)]
+
+
+class TestCorpusParser(SnorkelTestBase):
+
+    def sentences(self):
+        return sorted((s.document.name, s.position, s.text) for s in self.session.query(Sentence).all())
+
+    def expected(self, n):
+        return sorted(('doc%s' % i, j, text) for i in range(n)
+                      for j, text in enumerate(['Document %s.' % i, 'It has two sentences.']))
+
+    def test_apply(self):
+        parser = RecordingParser()
+        CorpusParser(parser=parser).apply(make_docs(3), progress_bar=False)
+        self.assertEqual(self.sentences(), self.expected(3))
+        self.assertEqual(parser.batches, [])
+
+    def test_apply_batch(self):
+        parser = RecordingParser()
+        CorpusParser(parser=parser).apply(make_docs(7), batch_size=3, n_process=2, progress_bar=False)
+        self.assertEqual(self.sentences(), self.expected(7))
+        self.assertEqual([n for n, _ in parser.batches], [3, 3, 1])
+        self.assertTrue(all(kwargs == {'batch_size': 3, 'n_process': 2} for _, kwargs in parser.batches))
+
+    def test_progress_bar(self):
+        # The progress bar of a list of documents counts its documents, or their batches
+        checkpoint_path = os.path.join(self.tmpdir, 'checkpoint')
+        for kwargs, total in [({}, 5), ({'batch_size': 2}, 3), ({'checkpoint_path': checkpoint_path}, 5)]:
+            corpus_parser = CorpusParser(parser=RegexParser())
+            corpus_parser.apply(make_docs(5), **kwargs)
+            self.assertEqual(corpus_parser.pb.total, total)
+        self.assertEqual(self.sentences(), self.expected(5))
+
+    def parsed_sentences(self):
+        return sorted((s.document.name, s.position, s.text, list(s.words), list(s.char_offsets),
+                       list(s.abs_char_offsets), s.stable_id) for s in self.session.query(Sentence).all())
+
+    def test_apply_bulk(self):
+        CorpusParser(parser=RegexParser()).apply(make_docs(5), progress_bar=False)
+        expected = self.parsed_sentences()
+        self.session.close()
+
+        for batch_size in [None, 2]:
+            CorpusParser(parser=RegexParser()).apply(make_docs(5), bulk=True, batch_size=batch_size,
+                                                     progress_bar=False)
+            self.assertEqual(self.parsed_sentences(), expected)
+            self.assertEqual(self.session.query(Document).count(), 5)
+            self.session.close()
+
+    def test_apply_bulk_chunks(self):
+        chunk_size = CorpusParserUDF.BULK_CHUNK_SIZE
+        CorpusParserUDF.BULK_CHUNK_SIZE = 3
+        try:
+            CorpusParser(parser=RegexParser()).apply(make_docs(4), bulk=True, batch_size=4, progress_bar=False)
+        finally:
+            CorpusParserUDF.BULK_CHUNK_SIZE = chunk_size
+        self.assertEqual(self.sentences(), self.expected(4))
+
+        # The stable key columns are filled in for the bulk inserted contexts
+        c = Context.__table__.c
+        q = select([c.stable_doc_id, c.stable_type, c.stable_start, c.stable_end]).where(c.type == 'sentence')
+        doc_ids = dict((d.name, d.id) for d in self.session.query(Document).all())
+        expected = [(doc_ids['doc%s' % i], STABLE_TYPE_CODES['sentence'], start, end)
+                    for i in range(4) for start, end in [(0, 11), (12, 33)]]
+        self.assertEqual(sorted(tuple(row) for row in self.session.execute(q)), sorted(expected))
+
+    def test_apply_bulk_meta(self):
+        # Meta set by the parser is written with the documents
+        docs = make_docs(3) + [(Document(name='empty', stable_id='empty::document:0:0', meta={}), '')]
+        CorpusParser(parser=MetaParser()).apply(docs, bulk=True, batch_size=4, progress_bar=False)
+        self.assertEqual(sorted((d.name, d.meta) for d in self.session.query(Document).all()),
+                         [('doc%s' % i, {'n_sentences': 2}) for i in range(3)] + [('empty', {'n_sentences': 0})])
+        self.assertEqual(self.sentences(), self.expected(3))
+
+    def test_apply_bulk_existing_document(self):
+        # A document persisted without sentences is parsed into its existing row
+        CorpusParser(parser=RegexParser()).apply(make_docs(2), progress_bar=False)
+        self.session.query(Context).filter(Context.stable_id.like('doc1::sentence:%'))\
+                                   .delete(synchronize_session=False)
+        self.session.commit()
+        CorpusParser(parser=RegexParser()).apply(make_docs(3), bulk=True, batch_size=3, clear=False,
+                                                 progress_bar=False)
+        self.assertEqual(self.sentences(), self.expected(3))
+        self.assertEqual(self.session.query(Document).count(), 3)
+
+
+class TestResumableParsing(SnorkelTestBase):
+
+    def setUp(self):
+        super(TestResumableParsing, self).setUp()
+        self.checkpoint_path = os.path.join(self.tmpdir, 'checkpoint')
+
+    def checkpoint(self):
+        with open(self.checkpoint_path) as f:
+            return int(f.read())
+
+    def document_names(self):
+        return sorted(set(s.document.name for s in self.session.query(Sentence).all()))
+
+    def run_interrupted(self, n, fail_on, **kwargs):
+        corpus_parser = CorpusParser(parser=FailingParser(fail_on=fail_on))
+        corpus_parser.udf_class = InterruptedUDF
+        with self.assertRaises(RuntimeError):
+            corpus_parser.apply(make_docs(n), progress_bar=False, **kwargs)
+
+        # Roll back the failed run's uncommitted writes, releasing its lock on the database
+        for udf in InterruptedUDF.instances:
+            udf.session.close()
+        del InterruptedUDF.instances[:]
+
+    def test_resume_from_checkpoint(self):
+        self.run_interrupted(10, 'doc7', commit_every=3, checkpoint_path=self.checkpoint_path)
+        self.assertEqual(self.checkpoint(), 6)
+        self.assertEqual(self.document_names(), ['doc%s' % i for i in range(6)])
+        self.session.close()
+
+        # The resumed run skips the checkpointed documents without looking them up
+        parser = FailingParser()
+        CorpusParser(parser=parser).apply(make_docs(10), clear=False, commit_every=3,
+                                          checkpoint_path=self.checkpoint_path, progress_bar=False)
+        self.assertEqual(parser.parsed, ['doc%s' % i for i in range(6, 10)])
+        self.assertEqual(self.checkpoint(), 10)
+        self.assertEqual(self.document_names(), sorted('doc%s' % i for i in range(10)))
+        self.assertEqual(self.session.query(Sentence).count(), 20)
+
+    def test_resume_without_checkpoint(self):
+        self.run_interrupted(6, 'doc4', commit_every=2)
+        self.assertEqual(self.document_names(), ['doc0', 'doc1', 'doc2', 'doc3'])
+        self.session.close()
+
+        # Documents which already have sentences are skipped
+        parser = FailingParser()
+        CorpusParser(parser=parser).apply(make_docs(6), clear=False, batch_size=4, progress_bar=False)
+        self.assertEqual(parser.parsed, ['doc4', 'doc5'])
+        self.assertEqual(self.session.query(Sentence).count(), 12)
+
+    def test_clear_resets_checkpoint(self):
+        CorpusParser(parser=RegexParser()).apply(make_docs(3), checkpoint_path=self.checkpoint_path,
+                                                 progress_bar=False)
+        self.assertEqual(self.checkpoint(), 3)
+
+        parser = FailingParser()
+        CorpusParser(parser=parser).apply(make_docs(2), checkpoint_path=self.checkpoint_path, progress_bar=False)
+        self.assertEqual(parser.parsed, ['doc0', 'doc1'])
+        self.assertEqual(self.checkpoint(), 2)
+        self.assertEqual(self.document_names(), ['doc0', 'doc1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
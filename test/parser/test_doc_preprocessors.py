@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import bz2
+import gc
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from snorkel.models import Document
+from snorkel.parser import CorpusParser, RegexParser
+from snorkel.parser.doc_preprocessors import (
+    HTMLDocPreprocessor, TextDocPreprocessor, TSVDocPreprocessor, XMLMultiDocPreprocessor
+)
+
+# The base class of the tests using a database is in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from snorkel_test_base import SnorkelTestBase
+
+
+def write_file(path, text):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def write_compressed(path, text):
+    open_file = gzip.GzipFile if path.endswith('.gz') else bz2.BZ2File
+    f = open_file(path, 'wb')
+    try:
+        f.write(text.encode('utf-8'))
+    finally:
+        f.close()
+    return path
+
+
+class FailingTextDocPreprocessor(TextDocPreprocessor):
+    """TextDocPreprocessor which fails on the file named fail.txt"""
+    def parse_file(self, fp, file_name):
+        if file_name == 'fail.txt':
+            raise ValueError("cannot parse %s" % file_name)
+        return super(FailingTextDocPreprocessor, self).parse_file(fp, file_name)
+
+
+class TestTSVDocPreprocessor(SnorkelTestBase):
+
+    def setUp(self):
+        super(TestTSVDocPreprocessor, self).setUp()
+        self.dir = self.tmpdir
+        self.path = write_file(os.path.join(self.dir, 'docs.tsv'),
+                               ''.join('doc%s\tText of document %s.\n' % (i, i) for i in range(5)))
+        self.checkpoint_dir = os.path.join(self.dir, 'checkpoints')
+
+    def test_positional_arguments(self):
+        # The arguments of DocPreprocessor keep their positions
+        docs = list(TSVDocPreprocessor(self.path, 'utf-8', 2))
+        self.assertEqual([doc.name for doc, _ in docs], ['doc0', 'doc1'])
+        self.assertEqual(docs[0][1], 'Text of document 0.\n')
+
+    def test_start_offset(self):
+        offset = len('doc0\tText of document 0.\n'.encode('utf-8'))
+        docs = list(TSVDocPreprocessor(self.path, start_offset=offset))
+        self.assertEqual([doc.name for doc, _ in docs], ['doc1', 'doc2', 'doc3', 'doc4'])
+
+    def test_checkpoint_saved_on_commit(self):
+        preprocessor = TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)
+        docs = preprocessor.generate()
+        next(docs), next(docs), next(docs)
+
+        # Reading documents does not save a checkpoint before they are committed
+        self.assertEqual([doc.name for doc, _ in TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)],
+                         ['doc0', 'doc1', 'doc2', 'doc3', 'doc4'])
+        preprocessor.commit_checkpoint(2)
+        self.assertEqual([doc.name for doc, _ in TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)],
+                         ['doc2', 'doc3', 'doc4'])
+        preprocessor.commit_checkpoint()
+        self.assertEqual([doc.name for doc, _ in TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)],
+                         ['doc3', 'doc4'])
+
+        preprocessor.reset_checkpoints()
+        self.assertEqual(len(list(TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir))), 5)
+
+    def test_checkpoint_parallelism(self):
+        with self.assertRaises(ValueError):
+            TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir, parallelism=2)
+
+    def test_corpus_parser_checkpoint(self):
+        def fail_on_doc3(parts):
+            if parts['document'].name == 'doc3':
+                raise RuntimeError("parse failed")
+            return parts
+
+        # Only the documents committed before the failure are skipped on resume
+        preprocessor = TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)
+        with self.assertRaises(RuntimeError):
+            CorpusParser(parser=RegexParser(), fn=fail_on_doc3).apply(preprocessor, commit_every=2,
+                                                                      progress_bar=False)
+        gc.collect()
+        preprocessor = TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)
+        self.assertEqual([doc.name for doc, _ in preprocessor], ['doc2', 'doc3', 'doc4'])
+
+        CorpusParser(parser=RegexParser()).apply(preprocessor, clear=False, progress_bar=False)
+        self.assertEqual(sorted(doc.name for doc in self.session.query(Document).all()),
+                         ['doc0', 'doc1', 'doc2', 'doc3', 'doc4'])
+        self.assertEqual(list(TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)), [])
+
+    def test_corpus_parser_checkpoint_path(self):
+        preprocessor = TSVDocPreprocessor(self.path, checkpoint_dir=self.checkpoint_dir)
+        with self.assertRaises(ValueError):
+            CorpusParser(parser=RegexParser()).apply(preprocessor, checkpoint_path=os.path.join(self.dir, 'ck'))
+
+
+class TestXMLMultiDocPreprocessor(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        docs = ''.join('<document><id>doc%s</id><text>Text %s</text></document>' % (i, i) for i in range(3))
+        self.path = write_file(os.path.join(self.dir, 'docs.xml'), '<root>%s</root>' % docs)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_positional_arguments(self):
+        # Positional arguments after keep_xml_tree still go to DocPreprocessor
+        docs = list(XMLMultiDocPreprocessor(self.path, './/document', './text/text()', './id/text()', False,
+                                            'utf-8', 2))
+        self.assertEqual([(doc.name, text) for doc, text in docs], [('doc0', 'Text 0'), ('doc1', 'Text 1')])
+
+    def test_iterparse(self):
+        docs = list(XMLMultiDocPreprocessor(self.path, iterparse=True))
+        self.assertEqual([(doc.name, text) for doc, text in docs],
+                         [('doc0', 'Text 0'), ('doc1', 'Text 1'), ('doc2', 'Text 2')])
+
+    def test_iterparse_doc_query(self):
+        with self.assertRaises(ValueError):
+            XMLMultiDocPreprocessor(self.path, doc='.//document[id]', iterparse=True)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for i in range(20):
+            write_file(os.path.join(self.dir, 'doc%02d.txt' % i), 'Text of document %s.' % i)
+        self.expected = [('doc%02d' % i, 'Text of document %s.' % i) for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def docs(self, preprocessor):
+        return sorted((doc.name, text) for doc, text in preprocessor)
+
+    def test_threads(self):
+        self.assertEqual(self.docs(TextDocPreprocessor(self.dir)), self.expected)
+        self.assertEqual(self.docs(TextDocPreprocessor(self.dir, parallelism=4)), self.expected)
+        self.assertEqual(self.docs(TextDocPreprocessor(self.dir, parallelism=4, max_queue_size=1)), self.expected)
+
+    def test_processes(self):
+        self.assertEqual(self.docs(TextDocPreprocessor(self.dir, parallelism=3, use_processes=True)),
+                         self.expected)
+
+    def test_max_docs(self):
+        for use_processes in [False, True]:
+            docs = list(TextDocPreprocessor(self.dir, max_docs=5, parallelism=3, use_processes=use_processes,
+                                            max_queue_size=2))
+            self.assertEqual(len(docs), 5)
+            self.assertEqual(len(set(doc.name for doc, _ in docs)), 5)
+
+    def test_close(self):
+        # Closing the generator early stops the workers blocked on the full queue
+        docs = TextDocPreprocessor(self.dir, parallelism=3, max_queue_size=1).generate()
+        next(docs)
+        docs.close()
+
+    def test_worker_error(self):
+        write_file(os.path.join(self.dir, 'fail.txt'), 'Not parsed.')
+        for use_processes in [False, True]:
+            with self.assertRaises(ValueError):
+                list(FailingTextDocPreprocessor(self.dir, parallelism=3, use_processes=use_processes))
+
+
+class TestCompressed(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tsv = ''.join('doc%s\tText of document %s.\n' % (i, i) for i in range(3))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tsv(self):
+        for ext in ['.gz', '.bz2']:
+            path = write_compressed(os.path.join(self.dir, 'docs.tsv' + ext), self.tsv)
+            docs = list(TSVDocPreprocessor(path))
+            self.assertEqual([(doc.name, text) for doc, text in docs],
+                             [('doc%s' % i, 'Text of document %s.\n' % i) for i in range(3)])
+            self.assertEqual(docs[0][0].meta, {'file_name': 'docs.tsv' + ext})
+
+    def test_tsv_checkpoint(self):
+        path = write_compressed(os.path.join(self.dir, 'docs.tsv.gz'), self.tsv)
+        checkpoint_dir = os.path.join(self.dir, 'checkpoints')
+        preprocessor = TSVDocPreprocessor(path, checkpoint_dir=checkpoint_dir)
+        docs = preprocessor.generate()
+        next(docs)
+        preprocessor.commit_checkpoint()
+        docs.close()
+        self.assertEqual([doc.name for doc, _ in TSVDocPreprocessor(path, checkpoint_dir=checkpoint_dir)],
+                         ['doc1', 'doc2'])
+
+    def test_text(self):
+        write_compressed(os.path.join(self.dir, 'a.txt.gz'), 'Text of a.')
+        write_compressed(os.path.join(self.dir, 'b.txt.bz2'), 'Text of b.')
+        write_file(os.path.join(self.dir, 'c.txt'), 'Text of c.')
+        docs = sorted((doc.name, text) for doc, text in TextDocPreprocessor(self.dir))
+        self.assertEqual(docs, [('a', 'Text of a.'), ('b', 'Text of b.'), ('c', 'Text of c.')])
+
+    def test_html_can_read(self):
+        preprocessor = HTMLDocPreprocessor(self.dir)
+        self.assertTrue(preprocessor._can_read('page.html.gz'))
+        self.assertTrue(preprocessor._can_read('page.html.bz2'))
+        self.assertFalse(preprocessor._can_read('notes.txt.gz'))
+        self.assertEqual(preprocessor._strip_compression('page.html.gz'), 'page.html')
+
+    def test_xml(self):
+        docs = ''.join('<document><id>doc%s</id><text>Text %s</text></document>' % (i, i) for i in range(2))
+        path = write_compressed(os.path.join(self.dir, 'docs.xml.bz2'), '<root>%s</root>' % docs)
+        for iterparse in [False, True]:
+            self.assertEqual([(doc.name, text) for doc, text in XMLMultiDocPreprocessor(path, iterparse=iterparse)],
+                             [('doc0', 'Text 0'), ('doc1', 'Text 1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
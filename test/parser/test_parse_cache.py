@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from snorkel.models import Document, Sentence
+from snorkel.parser import CorpusParser, ParseCache, RegexParser
+
+# The base class of the tests using a database is in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from snorkel_test_base import SnorkelTestBase
+
+
+class CountingParser(RegexParser):
+    """RegexParser which records the texts it parses"""
+    def __init__(self, *args, **kwargs):
+        super(CountingParser, self).__init__(*args, **kwargs)
+        self.texts = []
+
+    def parse(self, document, text):
+        self.texts.append(text)
+        return super(CountingParser, self).parse(document, text)
+
+
+def make_doc(name):
+    return Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ParseCache(os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_put(self):
+        parser, doc = RegexParser(), make_doc('doc')
+        text = 'One sentence. Another one.'
+        key = self.cache.key(parser, text)
+        self.assertIsNone(self.cache.get(key, doc))
+
+        sentences = list(parser.parse(doc, text))
+        self.cache.put(key, sentences)
+        other = make_doc('other')
+        cached = self.cache.get(key, other)
+        self.assertEqual([p['words'] for p in cached], [p['words'] for p in sentences])
+        # The parts are linked to the document they are loaded for
+        self.assertTrue(all(p['document'] is other for p in cached))
+        self.assertEqual([p['stable_id'] for p in cached], ['other::sentence:0:13', 'other::sentence:14:26'])
+
+    def test_key(self):
+        parser = RegexParser()
+        key = self.cache.key(parser, 'Some text.')
+        self.assertEqual(self.cache.key(RegexParser(), 'Some text.'), key)
+        self.assertNotEqual(self.cache.key(parser, 'Other text.'), key)
+        # Entries are invalidated by changes of the parser configuration
+        self.assertNotEqual(self.cache.key(RegexParser(token_rgx=r'\S+'), 'Some text.'), key)
+
+    def test_corrupt_entry(self):
+        key = self.cache.key(RegexParser(), 'Some text.')
+        self.cache.put(key, [])
+        with open(self.cache._file(key), 'wb') as f:
+            f.write(b'not zlib')
+        self.assertIsNone(self.cache.get(key, make_doc('doc')))
+
+
+class TestCorpusParserCache(SnorkelTestBase):
+
+    def setUp(self):
+        super(TestCorpusParserCache, self).setUp()
+        self.dir = os.path.join(self.tmpdir, 'cache')
+
+    def parse(self, texts, **kwargs):
+        parser = CountingParser()
+        docs = [(make_doc('doc%s' % i), text) for i, text in enumerate(texts)]
+        CorpusParser(parser=parser, cache_dir=self.dir).apply(docs, progress_bar=False, **kwargs)
+        sentences = sorted((s.document.name, s.position, s.text) for s in self.session.query(Sentence).all())
+        return parser.texts, sentences
+
+    def test_hits_and_misses(self):
+        texts = ['First doc. Two sentences.', 'Second doc.']
+        parsed, sentences = self.parse(texts)
+        self.assertEqual(parsed, texts)
+
+        # Cached documents are not parsed again, and give the same sentences
+        parsed, cached_sentences = self.parse(texts, batch_size=2)
+        self.assertEqual(parsed, [])
+        self.assertEqual(cached_sentences, sentences)
+
+        # A changed text is a miss
+        parsed, sentences = self.parse(['First doc. Two sentences.', 'Second doc, changed.'], batch_size=2)
+        self.assertEqual(parsed, ['Second doc, changed.'])
+        self.assertIn(('doc1', 0, 'Second doc, changed.'), sentences)
+
+    def test_batch_regrouping(self):
+        # Misses are regrouped by their position in the batch, including documents without sentences
+        texts = ['Cached text.', ' ', 'Doc two. More.', 'Doc three.']
+        self.parse(texts[:1])
+        parsed, sentences = self.parse(texts, batch_size=4)
+        self.assertEqual(parsed, texts[1:])
+        self.assertEqual(sentences, [('doc0', 0, 'Cached text.'), ('doc2', 0, 'Doc two.'), ('doc2', 1, 'More.'),
+                                     ('doc3', 0, 'Doc three.')])
+
+        # The document without sentences was cached as such
+        parsed, _ = self.parse(texts, batch_size=4)
+        self.assertEqual(parsed, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
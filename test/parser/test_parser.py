@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+
+from snorkel.parser.parser import Parser, ParserConnection, URLParserConnection
+
+try:
+    import snorkel.parser.spacy_parser as spacy_parser
+except ImportError:
+    spacy_parser = None
+
+
+class EchoParser(Parser):
+    """Yields one parts dict per document, recording the connection it was given"""
+    def __init__(self):
+        super(EchoParser, self).__init__(name='echo')
+        self.conns = []
+
+    def parse(self, document, text, conn=None):
+        self.conns.append(conn)
+        yield {'document': document, 'text': text}
+
+
+class TestParseBatch(unittest.TestCase):
+
+    batch = [('doc0', 'a'), ('doc1', 'b')]
+
+    def test_parse_batch(self):
+        parser = EchoParser()
+        parts = list(ParserConnection(parser).parse_batch(self.batch, batch_size=2, n_process=1))
+        self.assertEqual([(p['document'], p['text']) for p in parts], self.batch)
+        self.assertEqual(parser.conns, [None, None])
+
+    def test_url_parse_batch(self):
+        # Parsers reached through a URL connection are given the connection
+        parser = EchoParser()
+        conn = URLParserConnection(parser)
+        parts = list(conn.parse_batch(self.batch, batch_size=2))
+        self.assertEqual([(p['document'], p['text']) for p in parts], self.batch)
+        self.assertEqual(parser.conns, [conn, conn])
+
+    @unittest.skipIf(spacy_parser is None, "spaCy not installed")
+    def test_spacy_n_process_version(self):
+        parser = spacy_parser.Spacy.__new__(spacy_parser.Spacy)
+        version_info = spacy_parser.spacy_version_info
+        spacy_parser.spacy_version_info = (2, 1)
+        try:
+            with self.assertRaises(ValueError):
+                list(parser.parse_batch(self.batch, n_process=2))
+        finally:
+            spacy_parser.spacy_version_info = version_info
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import snorkel
+from snorkel.models import Document
+from snorkel.parser.regex_parser import RegexParser
+
+
+class TestRegexParser(unittest.TestCase):
+
+    def setUp(self):
+        self.document = Document(name='doc', stable_id='doc::document:0:0')
+
+    def test_parse(self):
+        text = 'Hello, world!  How are you?\nFine.'
+        parts = list(RegexParser().parse(self.document, text))
+        self.assertEqual([p['words'] for p in parts],
+                         [['Hello', ',', 'world', '!'], ['How', 'are', 'you', '?'], ['Fine', '.']])
+        self.assertEqual([p['position'] for p in parts], [0, 1, 2])
+        self.assertEqual([p['text'] for p in parts], ['Hello, world!', 'How are you?', 'Fine.'])
+        for p in parts:
+            self.assertEqual([text[i:i + len(w)] for i, w in zip(p['abs_char_offsets'], p['words'])], p['words'])
+            self.assertEqual([p['text'][i:i + len(w)] for i, w in zip(p['char_offsets'], p['words'])], p['words'])
+        self.assertEqual(parts[1]['stable_id'], 'doc::sentence:15:27')
+
+    def test_parse_empty(self):
+        self.assertEqual(list(RegexParser().parse(self.document, ' \n ')), [])
+
+    def test_parse_batch(self):
+        parser = RegexParser()
+        other = Document(name='other', stable_id='other::document:0:0')
+        batch = [(self.document, 'One. Two.'), (other, ''), (other, 'Three')]
+        parts = list(parser.connect().parse_batch(batch, batch_size=2, n_process=2))
+        self.assertEqual([(p['document'].name, p['text']) for p in parts],
+                         [('doc', 'One.'), ('doc', 'Two.'), ('other', 'Three')])
+
+    def test_import_without_spacy(self):
+        # Importing the parser package must not require spaCy, as RegexParser does not use it
+        code = ("import sys; sys.modules['spacy'] = None\n"
+                "from snorkel.parser import CorpusParser, RegexParser\n"
+                "assert 'Spacy' not in dir(sys.modules['snorkel.parser'])\n")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(snorkel.__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path))
+        cwd = tempfile.mkdtemp()
+        try:
+            subprocess.check_call([sys.executable, '-c', code], cwd=cwd, env=env)
+        finally:
+            shutil.rmtree(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import snorkel.models.meta as meta
+from snorkel.models.meta import SnorkelBase
+
+
+class SnorkelTestBase(unittest.TestCase):
+    """
+    Runs each test against a new SQLite database in a temporary directory, which the sessions of Snorkel's UDFs
+    and annotators (made with new_sessionmaker) use in place of the database set by SNORKELDB, so that tests
+    applying them with clear=True do not wipe it. Subclasses overriding setUp or tearDown must call them.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.conn_string = 'sqlite:///' + os.path.join(self.tmpdir, 'snorkel.db')
+        self.default_conn_string = meta.snorkel_conn_string
+        meta.snorkel_conn_string = self.conn_string
+        self.engine = meta.get_engine()
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = meta.new_sessionmaker()()
+
+    def tearDown(self):
+        self.session.close()
+        meta.snorkel_conn_string = self.default_conn_string
+        meta._engines.pop(self.conn_string).dispose()
+        shutil.rmtree(self.tmpdir)
@@ -0,0 +1,340 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import csv
+import io
+import unittest
+import numpy as np
+import scipy.sparse as sparse
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+
+import snorkel.annotations
+from snorkel.annotations import (
+    AnnotatorUDF, LabelAnnotator, csr_LabelMatrix, load_label_matrix, load_marginals, save_marginals
+)
+from snorkel.db_helpers import create_missing_indexes
+from snorkel.models import (
+    Candidate, Document, Label, LabelKey, Marginal, Sentence, Span, candidate_subclass, construct_stable_id
+)
+from snorkel.models.meta import SnorkelBase
+from snorkel_test_base import SnorkelTestBase
+
+AnnotatedPair = candidate_subclass('AnnotatedPair', ['a', 'b'])
+CategoricalPair = candidate_subclass('CategoricalPair', ['a', 'b'], cardinality=3)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def index_names(self, table_name):
+        return set(index['name'] for index in inspect(self.engine).get_indexes(table_name))
+
+    def test_indexes(self):
+        self.assertIn('ix_candidate_split', self.index_names('candidate'))
+        self.assertIn('ix_label_key_group', self.index_names('label_key'))
+        self.assertIn('ix_feature_key_group', self.index_names('feature_key'))
+        self.assertIn('ix_label_candidate_id_key_id', self.index_names('label'))
+        self.assertIn('ix_marginal_training', self.index_names('marginal'))
+
+    def test_create_missing_indexes(self):
+        self.session.execute(text("DROP INDEX ix_label_candidate_id_key_id"))
+        self.session.execute(text("DROP INDEX ix_label_key_group"))
+        self.session.commit()
+        self.assertEqual(sorted(create_missing_indexes(self.session)),
+                         ['ix_label_candidate_id_key_id', 'ix_label_key_group'])
+        self.assertIn('ix_label_candidate_id_key_id', self.index_names('label'))
+        self.assertEqual(create_missing_indexes(self.session), [])
+
+    def test_create_missing_indexes_missing_column(self):
+        self.session.execute(text("DROP TABLE marginal"))
+        self.session.execute(text("CREATE TABLE marginal (id INTEGER NOT NULL PRIMARY KEY, candidate_id INTEGER, "
+                                  "value INTEGER, probability FLOAT)"))
+        self.session.commit()
+        with self.assertRaises(ValueError):
+            create_missing_indexes(self.session)
+
+
+class TestLoadMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        # Candidates in splits 0 and 1, and label keys in groups 0 and 1
+        self.candidates = [AnnotatedPair(split=i % 2) for i in range(6)]
+        self.session.add_all(self.candidates)
+        self.keys = [LabelKey(name='lf%s' % i, group=i // 2) for i in range(4)]
+        self.session.add_all(self.keys)
+        self.session.flush()
+        for i, candidate in enumerate(self.candidates):
+            for j, key in enumerate(self.keys):
+                self.session.add(Label(candidate=candidate, key=key, value=1 if (i + j) % 2 else -1))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def expected(self, candidates, keys):
+        return [[1 if (self.candidates.index(c) + self.keys.index(k)) % 2 else -1 for k in keys] for c in candidates]
+
+    def test_load_split(self):
+        L = load_label_matrix(self.session, split=0)
+        self.assertEqual(L.shape, (3, 2))
+        self.assertEqual(L.todense().tolist(), self.expected(self.candidates[::2], self.keys[:2]))
+        self.assertEqual([L.get_candidate(self.session, i).id for i in range(3)],
+                         [c.id for c in self.candidates[::2]])
+
+    def test_load_key_group_and_names(self):
+        L = load_label_matrix(self.session, split=1, key_group=1, key_names=['lf3'])
+        self.assertEqual(L.todense().tolist(), self.expected(self.candidates[1::2], self.keys[3:]))
+
+    def test_load_cids_query(self):
+        cids_query = self.session.query(Candidate.id).filter(Candidate.id.in_([self.candidates[1].id,
+                                                                               self.candidates[2].id]))
+        L = load_label_matrix(self.session, cids_query=cids_query)
+        self.assertEqual(L.todense().tolist(), self.expected(self.candidates[1:3], self.keys[:2]))
+
+    def test_annotations_filtered_in_sql(self):
+        # Only the annotations of the split's candidates and the group's keys are read from the database
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().startswith('SELECT label.candidate_id'):
+                statements.append((statement, parameters))
+
+        event.listen(self.engine, 'before_cursor_execute', record)
+        try:
+            load_label_matrix(self.session, split=0)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(len(self.engine.execute(*statements[0]).fetchall()), 6)
+
+
+def add_sentence_candidates(session, name, split):
+    """Adds a Sentence with three Spans, and two AnnotatedPair candidates over them"""
+    text = 'Alice met Bob and Carol'
+    offsets = [0, 6, 10, 14, 18]
+    sentence = Sentence(document=Document(name=name, stable_id='%s::document:0:0' % name, meta={'source': name}),
+                        position=0, text=text, words=text.split(), char_offsets=offsets, abs_char_offsets=offsets,
+                        pos_tags=['NNP', 'VBD', 'NNP', 'CC', 'NNP'],
+                        stable_id='%s::sentence:0:%s' % (name, len(text) - 1))
+    spans = [Span(sentence=sentence, char_start=start, char_end=end,
+                  stable_id=construct_stable_id(sentence, 'span', start, end))
+             for start, end in [(0, 4), (10, 12), (18, 22)]]
+    candidates = [AnnotatedPair(a=spans[0], b=spans[1], split=split),
+                  AnnotatedPair(a=spans[0], b=spans[2], split=split)]
+    session.add_all(candidates)
+    session.commit()
+    return candidates
+
+
+def lf_words(c):
+    return 1 if c.a.sentence.words[c.a.get_word_end() + 1:c.b.get_word_start()] == ['met'] else -1
+
+
+def lf_pos_tags(c):
+    return 1 if c.b.sentence.pos_tags[c.b.get_word_start()] == 'NNP' else 0
+
+
+class TestSentenceColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.cids = [c.id for c in add_sentence_candidates(self.session, 'doc', 0)]
+        self.session.expunge_all()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def annotate(self, f_gen, **kwargs):
+        udf = AnnotatorUDF(annotation_class=Label, annotation_key_class=LabelKey, f_gen=f_gen)
+        udf.session.close()
+        udf.session = self.session
+        annotations = []
+        for cid in self.cids:
+            annotations.extend(udf.apply((cid,), **kwargs))
+            self.session.expunge_all()
+        return annotations
+
+    def test_load_only(self):
+        statements, unloaded = [], []
+
+        def f_gen(c):
+            event.listen(self.engine, 'before_cursor_execute', record)
+            try:
+                unloaded.append(set(inspect(c.a.sentence).unloaded))
+                yield 'lf_words', lf_words(c)
+                yield 'lf_pos_tags', lf_pos_tags(c)
+            finally:
+                event.remove(self.engine, 'before_cursor_execute', record)
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        annotations = self.annotate(f_gen, sentence_columns=['words', 'char_offsets'])
+        self.assertEqual(annotations, [(self.cids[0], 'lf_words', 1), (self.cids[0], 'lf_pos_tags', 1),
+                                       (self.cids[1], 'lf_words', -1), (self.cids[1], 'lf_pos_tags', 1)])
+
+        # The arguments and their sentence are loaded up front, with only the requested columns; any other column
+        # is loaded when it is first read
+        self.assertIn('pos_tags', unloaded[0])
+        self.assertIn('lemmas', unloaded[0])
+        self.assertNotIn('words', unloaded[0])
+        self.assertNotIn('char_offsets', unloaded[0])
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all('pos_tags' in statement for statement in statements))
+
+    def test_same_annotations(self):
+        def f_gen(c):
+            yield 'lf_words', lf_words(c)
+            yield 'lf_pos_tags', lf_pos_tags(c)
+        self.assertEqual(self.annotate(f_gen, sentence_columns=['words', 'pos_tags']), self.annotate(f_gen))
+
+    def test_document_meta_deferred(self):
+        document = self.session.query(Document).one()
+        self.assertIn('meta', inspect(document).unloaded)
+        self.assertEqual(document.meta, {'source': 'doc'})
+
+
+class TestLabelAnnotator(SnorkelTestBase):
+
+    def setUp(self):
+        super(TestLabelAnnotator, self).setUp()
+        self.candidates = add_sentence_candidates(self.session, 'annotated', 0)
+
+    def test_sentence_columns(self):
+        labeler = LabelAnnotator(lfs=[lf_words, lf_pos_tags])
+        L = labeler.apply(split=0, progress_bar=False)
+        L_projected = labeler.apply(split=0, sentence_columns=['words'], progress_bar=False)
+        self.assertEqual(L_projected.todense().tolist(), L.todense().tolist())
+        self.assertEqual(L.todense().tolist(), [[1, 1], [-1, 1]])
+
+
+class CopyCursor(object):
+    """Stands in for a Postgres cursor, inserting the rows of a CSV COPY ... FROM STDIN into the session"""
+    def __init__(self, session, copies):
+        self.session = session
+        self.copies  = copies
+
+    def copy_expert(self, sql, f):
+        self.copies.append(sql)
+        rows = [{'candidate_id': int(cid), 'value': int(k), 'probability': float(p), 'training': training == 'true'}
+                for cid, k, p, training in csv.reader(io.StringIO(f.read()))]
+        self.session.execute(Marginal.__table__.insert(), rows)
+
+
+class CopyConnection(object):
+    """Stands in for both a session's Connection and its raw Postgres connection"""
+    def __init__(self, session, copies):
+        self.connection = self
+        self.session    = session
+        self.copies     = copies
+
+    def cursor(self):
+        return CopyCursor(self.session, self.copies)
+
+
+class CopySession(object):
+    """Wraps a session, giving it a connection whose cursors support copy_expert"""
+    def __init__(self, session):
+        self.session = session
+        self.copies  = []
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def connection(self):
+        return CopyConnection(self.session, self.copies)
+
+
+class TestMarginals(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.binary = [AnnotatedPair(split=0) for _ in range(5)]
+        self.categorical = [CategoricalPair(split=1) for _ in range(4)]
+        self.session.add_all(self.binary + self.categorical)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def label_matrix(self, candidates):
+        # Rows in reverse candidate id order
+        cids = [c.id for c in reversed(candidates)]
+        return csr_LabelMatrix(sparse.csr_matrix((len(cids), 1)), candidate_index=dict((cid, i) for i, cid in
+                               enumerate(cids)), row_index=dict(enumerate(cids)))
+
+    def test_binary(self):
+        marginals = np.array([0.9, 0.0, 0.25, 1.0, 0.5])
+        save_marginals(self.session, self.binary, marginals, chunk_size=2)
+        self.assertEqual(self.session.query(Marginal).count(), 4)
+        np.testing.assert_array_equal(load_marginals(self.session, split=0), marginals)
+        np.testing.assert_array_equal(load_marginals(self.session, X=self.binary[::-1]), marginals[::-1])
+
+        # Marginals saved for a matrix are stored by the candidate ids of its rows
+        save_marginals(self.session, self.label_matrix(self.binary), marginals, training=False)
+        np.testing.assert_array_equal(load_marginals(self.session, split=0, training=False), marginals[::-1])
+        np.testing.assert_array_equal(load_marginals(self.session, X=self.label_matrix(self.binary), training=False),
+                                      marginals)
+        np.testing.assert_array_equal(load_marginals(self.session, split=0), marginals)
+
+    def test_categorical(self):
+        marginals = np.array([[0.2, 0.3, 0.5], [1.0, 0.0, 0.0], [0.0, 0.25, 0.75], [0.5, 0.5, 0.0]])
+        save_marginals(self.session, self.categorical, marginals)
+        self.assertEqual(self.session.query(Marginal).count(), 5)
+        np.testing.assert_allclose(load_marginals(self.session, split=1), marginals)
+        np.testing.assert_allclose(load_marginals(self.session, X=self.label_matrix(self.categorical), split=1),
+                                   marginals[::-1])
+
+    def test_replace(self):
+        save_marginals(self.session, self.binary, [0.5] * 5)
+        save_marginals(self.session, self.binary, [0.1, 0.2, 0.3, 0.4, 0.6])
+        self.assertEqual(self.session.query(Marginal).count(), 5)
+        np.testing.assert_allclose(load_marginals(self.session, split=0), [0.1, 0.2, 0.3, 0.4, 0.6])
+
+    def test_candidate_missing_from_x(self):
+        save_marginals(self.session, self.binary, [0.5] * 5)
+        with self.assertRaises(KeyError):
+            load_marginals(self.session, X=self.binary[:3])
+
+    def test_copy(self):
+        marginals = np.array([0.9, 0.0, 1.0 / 3, 1.0, 0.5])
+        session = CopySession(self.session)
+        postgres = snorkel.annotations.snorkel_postgres
+        snorkel.annotations.snorkel_postgres = True
+        try:
+            save_marginals(session, self.binary, marginals, chunk_size=3)
+        finally:
+            snorkel.annotations.snorkel_postgres = postgres
+        self.assertEqual(len(session.copies), 2)
+        self.assertTrue(all(sql.startswith('COPY marginal (candidate_id, value, probability, training)')
+                            for sql in session.copies))
+        self.assertEqual(self.session.query(Marginal).filter(Marginal.training == True).count(), 4)
+        np.testing.assert_array_equal(load_marginals(self.session, split=0), marginals)
+
+
+if __name__ == '__main__':
+    unittest.main()
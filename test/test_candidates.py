@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+
+from snorkel.candidates import CandidateExtractor, CandidateExtractorUDF, Ngrams
+from snorkel.matchers import DictionaryMatch
+from snorkel.models import Context, Document, Sentence, Span, candidate_subclass
+from snorkel.parser import CorpusParser, RegexParser
+from snorkel_test_base import SnorkelTestBase
+
+ExtractionPair = candidate_subclass('ExtractionPair', ['a', 'b'])
+
+TEXTS = [
+    'Alice met Bob in Paris. Carol stayed home.',
+    'Carol called Alice. Bob and Carol and Alice talked.',
+    'Nobody was there.',
+]
+
+
+class TestCandidateExtractor(SnorkelTestBase):
+
+    def setUp(self):
+        super(TestCandidateExtractor, self).setUp()
+        docs = [(Document(name='doc%s' % i, stable_id='doc%s::document:0:0' % i, meta={}), text)
+                for i, text in enumerate(TEXTS)]
+        CorpusParser(parser=RegexParser()).apply(docs, progress_bar=False)
+        self.clear_spans()
+
+        ngrams = Ngrams(n_max=1)
+        matcher = DictionaryMatch(d=['alice', 'bob', 'carol'])
+        self.extractor = CandidateExtractor(ExtractionPair, [ngrams, ngrams], [matcher, matcher])
+
+    def clear_spans(self):
+        # Deleting the context rows cascades to the spans and their candidates
+        self.session.query(Context).filter(Context.type == 'span').delete(synchronize_session=False)
+        self.session.commit()
+
+    def sentences(self):
+        return self.session.query(Sentence).order_by(Sentence.id).all()
+
+    def candidates(self):
+        # Candidate and context ids may be reused after a clear, so do not read through cached objects
+        self.session.expunge_all()
+        return sorted((c.a.sentence.document.name, c.a.sentence.position, c.a.get_span(), c.b.get_span())
+                      for c in self.session.query(ExtractionPair).all())
+
+    def test_by_document(self):
+        self.extractor.apply(self.sentences(), split=0, progress_bar=False)
+        expected = self.candidates()
+        self.assertEqual(expected, [('doc0', 0, 'Alice', 'Bob'), ('doc1', 0, 'Carol', 'Alice'),
+                                    ('doc1', 1, 'Bob', 'Alice'), ('doc1', 1, 'Bob', 'Carol'),
+                                    ('doc1', 1, 'Carol', 'Alice')])
+
+        self.clear_spans()
+        self.extractor.apply(self.sentences(), split=0, by_document=True, document_batch_size=2, progress_bar=False)
+        self.assertEqual(self.candidates(), expected)
+        self.assertEqual(self.session.query(Span).count(), 8)
+
+    def test_by_document_existing(self):
+        self.extractor.apply(self.sentences(), split=0, by_document=True, progress_bar=False)
+        candidates = self.candidates()
+        n_spans = self.session.query(Span).count()
+
+        # Existing contexts and candidates are reused rather than inserted again
+        self.extractor.apply(self.sentences(), split=0, by_document=True, clear=False, progress_bar=False)
+        self.assertEqual(self.candidates(), candidates)
+        self.assertEqual(self.session.query(Span).count(), n_spans)
+        self.assertEqual(self.session.query(ExtractionPair).count(), len(candidates))
+
+        # Candidates extracted one context at a time over the same spans are found as well
+        self.extractor.apply(self.sentences(), split=0, clear=False, progress_bar=False)
+        self.assertEqual(self.session.query(ExtractionPair).count(), len(candidates))
+        self.assertEqual(self.session.query(Span).count(), n_spans)
+
+    def test_compile_matchers(self):
+        self.extractor.apply(self.sentences(), split=0, progress_bar=False)
+        expected = self.candidates()
+
+        ngrams = Ngrams(n_max=1)
+        matcher = DictionaryMatch(d=['alice', 'bob', 'carol'])
+        extractor = CandidateExtractor(ExtractionPair, [ngrams, ngrams], [matcher, matcher], compile_matchers=True)
+        self.clear_spans()
+        extractor.apply(self.sentences(), split=0, progress_bar=False)
+        self.assertEqual(self.candidates(), expected)
+
+    def test_compiled_matcher_changes(self):
+        matcher = DictionaryMatch(d=['alice', 'bob', 'carol'])
+        udf = CandidateExtractorUDF(ExtractionPair, [Ngrams(n_max=1)] * 2, [matcher, matcher], self_relations=False,
+                                    nested_relations=False, symmetric_relations=False, compile_matchers=True)
+        self.assertEqual(len(udf.plans), 1)
+        sentence = self.sentences()[0]
+
+        # A matcher changed after compiling is prefiltered with its new settings
+        matcher.reverse = True
+        udf._refresh_plans()
+        self.assertEqual(sorted(tc.get_span() for tc in udf._get_child_contexts(0, sentence)),
+                         sorted(tc.get_span() for tc in matcher.apply(Ngrams(n_max=1).apply(sentence))))
+        udf.session.close()
+
+    def test_batch_by_document(self):
+        sentences = self.sentences()
+        batches = self.extractor._batch_by_document(list(reversed(sentences)), 2)
+        self.assertEqual([sorted(s.document.name for s in batch) for batch in batches],
+                         [['doc0', 'doc0', 'doc1', 'doc1'], ['doc2']])
+        self.assertEqual(sorted(s.id for batch in batches for s in batch), [s.id for s in sentences])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse as sparse
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from snorkel.annotations import csr_AnnotationMatrix, csr_LabelMatrix
+from snorkel.models import Document, FeatureKey, LabelKey, Sentence, Span, candidate_subclass, construct_stable_id
+from snorkel.models.meta import SnorkelBase
+
+try:
+    from snorkel.columnar import export_candidates, export_matrix, import_candidates, import_matrix
+except ImportError:
+    export_candidates = None
+
+ColumnarPair = candidate_subclass('ColumnarPair', ['a', 'b'])
+
+
+@unittest.skipIf(export_candidates is None, "pyarrow not installed")
+class TestColumnar(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.tmpdir = tempfile.mkdtemp()
+
+        text = 'Alice met Bob and Carol'
+        document = Document(name='doc', stable_id='doc::document:0:0')
+        offsets = [0, 6, 10, 14, 18]
+        self.sentence = Sentence(document=document, position=0, text=text, words=text.split(),
+                                 char_offsets=offsets, abs_char_offsets=offsets, lemmas=text.lower().split(),
+                                 stable_id='doc::sentence:0:%s' % (len(text) - 1))
+        spans = [self.add_span(start, end) for start, end in [(0, 4), (10, 12), (18, 22)]]
+        self.candidates = [ColumnarPair(a=spans[0], b=spans[1], split=0),
+                           ColumnarPair(a=spans[0], b=spans[2], split=0),
+                           ColumnarPair(a=spans[1], b=spans[2], split=1)]
+        self.session.add_all(self.candidates)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def add_span(self, start, end):
+        span = Span(sentence=self.sentence, char_start=start, char_end=end,
+                    stable_id=construct_stable_id(self.sentence, 'span', start, end))
+        self.session.add(span)
+        return span
+
+    def test_candidates(self):
+        path = os.path.join(self.tmpdir, 'candidates.parquet')
+        self.assertEqual(export_candidates(self.session, ColumnarPair, path, split=0, chunk_size=1), 2)
+
+        table = import_candidates(path)
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(table.column('id').to_pylist(), [c.id for c in self.candidates[:2]])
+        self.assertEqual(table.column('split').to_pylist(), [0, 0])
+        self.assertEqual(table.column('a_char_start').to_pylist(), [0, 0])
+        self.assertEqual(table.column('b_char_end').to_pylist(), [12, 22])
+        self.assertEqual(table.column('b_sentence_id').to_pylist(), [self.sentence.id] * 2)
+        self.assertEqual(table.column('sentence_words').to_pylist(), [self.sentence.words] * 2)
+        self.assertEqual(table.column('sentence_char_offsets').to_pylist(), [self.sentence.char_offsets] * 2)
+        self.assertEqual(table.column('sentence_text').to_pylist(), [self.sentence.text] * 2)
+
+    def test_candidates_columns(self):
+        path = os.path.join(self.tmpdir, 'candidates.parquet')
+        export_candidates(self.session, ColumnarPair, path, split=1, sentence_columns=['words'])
+        names = import_candidates(path).schema.names
+        self.assertIn('sentence_words', names)
+        self.assertNotIn('sentence_text', names)
+        self.assertNotIn('sentence_lemmas', names)
+
+        table = import_candidates(path, columns=['id', 'a_char_start'])
+        self.assertEqual(table.schema.names, ['id', 'a_char_start'])
+        self.assertEqual(table.column('id').to_pylist(), [self.candidates[2].id])
+        self.assertEqual(table.column('a_char_start').to_pylist(), [10])
+
+    def add_keys(self, key_cls, names):
+        keys = [key_cls(name=name, group=0) for name in names]
+        self.session.add_all(keys)
+        self.session.commit()
+        return keys
+
+    def make_matrix(self, matrix_class, key_cls, keys, X):
+        # Rows and columns in a different order than the candidate and key ids
+        candidate_ids = [c.id for c in reversed(self.candidates)]
+        key_ids = [k.id for k in reversed(keys)]
+        return matrix_class(X,
+                            candidate_index=dict((cid, i) for i, cid in enumerate(candidate_ids)),
+                            row_index=dict(enumerate(candidate_ids)),
+                            annotation_key_cls=key_cls,
+                            key_index=dict((kid, j) for j, kid in enumerate(key_ids)),
+                            col_index=dict(enumerate(key_ids)))
+
+    def assert_round_trip(self, X, Y):
+        self.assertEqual(type(Y), type(X))
+        self.assertEqual(Y.shape, X.shape)
+        np.testing.assert_array_equal(Y.toarray(), X.toarray())
+        self.assertEqual(Y.row_index, X.row_index)
+        self.assertEqual(Y.candidate_index, X.candidate_index)
+        self.assertEqual(Y.col_index, X.col_index)
+        self.assertEqual(Y.key_index, X.key_index)
+        self.assertIs(Y.annotation_key_cls, X.annotation_key_cls)
+
+    def test_label_matrix(self):
+        keys = self.add_keys(LabelKey, ['LF_a', 'LF_b'])
+        X = self.make_matrix(csr_LabelMatrix, LabelKey, keys,
+                             sparse.csr_matrix(np.array([[1, 0], [0, -1], [-1, 1]])))
+        path = os.path.join(self.tmpdir, 'L.parquet')
+        export_matrix(self.session, X, path)
+        self.assert_round_trip(X, import_matrix(path))
+
+    def test_feature_matrix(self):
+        keys = self.add_keys(FeatureKey, ['f0', 'f1', 'f2'])
+        X = self.make_matrix(csr_AnnotationMatrix, FeatureKey, keys,
+                             sparse.csr_matrix(np.array([[0.5, 0, 0], [0, 0, 0], [0, 2.0, -1.5]])))
+        path = os.path.join(self.tmpdir, 'F.parquet')
+        export_matrix(self.session, X, path)
+        Y = import_matrix(path)
+        self.assert_round_trip(X, Y)
+        self.assertEqual(Y.dtype, np.float64)
+
+    def test_empty_matrix(self):
+        X = csr_LabelMatrix(sparse.csr_matrix((0, 0), dtype=np.int64), candidate_index={}, row_index={},
+                            annotation_key_cls=LabelKey, key_index={}, col_index={})
+        path = os.path.join(self.tmpdir, 'L.parquet')
+        export_matrix(self.session, X, path)
+        self.assert_round_trip(X, import_matrix(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
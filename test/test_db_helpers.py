@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import snorkel.db_helpers as db_helpers
+from snorkel.db_helpers import IdAllocator, reload_annotator_labels
+from snorkel.models import (
+    Candidate, Context, Document, GoldLabel, Sentence, Span, StableLabel, candidate_subclass, construct_stable_id
+)
+from snorkel.models.meta import SnorkelBase
+
+ReloadPair = candidate_subclass('ReloadPair', ['a', 'b'])
+
+
+class TestReloadAnnotatorLabels(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        text = 'Alice met Bob and Carol'
+        document = Document(name='doc', stable_id='doc::document:0:0')
+        offsets = [0, 6, 10, 14, 18]
+        self.sentence = Sentence(document=document, position=0, text=text, words=text.split(),
+                                 char_offsets=offsets, abs_char_offsets=offsets,
+                                 stable_id='doc::sentence:0:%s' % (len(text) - 1))
+        self.spans = [self.add_span(start, end) for start, end in [(0, 4), (10, 12), (18, 22)]]
+        self.session.add(ReloadPair(a=self.spans[0], b=self.spans[1], split=0))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def add_span(self, start, end):
+        span = Span(sentence=self.sentence, char_start=start, char_end=end,
+                    stable_id=construct_stable_id(self.sentence, 'span', start, end))
+        self.session.add(span)
+        return span
+
+    def add_label(self, a, b, value, suffix=''):
+        stable_ids = '~~'.join([a.stable_id, b.stable_id]) + suffix
+        self.session.add(StableLabel(context_stable_ids=stable_ids, annotator_name='gold', split=0, value=value))
+        self.session.commit()
+
+    def gold_labels(self):
+        return sorted((label.candidate.a.char_start, label.candidate.b.char_start, label.value)
+                      for label in self.session.query(GoldLabel).all())
+
+    def test_reload(self):
+        self.add_label(self.spans[0], self.spans[1], 1)
+        self.add_label(self.spans[0], self.spans[2], -1)
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0)
+        self.assertEqual(self.gold_labels(), [(0, 10, 1)])
+
+        # Labels are only loaded once
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0)
+        self.assertEqual(self.session.query(GoldLabel).count(), 1)
+
+    def test_reload_create_missing_cands(self):
+        self.add_label(self.spans[0], self.spans[1], 1)
+        self.add_label(self.spans[0], self.spans[2], -1)
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0, create_missing_cands=True)
+        self.assertEqual(self.gold_labels(), [(0, 10, 1), (0, 18, -1)])
+        self.assertEqual(self.session.query(ReloadPair).count(), 2)
+        self.assertEqual(self.session.query(Candidate).filter(Candidate.split == 0).count(), 2)
+
+    def test_reload_duplicate_labels(self):
+        # Both labels resolve to the same candidate, which gets a single GoldLabel
+        self.add_label(self.spans[0], self.spans[2], 1)
+        self.add_label(self.spans[0], self.spans[2], -1, suffix='~~extra')
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0, create_missing_cands=True)
+        self.assertEqual(self.gold_labels(), [(0, 18, -1)])
+
+    def test_reload_contexts_without_key(self):
+        self.session.execute(Context.__table__.update().values(stable_doc_id=None, stable_type=None,
+                                                               stable_start=None, stable_end=None))
+        self.session.commit()
+        self.add_label(self.spans[0], self.spans[1], 1)
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0)
+        self.assertEqual(self.gold_labels(), [(0, 10, 1)])
+
+    def test_reload_some_contexts_without_key(self):
+        # Each argument is looked up by its key, or else by its stable id
+        context = Context.__table__
+        self.session.execute(context.update().where(context.c.id == self.spans[1].id)
+                             .values(stable_doc_id=None, stable_type=None, stable_start=None, stable_end=None))
+        self.session.commit()
+        self.add_label(self.spans[0], self.spans[1], 1)
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0)
+        self.assertEqual(self.gold_labels(), [(0, 10, 1)])
+
+    def test_reload_error(self):
+        class FailingIdAllocator(db_helpers.IdAllocator):
+            def next_ids(self, n):
+                raise RuntimeError("no ids")
+
+        self.add_label(self.spans[0], self.spans[2], 1)
+        IdAllocator = db_helpers.IdAllocator
+        db_helpers.IdAllocator = FailingIdAllocator
+        try:
+            with self.assertRaises(RuntimeError):
+                reload_annotator_labels(self.session, ReloadPair, 'gold', split=0, create_missing_cands=True)
+        finally:
+            db_helpers.IdAllocator = IdAllocator
+
+        # The temporary table left over by the failed call does not prevent reloading
+        reload_annotator_labels(self.session, ReloadPair, 'gold', split=0, create_missing_cands=True)
+        self.assertEqual(self.gold_labels(), [(0, 18, 1)])
+
+
+class TestIdAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        SnorkelBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def add_document(self, id):
+        self.session.add(Document(id=id, name='doc%s' % id, stable_id='doc%s::document:0:0' % id))
+        self.session.commit()
+
+    def test_empty_table(self):
+        ids = IdAllocator(self.session, Context.__table__, block_size=4)
+        self.assertEqual(ids.next_ids(0), [])
+        self.assertEqual(ids.next_ids(3), [1, 2, 3])
+        self.assertEqual(ids.next_ids(6), [4, 5, 6, 7, 8, 9])
+
+    def test_blocks(self):
+        self.add_document(5)
+        ids = IdAllocator(self.session, Context.__table__, block_size=3)
+        self.assertEqual(ids.next_ids(1), [6])
+
+        # Ids left in the reserved block are handed out first; new blocks start above the largest id in the table
+        # and above the ids already reserved
+        self.add_document(100)
+        self.assertEqual(ids.next_ids(4), [7, 8, 101, 102])
+        self.assertEqual(ids.next_ids(1), [103])
+        self.session.execute(Context.__table__.delete().where(Context.__table__.c.id == 100))
+        self.assertEqual(ids.next_ids(2), [104, 105])
+
+    def test_bulk_insert(self):
+        self.add_document(1)
+        ids = IdAllocator(self.session, Context.__table__)
+        rows = [{'id': id, 'type': 'document', 'stable_id': 'd%s' % id} for id in ids.next_ids(3)]
+        self.session.execute(Context.__table__.insert(), rows)
+        self.session.commit()
+        self.assertEqual(sorted(row[0] for row in self.session.execute(Context.__table__.select())), [1, 2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
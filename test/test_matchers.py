@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import random
+import unittest
+
+from snorkel.candidates import Ngrams
+from snorkel.matchers import (
+    CompiledMatcher, Concat, DictionaryMatch, LambdaFunctionMatcher, Matcher, NgramMatcher, RegexMatchSpan,
+    SeenIntervals, SeenSpans, SlotFillMatch, Union
+)
+from snorkel.models import Sentence, TemporarySpan
+
+
+def make_sentence(text, id=0):
+    words = text.split()
+    offsets, start = [], 0
+    for w in words:
+        start = text.index(w, start)
+        offsets.append(start)
+        start += len(w)
+    return Sentence(id=id, position=0, text=text, words=words, char_offsets=offsets, abs_char_offsets=offsets,
+                    stable_id='doc::sentence:0:%s' % (len(text) - 1))
+
+
+def spans(matched):
+    return [(c.char_start, c.char_end) for c in matched]
+
+
+class TestPrefilter(unittest.TestCase):
+
+    sentence = make_sentence('the dog ran to New York City and then Los Angeles')
+
+    def test_dictionary_prefilter(self):
+        ngrams = Ngrams(n_max=3)
+        matcher = DictionaryMatch(d=['new york', 'los angeles'])
+        starts, ends = ngrams.get_char_offsets(self.sentence)
+        mask = matcher.prefilter(self.sentence, starts, ends)
+        self.assertIsNotNone(mask)
+        self.assertLess(mask.sum(), len(mask))
+        self.assertEqual(spans(matcher.apply(ngrams.apply_prefiltered(self.sentence, matcher))),
+                         spans(matcher.apply(ngrams.apply(self.sentence))))
+
+    def test_dictionary_prefilter_overridden_f(self):
+        # A subclass with its own _f may accept spans of any length, so they cannot be prefiltered
+        class PrefixMatch(DictionaryMatch):
+            def _f(self, c):
+                return any(c.get_span().lower().startswith(w) for w in self.d)
+
+        ngrams = Ngrams(n_max=3)
+        matcher = PrefixMatch(d=['new york', 'los angeles'])
+        starts, ends = ngrams.get_char_offsets(self.sentence)
+        self.assertIsNone(matcher.prefilter(self.sentence, starts, ends))
+        self.assertEqual(spans(matcher.apply(ngrams.apply_prefiltered(self.sentence, matcher))),
+                         [(15, 27), (38, 48)])
+
+
+class TestCompiledMatcher(unittest.TestCase):
+
+    sentence = make_sentence('the dog ran to New York City and then Los Angeles with John Smith and Mary Jane Doe')
+
+    def matchers(self):
+        places = DictionaryMatch(d=['new york', 'los angeles', 'john', 'smith', 'mary', 'jane', 'doe', 'city'])
+        capitalized = RegexMatchSpan(rgx='[A-Z][a-z]+')
+        either = Union(places, capitalized)
+        return [
+            places,
+            either,
+            Concat(either, Concat(either, capitalized, left_required=False), ignore_sep=False),
+            SlotFillMatch(either, capitalized, pattern='{0} and {1}'),
+            Concat(capitalized, capitalized, permutations=True),
+        ]
+
+    def test_compile(self):
+        for matcher in self.matchers():
+            compiled = matcher.compile()
+            self.assertIsInstance(compiled, CompiledMatcher)
+            for longest_match_only in [True, False]:
+                matcher.longest_match_only = longest_match_only
+                self.assertEqual(spans(compiled.apply(Ngrams(n_max=6).apply(self.sentence))),
+                                 spans(matcher.apply(Ngrams(n_max=6).apply(self.sentence))))
+
+    def test_shared_subtree_memo(self):
+        # A shared subtree is compiled once, and evaluates each span of the sentence once
+        calls = []
+        counted = LambdaFunctionMatcher(func=lambda c: calls.append((c.char_start, c.char_end)) or c.get_span().istitle())
+        matcher = Union(Concat(counted, counted), counted)
+        compiled = matcher.compile()
+        self.assertIs(compiled.matcher.children[1], compiled.matcher.children[0].matcher.children[0])
+
+        expected = spans(matcher.apply(Ngrams(n_max=3).apply(self.sentence)))
+        n_calls = len(calls)
+        del calls[:]
+        self.assertEqual(spans(compiled.apply(Ngrams(n_max=3).apply(self.sentence))), expected)
+        self.assertEqual(len(calls), len(set(calls)))
+        self.assertLess(len(calls), n_calls)
+
+    def test_f_slice(self):
+        candidates = list(Ngrams(n_max=3).apply(self.sentence))
+        matcher = RegexMatchSpan(rgx='[A-Z][a-z]+ [A-Z][a-z]+')
+        compiled = matcher.compile()
+        for c in candidates:
+            for start, stop in [(None, None), (None, 4), (4, None)]:
+                expected = matcher.f(c[start:stop])
+                self.assertEqual(matcher._f_slice(c, start, stop), expected)
+                self.assertEqual(compiled._f_slice(c, start, stop), expected)
+
+    def test_overridden_apply(self):
+        class ReversedMatcher(DictionaryMatch):
+            def apply(self, candidates):
+                return reversed(list(super(ReversedMatcher, self).apply(candidates)))
+
+        matcher = ReversedMatcher(d=['new york', 'los angeles'])
+        self.assertIs(matcher.compile(), matcher)
+        # Only the root's apply is used, so children are still compiled
+        self.assertIsInstance(Union(matcher).compile(), CompiledMatcher)
+
+    def test_later_changes(self):
+        places = DictionaryMatch(d=['new york city', 'los angeles'])
+        matcher = Union(places)
+        compiled = matcher.compile()
+        self.assertEqual(spans(compiled.apply(Ngrams(n_max=3).apply(self.sentence))), [(15, 27), (38, 48)])
+
+        # Changes to the original tree after compiling are picked up
+        places.reverse = True
+        matcher.longest_match_only = False
+        self.assertEqual(spans(compiled.apply(Ngrams(n_max=3).apply(self.sentence))),
+                         spans(matcher.apply(Ngrams(n_max=3).apply(self.sentence))))
+        matcher.children = (RegexMatchSpan(rgx='Mary'),)
+        self.assertEqual(spans(compiled.apply(Ngrams(n_max=3).apply(self.sentence))), [(70, 73)])
+
+
+class TestSeenIntervals(unittest.TestCase):
+
+    sentence = make_sentence('the dog ran to New York City and then Los Angeles')
+
+    def span(self, start, end):
+        return TemporarySpan(self.sentence, start, end)
+
+    def test_contains(self):
+        seen = SeenIntervals()
+        self.assertFalse(seen.contains(self.span(0, 2)))
+        seen.add(self.span(4, 10))
+        seen.add(self.span(20, 30))
+        self.assertTrue(seen.contains(self.span(4, 10)))
+        self.assertTrue(seen.contains(self.span(5, 9)))
+        self.assertTrue(seen.contains(self.span(20, 25)))
+        self.assertFalse(seen.contains(self.span(3, 5)))
+        self.assertFalse(seen.contains(self.span(9, 11)))
+        self.assertFalse(seen.contains(self.span(11, 19)))
+        self.assertFalse(seen.contains(self.span(25, 31)))
+
+    def test_nested_intervals_dropped(self):
+        seen = SeenIntervals()
+        for start, end in [(10, 12), (14, 16), (30, 35), (11, 12), (9, 20), (0, 1)]:
+            seen.add(self.span(start, end))
+        self.assertEqual(list(zip(seen.starts, seen.ends)), [(0, 1), (9, 20), (30, 35)])
+
+    def test_random(self):
+        # Agrees with testing against every seen span, and keeps the intervals sorted by both start and end
+        rng = random.Random(0)
+        for _ in range(50):
+            seen, seen_spans = SeenIntervals(), SeenSpans(NgramMatcher())
+            for _ in range(100):
+                start = rng.randint(0, 50)
+                c = self.span(start, start + rng.randint(0, 10))
+                self.assertEqual(seen.contains(c), seen_spans.contains(c))
+                if rng.random() < 0.3:
+                    seen.add(c)
+                    seen_spans.add(c)
+            self.assertEqual(seen.starts, sorted(seen.starts))
+            self.assertEqual(seen.ends, sorted(seen.ends))
+            self.assertEqual(len(set(seen.starts)), len(seen.starts))
+
+    def test_longest_match_only(self):
+        matcher = DictionaryMatch(d=['new york city', 'new york', 'york', 'los angeles', 'angeles', 'dog'])
+        self.assertEqual(spans(matcher.apply(Ngrams(n_max=3).apply(self.sentence))), [(15, 27), (38, 48), (4, 6)])
+        matcher.longest_match_only = False
+        self.assertEqual(sorted(spans(matcher.apply(Ngrams(n_max=3).apply(self.sentence)))),
+                         [(4, 6), (15, 22), (15, 27), (19, 22), (38, 48), (42, 48)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import *
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+
+import snorkel.models.meta as meta
+import snorkel.udf
+from snorkel.udf import UDF, UDFRunner
+
+
+class CountingSession(object):
+    """Stands in for the session of a UDF, counting the added objects and the commits"""
+    def __init__(self):
+        self.added   = []
+        self.commits = []
+
+    def add(self, y):
+        self.added.append(y)
+
+    def commit(self):
+        self.commits.append(len(self.added))
+
+    def close(self):
+        pass
+
+
+class RepeatUDF(UDF):
+    """Outputs each input x, x times"""
+    # The UDFs created, to inspect their sessions
+    instances = []
+
+    def __init__(self, **kwargs):
+        super(RepeatUDF, self).__init__(**kwargs)
+        self.session.close()
+        self.session = CountingSession()
+        self.apply_calls = []
+        RepeatUDF.instances.append(self)
+
+    def apply(self, x, **kwargs):
+        self.apply_calls.append(kwargs)
+        for _ in range(x):
+            yield x
+
+
+class TestCommitBatch(unittest.TestCase):
+
+    def test_commit_batch(self):
+        udf = RepeatUDF()
+        for n in [1, 1, 1, 2, 0, 1]:
+            udf.session.added.extend([None] * n)
+            udf.commit_batch(n, 3)
+        self.assertEqual(udf.session.commits, [3, 6])
+        self.assertEqual(udf.n_uncommitted, 0)
+
+        udf = RepeatUDF()
+        udf.commit_batch(10, None)
+        self.assertEqual(udf.session.commits, [])
+
+    def test_apply_write_batch_size(self):
+        del RepeatUDF.instances[:]
+        UDFRunner(RepeatUDF).apply([1, 2, 3, 1], clear=False, progress_bar=False, write_batch_size=3, flag=True)
+        udf = RepeatUDF.instances[-1]
+        # Commits after an input once enough outputs are uncommitted, and at the end of the run
+        self.assertEqual(udf.session.commits, [3, 6, 7])
+        # write_batch_size is not passed on to apply
+        self.assertEqual(udf.apply_calls, [{'clear': False, 'flag': True}] * 4)
+
+
+class PidUDF(UDF):
+    """Outputs the pid of the worker process applied to each input, or fails on negative inputs"""
+    def apply(self, x, **kwargs):
+        if x < 0:
+            raise ValueError("negative input")
+        yield x, os.getpid(), kwargs.get('tag')
+
+    def reduce(self, y, **kwargs):
+        self.outputs.append(y)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        # The workers do not write to the database, so the pool can run on any backend
+        self.conn_string = snorkel.udf.snorkel_conn_string
+        snorkel.udf.snorkel_conn_string = 'postgresql://'
+        self.runner = UDFRunner(PidUDF)
+        self.runner.reducer.outputs = []
+
+    def tearDown(self):
+        self.runner.terminate_workers()
+        snorkel.udf.snorkel_conn_string = self.conn_string
+
+    def run_pool(self, xs, **kwargs):
+        del self.runner.reducer.outputs[:]
+        self.runner.apply(xs, clear=False, parallelism=2, progress_bar=False, **kwargs)
+        return sorted(self.runner.reducer.outputs)
+
+    def test_reuse(self):
+        self.runner.start_workers(2)
+        pids = set(udf.pid for udf in self.runner.pool)
+        outputs = self.run_pool(list(range(20)), tag='first')
+        self.assertEqual([(x, tag) for x, _, tag in outputs], [(x, 'first') for x in range(20)])
+        self.assertTrue(set(pid for _, pid, _ in outputs) <= pids)
+
+        # The same processes serve the next run, with its own apply kwargs
+        outputs = self.run_pool(list(range(5)), tag='second')
+        self.assertEqual([(x, tag) for x, _, tag in outputs], [(x, 'second') for x in range(5)])
+        self.assertTrue(set(pid for _, pid, _ in outputs) <= pids)
+        self.assertEqual(set(udf.pid for udf in self.runner.pool), pids)
+
+    def test_close_workers(self):
+        self.runner.start_workers(2)
+        workers = list(self.runner.pool)
+        self.run_pool([1, 2, 3])
+        self.runner.close_workers()
+        self.assertEqual(self.runner.pool, [])
+        self.assertFalse(any(udf.is_alive() for udf in workers))
+        self.assertTrue(all(udf.exitcode == 0 for udf in workers))
+
+    def test_worker_error(self):
+        self.runner.start_workers(2)
+        workers = list(self.runner.pool)
+        with self.assertRaises(RuntimeError):
+            self.run_pool([1, 2, -1, 3, 4])
+        # The pool is shut down rather than left waiting for the failed run
+        self.assertEqual(self.runner.pool, [])
+        self.assertFalse(any(udf.is_alive() for udf in workers))
+        self.runner.close_workers()
+
+
+class TestSQLitePerformance(unittest.TestCase):
+
+    def setUp(self):
+        if not meta.snorkel_conn_string.startswith('sqlite'):
+            self.skipTest("Snorkel database is not SQLite")
+        self.dir = tempfile.mkdtemp()
+        self.performance = meta.snorkel_sqlite_performance
+
+    def tearDown(self):
+        meta.snorkel_sqlite_performance = self.performance
+        shutil.rmtree(self.dir)
+
+    def pragmas(self):
+        engine = create_engine('sqlite:///' + os.path.join(self.dir, 'test.db'))
+        try:
+            return dict((pragma, engine.execute('PRAGMA %s' % pragma).scalar())
+                        for pragma in ['journal_mode', 'synchronous', 'cache_size', 'temp_store', 'foreign_keys'])
+        finally:
+            engine.dispose()
+
+    def test_default(self):
+        meta.snorkel_sqlite_performance = False
+        pragmas = self.pragmas()
+        self.assertEqual(pragmas['journal_mode'], 'delete')
+        self.assertEqual(pragmas['foreign_keys'], 1)
+
+    def test_performance(self):
+        meta.snorkel_sqlite_performance = True
+        self.assertEqual(self.pragmas(), {'journal_mode': 'wal', 'synchronous': 1, 'cache_size': -262144,
+                                          'temp_store': 2, 'foreign_keys': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()